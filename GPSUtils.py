@@ -66,6 +66,29 @@ def pgps_to_xy(lon, lat):
     return c[0], c[1]
 
 
+def pgps_to_xy_batch(lon, lat, out_x=None, out_y=None):
+    ''' pgps_to_xy for whole arrays of coordinates at once.
+    # Arguments:
+        lon, lat: Float64 numpy arrays of GPS coordinates.
+        out_x, out_y: Optional float64 numpy arrays (same shape as lon)
+            to write the results into.
+    # Returns:
+        x, y: Numpy arrays of coordinates in the grid.
+    '''
+    # (The same matmul as pgps_to_xy, so the results are the same to the last bit,
+    #   which summing the products one by one isn't)
+    with np.errstate(invalid='ignore', over='ignore'):
+        c = np.matmul(np.stack((np.subtract(lon, origin_array[0]), np.subtract(lat, origin_array[1])), axis=-1),
+                      inv_basis)
+    if out_x is None:
+        out_x = np.empty(c.shape[:-1])
+    if out_y is None:
+        out_y = np.empty(c.shape[:-1])
+    out_x[...] = c[..., 0]
+    out_y[...] = c[..., 1]
+    return out_x, out_y
+
+
 def gps_distance(origin, destination):
     # https://stackoverflow.com/questions/19412462/
     """
@@ -102,3 +125,57 @@ def gps_distance(origin, destination):
     d = radius * c
     
     return d*1000
+
+
+_atan2 = np.frompyfunc(atan2, 2, 1)
+
+def gps_distance_batch(lat1, lon1, lat2, lon2, out=None, errors=None):
+    ''' gps_distance (the Haversine distance, in m) for whole arrays of
+    coordinates at once.
+    # Arguments:
+        lat1, lon1, lat2, lon2: Float64 numpy arrays of GPS coordinates
+            of the origins and destinations.
+        out: Optional float64 numpy array to write the results into,
+            to avoid allocating a new array.
+        errors: Optional boolean numpy array. Set to True wherever the
+            scalar math would hit a domain error (e.g. an infinite
+            coordinate). The distance is NaN there.
+    # Returns:
+        Numpy array of distances in meters.
+    '''
+    radius = 6371  # km
+    
+    with np.errstate(invalid='ignore', over='ignore'):
+        dlat = np.radians(np.subtract(lat2, lat1))
+        dlon = np.radians(np.subtract(lon2, lon1))
+        cos1 = np.radians(lat1)
+        cos2 = np.radians(lat2)
+        if errors is not None:
+            errors[...] = np.isinf(dlat) | np.isinf(dlon) | np.isinf(cos1) | np.isinf(cos2)
+        
+        # a = sin(dlat/2)**2 + cos(lat1)*cos(lat2)*sin(dlon/2)**2, in place
+        dlat /= 2
+        a = np.sin(dlat, out=dlat)
+        a *= a
+        dlon /= 2
+        np.sin(dlon, out=dlon)
+        np.cos(cos1, out=cos1)
+        np.cos(cos2, out=cos2)
+        cos1 *= cos2
+        cos1 *= dlon
+        cos1 *= dlon
+        a += cos1
+        if errors is not None:
+            errors |= (a < 0) | (a > 1)
+        
+        # c = 2 * atan2(sqrt(a), sqrt(1 - a)). (np.arctan2 now and then differs from
+        #   math.atan2 in the last bit, unlike np.sin, np.cos and np.sqrt, so it's math.atan2)
+        np.subtract(1, a, out=cos2)
+        if out is None:
+            out = np.empty(np.shape(a))
+        out[...] = _atan2(np.sqrt(a, out=a), np.sqrt(cos2, out=cos2))
+        out *= 2
+        out *= radius
+        out *= 1000
+    
+    return out
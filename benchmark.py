@@ -0,0 +1,379 @@
+''' Benchmarks of the processing, on made-up trip data.
+
+generate_lines makes a seeded, realistic month of trip_data .csv lines, in
+the column layout of example.csv: trips spread over the month in order of
+pickup time, most of them in Manhattan, with given rates of malformed
+lines (unparsable), invalid trips (see utils.check_valid) and trips that
+end in the next month. benchmark then times each stage on it, at each grid
+configuration, each in a fresh process:
+
+    process_entry, check_valid, update_data:
+        The per-line functions ("--engine line"), over every line, every
+        parsable line, and every valid trip.
+    process_entries, check_valid_entries, update_data_entries:
+        Their batch versions ("--engine batch"), batchsize lines at a time.
+    process_month_line, process_month_batch:
+        main.process_month_resolutions with each engine, reading included.
+    save:
+        main.save_month of the processed month.
+
+For each, it reports lines per second (of the lines, entries or trips the
+stage went through), seconds, and the peak RSS of its process. Results are
+saved as JSON, so two runs can be compared (see compare):
+
+    python3.6 benchmark.py --lines 1000000 -R 10x20n4 5x10n2 -o before.json
+    python3.6 benchmark.py --lines 1000000 -R 10x20n4 5x10n2 -o after.json
+    python3.6 benchmark.py --compare before.json after.json
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import concurrent.futures
+import numpy as np
+import utils
+import sparseutils
+import instrument
+import main
+from GPSUtils import origin_longitude, origin_latitude, top_left_longitude, top_left_latitude, \
+                     bottom_right_longitude, bottom_right_latitude
+
+header = '"medallion"," hack_license"," vendor_id"," rate_code"," store_and_fwd_flag"," pickup_datetime",' \
+         '" dropoff_datetime"," passenger_count"," trip_time_in_secs"," trip_distance"," pickup_longitude",' \
+         '" pickup_latitude"," dropoff_longitude"," dropoff_latitude"\n'
+
+STAGES = ("process_entry", "check_valid", "update_data",
+          "process_entries", "check_valid_entries", "update_data_entries",
+          "process_month_line", "process_month_batch", "save")
+
+def generate_lines(year, month, lines, seed=0, malformed=0.001, invalid=0.05, crossing=0.001):
+    ''' Yield lines lines of made-up trips starting in (year, month), in the
+        format of the FOIL trip_data .csv files (header excluded).
+
+    # Arguments:
+        year, month: The month the trips start in.
+        lines: The number of lines.
+        seed: Seed of the random numbers. The same seed gives the same lines.
+        malformed: The rate of lines that can't be parsed (missing columns,
+            a bad coordinate, or a missing pickup time).
+        invalid: The rate of trips that utils.check_valid rejects (at 0,0,
+            too short, not moving, or too fast).
+        crossing: The rate of trips that start in the last half hour of the
+            month and end in the next one.
+    '''
+    rng = np.random.RandomState(seed)
+    month_start = int(utils.epoch_seconds(year, month, 1, 0, 0, 0))
+    month_seconds = utils.no_days_in_mo(year=year, month=month) * 24 * 3600
+    crossings = rng.binomial(lines, crossing) if lines else 0
+    regular = lines - crossings
+    b1 = np.array([bottom_right_longitude - origin_longitude, bottom_right_latitude - origin_latitude])
+    b2 = np.array([top_left_longitude - origin_longitude, top_left_latitude - origin_latitude])
+    # (Made 100000 lines at a time)
+    for first in range(0, lines, 100000):
+        size = min(100000, lines - first)
+        index = np.arange(first, first + size)
+        # Pickup times in order: the regular trips spread over the month but
+        #   its last half hour, then the crossing trips in it
+        is_crossing = index >= regular
+        spread = np.where(is_crossing,
+                          month_seconds - 1800 + (index - regular + rng.uniform(size=size)) * 1800 / max(crossings, 1),
+                          (index + rng.uniform(size=size)) * (month_seconds - 1800) / max(regular, 1))
+        start = np.floor(spread).astype(np.int64)
+        duration = np.clip(np.exp(rng.normal(np.log(660), 0.6, size=size)), 60, 3 * 3600).astype(np.int64)
+        duration = np.where(is_crossing, month_seconds - start + rng.randint(60, 1800, size=size), duration)
+
+        # Mostly in Manhattan (the unit grid, see GPSUtils), some just outside it
+        u, v = rng.uniform(-0.15, 1.15, size=size), rng.uniform(-0.15, 1.15, size=size)
+        slon = origin_longitude + u * b1[0] + v * b2[0]
+        slat = origin_latitude + u * b1[1] + v * b2[1]
+        meters = np.minimum(rng.uniform(2, 12, size=size) * duration, 15000)
+        angle = rng.uniform(0, 2 * np.pi, size=size)
+        elon = slon + meters * np.cos(angle) / 84300
+        elat = slat + meters * np.sin(angle) / 111200
+
+        kind = np.where((rng.uniform(size=size) < invalid) & ~is_crossing, rng.randint(4, size=size), -1)
+        slon[kind == 0], slat[kind == 0] = 0, 0                                 # At 0,0 (too fast)
+        duration[kind == 1] = rng.randint(0, 59, size=size)[kind == 1]          # Too short
+        elon[kind == 2], elat[kind == 2] = slon[kind == 2], slat[kind == 2]     # Not moving
+        elon[kind == 3] = slon[kind == 3] + 50 * duration[kind == 3] / 84300    # Too fast
+        miles = meters * rng.uniform(1.1, 1.6, size=size) / 1609.34
+
+        pcount = rng.choice(np.arange(1, 7), size=size, p=[0.7, 0.14, 0.05, 0.03, 0.05, 0.03])
+        vendor = np.where(rng.uniform(size=size) < 0.5, "VTS", "CMT")
+        flag = np.where(rng.uniform(size=size) < 0.5, "", "N")
+        pickup = np.datetime_as_string((month_start + start).astype("datetime64[s]"))
+        dropoff = np.datetime_as_string((month_start + start + duration).astype("datetime64[s]"))
+        medallion = year * 1000000 + index % 1000000 + 1
+
+        broken = np.where(rng.uniform(size=size) < malformed, rng.randint(3, size=size), -1)
+        for ii in range(size):
+            line = '%d,%d,"%s",1,%s,"%s","%s",%d,%d,%.2f,%.6f,%.6f,%.6f,%.6f' % (
+                medallion[ii], medallion[ii], vendor[ii], flag[ii], pickup[ii].replace("T", " "),
+                dropoff[ii].replace("T", " "), pcount[ii], duration[ii], miles[ii],
+                slon[ii], slat[ii], elon[ii], elat[ii])
+            if broken[ii] >= 0:
+                columns = line.split(",")
+                if broken[ii] == 0:
+                    columns = columns[:8]     # Missing columns
+                elif broken[ii] == 1:
+                    columns[10] = "-73.9x"    # Bad coordinate
+                else:
+                    columns[5] = ""           # Missing pickup time
+                line = ",".join(columns)
+            yield line + "\n"
+
+def write_month(year, month, lines, datadir=".", **kwargs):
+    ''' Write lines made-up trips (see generate_lines, which kwargs are
+        passed on to) to the .csv main.py reads (year, month) from in
+        datadir. Returns its filename.'''
+    filename = main.get_load_filename(year=year, month=month, datadir=datadir)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as write_f:
+        write_f.write(header)
+        write_f.writelines(generate_lines(year=year, month=month, lines=lines, **kwargs))
+    return filename
+
+def _gen_arrays(year, month, w, h, n):
+    # Empty arrays to accumulate a month into, as main.process_month_resolutions makes them
+    spill = sparseutils.gen_empty_spill(w=w, h=h, n=n)
+    return {'trips' : np.zeros((2, 2, 2)),
+            'vdata' : utils.gen_empty_vdata(year=year, month=month, w=w, h=h, n=n),
+            'fdata' : utils.gen_empty_fdata(year=year, month=month, w=w, h=h, n=n),
+            'vdata_next_mo' : spill['vdata'],
+            'fdata_next_mo' : spill['fdata']}
+
+def _parse_lines(lines, n):
+    # The entries of the parsable lines
+    entries = []
+    for line in lines:
+        try:
+            entries.append(utils.process_entry(line=line, n=n))
+        except:
+            pass
+    return entries
+
+def _parse_batches(lines, n, batchsize, year=None, month=None):
+    # The entries of each batch the batch functions can handle (and, given
+    #   year and month, that are valid)
+    batches = []
+    for batch in utils.read_batches(lines, batchsize=batchsize):
+        entries = utils.process_entries(batch, n=n)
+        ok = entries['ok']
+        if year is not None:
+            ok &= utils.check_valid_entries(entries, year=year, month=month)
+        batches.append(utils.select_entries(entries, ok))
+    return batches
+
+def run_stage(stage, year, month, resolution, datadir=".", batchsize=100000, save_format="npz"):
+    ''' Time one stage (see STAGES) on the (year, month) in datadir at the
+        resolution (w, h, n). Run it in a process of its own, for its peak
+        RSS to be the stage's.
+        Returns a dict of the 'lines' (or entries, or trips) the stage went
+        through, the 'seconds' it took, 'lines_per_sec', the 'peak_rss'
+        (bytes) of the process, and 'setup_peak_rss', its peak RSS before
+        the stage started (reading the lines, etc.).'''
+    w, h, n = resolution
+    if stage not in STAGES:
+        raise ValueError("Unknown stage " + repr(stage) + ", should be one of " + ", ".join(STAGES))
+    month_kwargs = dict(year=year, month=month, resolutions=[resolution], batchsize=batchsize, datadir=datadir)
+    lines = []
+    if not stage.startswith("process_month") and stage != "save":
+        with open(main.get_load_filename(year=year, month=month, datadir=datadir), "r") as read_f:
+            next(read_f, None) # Skip header
+            lines = read_f.readlines()
+    arrays = _gen_arrays(year, month, w, h, n)
+    count = len(lines)
+    extra = {}
+
+    # Setup, not timed
+    if stage == "check_valid":
+        entries = _parse_lines(lines, n)
+        count = len(entries)
+    elif stage == "update_data":
+        entries = [entry for entry in _parse_lines(lines, n) if utils.check_valid(entry=entry, year=year, month=month)]
+        count = len(entries)
+    elif stage == "check_valid_entries":
+        batches = _parse_batches(lines, n, batchsize)
+        count = sum(len(entries['ok']) for entries in batches)
+    elif stage == "update_data_entries":
+        batches = _parse_batches(lines, n, batchsize, year=year, month=month)
+        count = sum(len(entries['ok']) for entries in batches)
+    elif stage == "save":
+        with contextlib.redirect_stdout(io.StringIO()):
+            data, _, count = main.process_month_resolutions(engine="batch", **month_kwargs)
+        data = data[resolution]
+        savedir = tempfile.mkdtemp(prefix="tmp-save-", dir=datadir)
+    setup_peak_rss = instrument.peak_rss()
+
+    start = time.time()
+    if stage == "process_entry":
+        _parse_lines(lines, n)
+    elif stage == "check_valid":
+        for entry in entries:
+            utils.check_valid(entry=entry, year=year, month=month)
+    elif stage == "update_data":
+        for entry in entries:
+            try:
+                utils.update_data(entry=entry, w=w, h=h, n=n, **arrays)
+            except:
+                pass
+    elif stage == "process_entries":
+        for batch in utils.read_batches(lines, batchsize=batchsize):
+            utils.process_entries(batch, n=n)
+    elif stage == "check_valid_entries":
+        for entries in batches:
+            utils.check_valid_entries(entries, year=year, month=month)
+    elif stage == "update_data_entries":
+        for entries in batches:
+            utils.update_data_entries(entries, w=w, h=h, n=n, **arrays)
+    elif stage.startswith("process_month"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, _, count = main.process_month_resolutions(engine=stage[len("process_month_"):], **month_kwargs)
+    else: # save
+        save_filename = main.save_month(year=year, month=month, data=data, savedir=savedir,
+                                        save_format=save_format, n=n)
+    seconds = time.time() - start
+
+    if stage == "save":
+        extra['bytes'] = os.path.getsize(save_filename)
+        shutil.rmtree(savedir)
+    return dict(lines=count, seconds=seconds, lines_per_sec=count / seconds if seconds > 0 else None,
+                peak_rss=instrument.peak_rss(), setup_peak_rss=setup_peak_rss, **extra)
+
+def benchmark(lines=200000, year=2010, month=1, resolutions=((10, 20, 4),), stages=STAGES, seed=0,
+              malformed=0.001, invalid=0.05, crossing=0.001, batchsize=100000, save_format="npz", workdir=None,
+              V=True):
+    ''' Make a month of lines made-up trips (see generate_lines) in a
+        temporary directory in workdir, and time each stage of processing
+        it at each resolution (see run_stage), each in a fresh process.
+        Returns the results as a dict (of the 'config', the 'environment'
+        and a list of 'results', one per resolution and stage), to be saved
+        as JSON. With V, prints each result as it is done.'''
+    resolutions = [tuple(resolution) for resolution in resolutions]
+    config = dict(lines=lines, year=year, month=month, resolutions=["%dx%dn%d" % resolution for resolution in resolutions],
+                  stages=list(stages), seed=seed, malformed=malformed, invalid=invalid, crossing=crossing,
+                  batchsize=batchsize, save_format=save_format)
+    environment = dict(python=platform.python_version(), numpy=np.__version__, platform=platform.platform(),
+                       cpus=os.cpu_count())
+    results = []
+    tempdir = tempfile.mkdtemp(prefix="tmp-benchmark-", dir=workdir)
+    try:
+        write_month(year=year, month=month, lines=lines, datadir=tempdir, seed=seed,
+                    malformed=malformed, invalid=invalid, crossing=crossing)
+        for resolution in resolutions:
+            for stage in stages:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                    result = executor.submit(run_stage, stage, year=year, month=month, resolution=resolution,
+                                             datadir=tempdir, batchsize=batchsize, save_format=save_format).result()
+                result = dict(resolution="%dx%dn%d" % resolution, stage=stage, **result)
+                results.append(result)
+                if V:
+                    print(format_result(result))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+    return dict(config=config, environment=environment, results=results)
+
+def format_result(result):
+    ''' Return a line describing one result from benchmark.'''
+    rate = "-" if result['lines_per_sec'] is None else "%.0f" % result['lines_per_sec']
+    return "%-10s %-20s %12s lines/s %9.3fs %8.1f MB peak" % (result['resolution'], result['stage'], rate,
+                                                                result['seconds'], result['peak_rss'] / 2**20)
+
+def compare(old, new, tolerance=0.1):
+    ''' Compare two results of benchmark (as loaded from their JSON).
+        Returns a list of (resolution, stage, old lines_per_sec, new
+        lines_per_sec) for the stages of both, and the list of the
+        (resolution, stage) pairs that are more than tolerance slower.'''
+    old_rates = {(result['resolution'], result['stage']) : result['lines_per_sec'] for result in old['results']}
+    rows, slower = [], []
+    for result in new['results']:
+        key = (result['resolution'], result['stage'])
+        if key not in old_rates:
+            continue
+        rows.append(key + (old_rates[key], result['lines_per_sec']))
+        if old_rates[key] and result['lines_per_sec'] is not None and \
+           result['lines_per_sec'] < old_rates[key] * (1 - tolerance):
+            slower.append(key)
+    return rows, slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark processing on made-up trip data")
+    parser.add_argument("--lines", "-l",
+                        help="The number of lines in the made-up month. (Default 200000)",
+                        type=int, nargs=1)
+    parser.add_argument("--resolutions", "-R",
+                        help="The grid configurations to benchmark, each as WIDTHxHEIGHTnN. (Default 10x20n4)",
+                        type=main.parse_resolution, nargs="+")
+    parser.add_argument("--stages", "-s",
+                        help="The stages to time. (Default all)",
+                        choices=STAGES, nargs="+")
+    parser.add_argument("--year", "-yr",
+                        help="Year of the made-up month. (Default 2010)",
+                        type=int, nargs=1)
+    parser.add_argument("--month", "-mo",
+                        help="Month of the made-up month. (Default 1)",
+                        type=int, nargs=1)
+    parser.add_argument("--seed",
+                        help="Seed of the made-up data. (Default 0)",
+                        type=int, nargs=1)
+    parser.add_argument("--malformed",
+                        help="Rate of unparsable lines. (Default 0.001)",
+                        type=float, nargs=1)
+    parser.add_argument("--invalid",
+                        help="Rate of invalid trips. (Default 0.05)",
+                        type=float, nargs=1)
+    parser.add_argument("--crossing",
+                        help="Rate of trips that end in the next month. (Default 0.001)",
+                        type=float, nargs=1)
+    parser.add_argument("--batchsize", "-b",
+                        help="Number of lines per batch for the batch stages. (Default 100000)",
+                        type=int, nargs=1)
+    parser.add_argument("--format", "-f",
+                        help="Format for the save stage, as main.py --format. (Default npz)",
+                        choices=["npz", "chunked"], nargs=1)
+    parser.add_argument("--workdir", "-d",
+                        help="Directory to make the data in. (Default: the system's temporary directory)",
+                        type=str, nargs=1)
+    parser.add_argument("--output", "-o",
+                        help="JSON file to save the results to.",
+                        type=str, nargs=1)
+    parser.add_argument("--compare", "-c",
+                        help="Compare two saved results, OLD NEW, instead of benchmarking.",
+                        type=str, nargs=2)
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        with open(args.compare[0], "r") as read_f:
+            old = json.load(read_f)
+        with open(args.compare[1], "r") as read_f:
+            new = json.load(read_f)
+        rows, slower = compare(old, new)
+        for resolution, stage, old_rate, new_rate in rows:
+            ratio = "%.2fx" % (new_rate / old_rate) if old_rate and new_rate is not None else "-"
+            print("%-10s %-20s %12.0f -> %12.0f lines/s  %s%s" % (resolution, stage, old_rate or 0, new_rate or 0,
+                                                                ratio, "  SLOWER" if (resolution, stage) in slower else ""))
+        sys.exit(1 if slower else 0)
+
+    results = benchmark(lines       = 200000 if args.lines     is None else args.lines[0],
+                        year        = 2010   if args.year      is None else args.year[0],
+                        month       = 1      if args.month     is None else args.month[0],
+                        resolutions = [(10, 20, 4)] if args.resolutions is None else args.resolutions,
+                        stages      = STAGES if args.stages    is None else args.stages,
+                        seed        = 0      if args.seed      is None else args.seed[0],
+                        malformed   = 0.001  if args.malformed is None else args.malformed[0],
+                        invalid     = 0.05   if args.invalid   is None else args.invalid[0],
+                        crossing    = 0.001  if args.crossing  is None else args.crossing[0],
+                        batchsize   = 100000 if args.batchsize is None else args.batchsize[0],
+                        save_format = "npz"  if args.format    is None else args.format[0],
+                        workdir     = None   if args.workdir   is None else args.workdir[0])
+    if args.output is not None:
+        with open(args.output[0], "w") as write_f:
+            json.dump(results, write_f, indent=1)
+        print("Saved", args.output[0])
@@ -0,0 +1,184 @@
+''' A multithreaded alternative to np.savez_compressed and np.load.
+
+np.savez_compressed compresses each array with one thread, which takes
+minutes for a ~1GB fdata. A chunked file (.npzc) is a zip archive holding
+each array split into chunks along its time slot axis, each compressed
+with zlib on its own in a thread pool (zlib releases the GIL), plus
+'meta.json' with the shape, dtype and chunk bounds of each array. The zip
+itself doesn't compress anything, so the chunks can also be read back and
+decompressed in parallel. Loading gives back exactly the saved arrays.
+
+Chunks can also hold a fixed number of time slots each (e.g. one day's),
+so load_range can read a range of slots by decompressing only the chunks
+it touches. (See slotreader.py to read across months.)
+'''
+
+import os
+import json
+import bisect
+import zlib
+import zipfile
+import concurrent.futures
+import numpy as np
+
+extension = ".npzc"
+
+def time_axis(name, array):
+    ''' The axis to split the array name into chunks along by default:
+        the time slot axis, 1 for fdata and 0 for anything else.'''
+    return 1 if name.startswith("fdata") and array.ndim > 1 else 0
+
+def _chunk_bounds(shape, itemsize, axis, chunkbytes, chunkslots=None):
+    # Positions along axis where chunks of about chunkbytes bytes (or of
+    #   chunkslots positions) start (and the end)
+    size = shape[axis]
+    position_bytes = itemsize * int(np.prod(shape[:axis] + shape[axis+1:], dtype=np.int64))
+    step = max(1, chunkbytes // max(1, position_bytes)) if chunkslots is None else chunkslots
+    return list(range(0, size, step)) + [size] if size else [0]
+
+def _chunk_index(info, ii):
+    # Index of the ii-th chunk of an array, given its entry in meta.json
+    if info['axis'] is None:
+        return (Ellipsis,)
+    index = [slice(None)] * len(info['shape'])
+    index[info['axis']] = slice(info['bounds'][ii], info['bounds'][ii+1])
+    return tuple(index)
+
+def _entry_name(name, ii):
+    return name + "/" + str(ii).zfill(6)
+
+def save_chunked(filename, arrays, chunkbytes=1<<24, level=6, workers=None, axes=None, chunkslots=None):
+    ''' Save the dict of numpy arrays to a chunked file at filename.
+
+    # Arguments:
+        filename: The file to write, usually ending in .npzc.
+        arrays: Dict of numpy arrays (or memory maps) to save.
+        chunkbytes: About how many (uncompressed) bytes to put in a chunk.
+        level: zlib compression level, 1 (fastest) to 9 (smallest).
+            (Default 6, as with np.savez_compressed)
+        workers: Number of threads to compress with. (Default: one per CPU)
+        axes: Optional dict mapping array names to the axis to split them
+            along. (Default: see time_axis)
+        chunkslots: If given, each chunk holds this many positions along
+            the axis (e.g. one day of time slots, 24*n), instead of about
+            chunkbytes bytes.
+    '''
+    axes = {} if axes is None else axes
+    meta = {'arrays' : {}}
+    chunks = [] # (name, index of chunk, array)
+    for name, array in arrays.items():
+        array = np.asanyarray(array)
+        if array.dtype.hasobject:
+            raise ValueError("Can't save " + name + ": arrays of Python objects aren't supported.")
+        info = {'shape' : list(array.shape),
+                'dtype' : np.lib.format.dtype_to_descr(array.dtype),
+                'axis'  : None,
+                'bounds': [0, 1]}
+        if array.ndim:
+            info['axis'] = axes.get(name, time_axis(name, array))
+            info['bounds'] = _chunk_bounds(array.shape, array.dtype.itemsize, info['axis'],
+                                           chunkbytes, chunkslots)
+        meta['arrays'][name] = info
+        chunks += [(name, ii, array) for ii in range(len(info['bounds']) - 1)]
+
+    def compress(chunk):
+        name, ii, array = chunk
+        return zlib.compress(np.ascontiguousarray(array[_chunk_index(meta['arrays'][name], ii)]).tobytes(), level)
+
+    with zipfile.ZipFile(filename, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for (name, ii, _), data in zip(chunks, executor.map(compress, chunks)):
+                archive.writestr(_entry_name(name, ii), data)
+        archive.writestr("meta.json", json.dumps(meta))
+
+def read_chunked_header(filename, name):
+    ''' Return (shape, dtype) of the array name in the chunked file at
+        filename, without loading it.'''
+    with zipfile.ZipFile(filename) as archive:
+        info = json.loads(archive.read("meta.json"))['arrays'][name]
+    return tuple(info['shape']), np.lib.format.descr_to_dtype(info['dtype'])
+
+def load_chunked(filename, keys=None, workers=None):
+    ''' Load the arrays in the chunked file at filename, decompressing in
+        workers threads. (Default: one per CPU)
+        Returns a dict of numpy arrays: all of them, or just the names in keys.'''
+    with zipfile.ZipFile(filename) as archive:
+        meta = json.loads(archive.read("meta.json"))
+        keys = list(meta['arrays']) if keys is None else keys
+        arrays = {}
+        for name in keys:
+            info = meta['arrays'][name]
+            arrays[name] = np.empty(info['shape'], dtype=np.lib.format.descr_to_dtype(info['dtype']))
+
+        def decompress(chunk):
+            name, ii, data = chunk
+            array = arrays[name]
+            target = array[_chunk_index(meta['arrays'][name], ii)]
+            target[...] = np.frombuffer(zlib.decompress(data), dtype=array.dtype).reshape(target.shape)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(decompress, (name, ii, archive.read(_entry_name(name, ii))))
+                       for name in keys for ii in range(len(meta['arrays'][name]['bounds']) - 1)]
+            for future in futures:
+                future.result()
+    return arrays
+
+def read_chunked_names(filename):
+    ''' Return the names of the arrays in the chunked file at filename.'''
+    with zipfile.ZipFile(filename) as archive:
+        return list(json.loads(archive.read("meta.json"))['arrays'])
+
+def load_range(filename, name, start, end, workers=None):
+    ''' Load positions start to end (exclusive) along the chunked axis of
+        the array name (e.g. time slots start to end of fdata) from the
+        chunked file at filename, decompressing only the chunks holding them.
+
+    # Arguments:
+        filename: The chunked file to read.
+        name: The name of the array.
+        start, end: The range of positions to read. 0 <= start <= end <= the
+            length of the axis.
+        workers: Number of threads to decompress with. (Default: one per CPU)
+    # Returns:
+        A numpy array, the same as load_chunked(filename)[name][start:end]
+        along its chunked axis.
+    '''
+    with zipfile.ZipFile(filename) as archive:
+        info = json.loads(archive.read("meta.json"))['arrays'][name]
+        axis, bounds = info['axis'], info['bounds']
+        if axis is None:
+            raise ValueError("Can't read a range of " + name + ": it has no axes.")
+        if not 0 <= start <= end <= info['shape'][axis]:
+            raise ValueError("Can't read positions " + str(start) + " to " + str(end) + " of " + name +
+                             ", which has " + str(info['shape'][axis]))
+        shape = list(info['shape'])
+        shape[axis] = end - start
+        array = np.empty(shape, dtype=np.lib.format.descr_to_dtype(info['dtype']))
+        if start == end:
+            return array
+        # The chunks holding positions start to end-1
+        first = bisect.bisect_right(bounds, start) - 1
+        last = bisect.bisect_right(bounds, end - 1) - 1
+
+        def decompress(chunk):
+            ii, data = chunk
+            lo, hi = bounds[ii], bounds[ii+1]
+            chunk_shape = list(info['shape'])
+            chunk_shape[axis] = hi - lo
+            data = np.frombuffer(zlib.decompress(data), dtype=array.dtype).reshape(chunk_shape)
+            source = [slice(None)] * len(shape)
+            target = [slice(None)] * len(shape)
+            source[axis] = slice(max(lo, start) - lo, min(hi, end) - lo)
+            target[axis] = slice(max(lo, start) - start, min(hi, end) - start)
+            array[tuple(target)] = data[tuple(source)]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(decompress, (ii, archive.read(_entry_name(name, ii))))
+                       for ii in range(first, last + 1)]
+            for future in futures:
+                future.result()
+    return array
+
+def is_chunked(filename):
+    ''' Return True if filename is a chunked file (by its extension).'''
+    return os.path.splitext(filename)[1] == extension
@@ -0,0 +1,141 @@
+''' Counts of the lines of a month that couldn't be processed, by reason.
+
+Instead of printing each unparsable line as it's found, main.process adds
+every line it can't use to an ErrorSink, with why:
+
+    Unparsable (see utils.UNPARSABLE_REASONS): missing_columns, bad_timestamp,
+        bad_float, bad_pcount, out_of_range (parses, but can't be added), other.
+    Invalid (see utils.INVALID_REASONS): the first rule of utils.check_valid
+        the trip breaks; wrong_month, too_close, too_short or too_fast.
+
+Along with the counts, it keeps a reservoir sample of up to samplesize of
+the lines for each reason, with their line numbers, so a month's report
+(see ErrorSink.report) stays small however dirty the month is. Adding
+lines doesn't print or write anything.
+'''
+
+import json
+import collections
+import numpy as np
+import utils
+
+class ErrorSink:
+    ''' The count of each reason lines couldn't be used for, and a sample of
+        the lines.
+
+    # Arguments:
+        samplesize: The most lines to keep for each reason.
+        seed: Seed of the random sampling. (The same lines, added in the same
+            order, are sampled the same way)
+    '''
+    def __init__(self, samplesize=10, seed=0):
+        self.samplesize = samplesize
+        self.random = np.random.RandomState(seed)
+        self.counts = collections.OrderedDict((reason, 0) for reason in utils.UNPARSABLE_REASONS + utils.INVALID_REASONS)
+        self.samples = collections.OrderedDict((reason, []) for reason in self.counts) # [line_number, text]
+        self.batch = None # (first_line_number, lines) of the batch being added, to sample text from
+
+    def set_batch(self, first_line_number, lines):
+        ''' Look up the text of lines added without it in lines, the batch
+            starting at first_line_number. (See add_many)'''
+        self.batch = (first_line_number, lines)
+
+    def _text(self, line_number):
+        # The text of line_number, from the batch, if it's in it
+        if self.batch is None:
+            return None
+        first_line_number, lines = self.batch
+        if 0 <= line_number - first_line_number < len(lines):
+            return lines[line_number - first_line_number].rstrip("\r\n")
+        return None
+
+    def _keep(self, reason, line_number, line, index):
+        # Put the line in reason's sample, in place index (or at the end)
+        sample = [int(line_number), self._text(line_number) if line is None else line.rstrip("\r\n")]
+        if index < len(self.samples[reason]):
+            self.samples[reason][index] = sample
+        else:
+            self.samples[reason].append(sample)
+
+    def add(self, reason, line_number, line=None):
+        ''' Add a line, numbered line_number, that couldn't be used for reason.
+            Its text is line, or looked up in the batch. (See set_batch)'''
+        seen = self.counts[reason]
+        self.counts[reason] = seen + 1
+        index = seen if seen < self.samplesize else self.random.randint(0, seen + 1)
+        if index < self.samplesize:
+            self._keep(reason, line_number, line, index)
+
+    def add_many(self, reason, line_numbers):
+        ''' Add the lines numbered line_numbers (an array), that couldn't be
+            used for reason, as add does, at once.'''
+        line_numbers = np.asarray(line_numbers)
+        if len(line_numbers) == 0:
+            return
+        seen = self.counts[reason]
+        self.counts[reason] = seen + len(line_numbers)
+        # Each line replaces a random line of the sample with probability samplesize / (lines so far)
+        positions = seen + np.arange(len(line_numbers))
+        indices = np.where(positions < self.samplesize, positions, self.random.randint(0, positions + 1))
+        for kept in np.flatnonzero(indices < self.samplesize):
+            self._keep(reason, line_numbers[kept], None, indices[kept])
+
+    def merge(self, other, offset=0):
+        ''' Add the counts and samples of the ErrorSink other, whose line
+            numbers are offset by offset (e.g. the lines of the parts of a
+            month before it), into this one. Returns nothing.'''
+        for reason, count in other.counts.items():
+            samples = self.samples[reason] + [[line_number + offset, text]
+                                              for line_number, text in other.samples[reason]]
+            if len(samples) > self.samplesize:
+                # Each line stands for (count / sample size) lines of its sink
+                weights = np.array([self.counts[reason] / max(len(self.samples[reason]), 1)] * len(self.samples[reason])
+                                   + [count / max(len(other.samples[reason]), 1)] * len(other.samples[reason]))
+                kept = self.random.choice(len(samples), size=self.samplesize, replace=False, p=weights / weights.sum())
+                samples = [samples[index] for index in sorted(kept)]
+            self.samples[reason] = samples
+            self.counts[reason] += count
+
+    @property
+    def unparsable(self):
+        ''' The number of unparsable lines.'''
+        return sum(self.counts[reason] for reason in utils.UNPARSABLE_REASONS)
+
+    @property
+    def invalid(self):
+        ''' The number of parsable lines that aren't valid trips.'''
+        return sum(self.counts[reason] for reason in utils.INVALID_REASONS)
+
+    def report(self):
+        ''' Return a dict of the counts, to save as JSON: the unparsable and
+            invalid totals, the count of each reason, and the sample of each
+            reason, as [line_number, text] sorted by line number.'''
+        return collections.OrderedDict([
+            ('unparsable', self.unparsable), ('invalid', self.invalid),
+            ('counts', collections.OrderedDict(self.counts)),
+            ('samples', collections.OrderedDict((reason, sorted(samples))
+                                                for reason, samples in self.samples.items() if samples))])
+
+    @classmethod
+    def from_report(cls, report, samplesize=10, seed=0):
+        ''' Return an ErrorSink with the counts and samples of report.
+            (See ErrorSink.report)'''
+        sink = cls(samplesize=samplesize, seed=seed)
+        for reason, count in report['counts'].items():
+            sink.counts[reason] = count
+        for reason, samples in report['samples'].items():
+            sink.samples[reason] = [list(sample) for sample in samples]
+        return sink
+
+    def summary(self):
+        ''' Return a line giving the totals and the count of each reason.'''
+        def counts(reasons):
+            found = ["%s %d" % (reason, self.counts[reason]) for reason in reasons if self.counts[reason]]
+            return " (%s)" % ", ".join(found) if found else ""
+        return "    Errors: %d unparsable%s, %d invalid%s" % (self.unparsable, counts(utils.UNPARSABLE_REASONS),
+                                                              self.invalid, counts(utils.INVALID_REASONS))
+
+    def write(self, filename):
+        ''' Save the report (see ErrorSink.report) to filename as JSON.'''
+        with open(filename, "w") as write_f:
+            json.dump(self.report(), write_f, indent=1)
@@ -0,0 +1,324 @@
+''' Differential tests of the faster ways of processing against the original one.
+
+Every engine and option of main.process is meant to save exactly the same
+arrays as the original per-line path (process_entry, check_valid and
+update_data; "--engine line"). check runs that path and each candidate
+(see CANDIDATES) over the same months, and compares every array they save
+(vdata, fdata, trips and errors) element for element. Where two arrays
+differ, it reports the first index (in C order) they differ at, the values
+there, how many elements differ, and, along each axis, which indices the
+differences are at (see diff_arrays).
+
+The months can be real ones (--datadir), a slice of the first --lines
+lines of each, example.csv (--example) or made-up trips (--synthetic LINES,
+see benchmark.generate_lines):
+
+    python3.6 golden.py --synthetic 200000 -R 10x20n4 5x10n2
+    python3.6 golden.py -sy 2012 -sm 3 -ey 2012 -em 4 --datadir ../decompressed --candidates batch jobs
+
+It exits with 1 if any candidate differs.
+'''
+
+import io
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import contextlib
+import collections
+import numpy as np
+import utils
+import readers
+import tripcache
+import benchmark
+import main
+
+# The keyword arguments of main.process each candidate runs with. ("cache"
+#   is ingested into a cache with tripcache.py first)
+CANDIDATES = collections.OrderedDict([
+    ("batch",    dict(engine="batch")),
+    ("sparse",   dict(engine="batch", sparse=True)),
+    ("jobs",     dict(engine="batch", jobs=2, splits=2)),
+    ("parts",    dict(engine="batch", resume=True, splits=2)),
+    ("stream",   dict(engine="batch", stream=True)),
+    ("pipeline", dict(engine="batch", pipeline_workers=1)),
+    ("chunked",  dict(engine="batch", save_format="chunked")),
+    ("cache",    dict(engine="batch")),
+])
+
+def diff_arrays(expected, actual, limit=5):
+    ''' Compare two arrays element for element.
+
+    # Arguments:
+        expected, actual: The arrays. (Anything np.asarray takes)
+        limit: The most indices to list along each axis.
+    # Returns:
+        An OrderedDict: 'equal', True if they have the same shape, dtype and
+        elements (NaNs equal to NaNs). If not, 'shape' and 'dtype' are their
+        (expected, actual) shapes and dtypes. For the same shape, also
+        'differing', the number of elements that differ, 'first', the first
+        index they differ at, 'expected' and 'actual', the values there, and
+        'axes', a list for each axis of the indices along it with any
+        differences, as [index, number of differing elements], the first
+        limit of them, with 'count', the number of them.
+    '''
+    expected, actual = np.asarray(expected), np.asarray(actual)
+    result = collections.OrderedDict([('equal', expected.shape == actual.shape and expected.dtype == actual.dtype),
+                                      ('shape', [list(expected.shape), list(actual.shape)]),
+                                      ('dtype', [str(expected.dtype), str(actual.dtype)])])
+    if expected.shape != actual.shape:
+        return result
+    if expected.ndim == 0:
+        expected, actual = expected.reshape(1), actual.reshape(1)
+    # (A few rows at a time, to not need a boolean array of the whole month)
+    counts = [np.zeros(size, dtype=np.int64) for size in expected.shape]
+    first = None
+    rows = max(1, 2**24 // max(expected[0:1].size, 1))
+    for start in range(0, expected.shape[0], rows):
+        expected_rows, actual_rows = expected[start:start + rows], actual[start:start + rows]
+        differ = expected_rows != actual_rows
+        if expected_rows.dtype.kind in "fc" and actual_rows.dtype.kind in "fc":
+            differ &= ~(np.isnan(expected_rows) & np.isnan(actual_rows))
+        if not differ.any():
+            continue
+        for axis in range(differ.ndim):
+            axis_counts = differ.sum(axis=tuple(other for other in range(differ.ndim) if other != axis))
+            if axis == 0:
+                counts[0][start:start + len(axis_counts)] += axis_counts
+            else:
+                counts[axis] += axis_counts
+        if first is None:
+            first = np.unravel_index(np.flatnonzero(differ)[0], differ.shape)
+            first = (first[0] + start,) + tuple(first[1:])
+    if first is None:
+        return result
+    result['equal'] = False
+    result['differing'] = int(counts[0].sum())
+    result['first'] = [int(index) for index in first]
+    result['expected'] = expected[first].item()
+    result['actual'] = actual[first].item()
+    result['axes'] = []
+    for axis_counts in counts:
+        indices = np.flatnonzero(axis_counts)
+        result['axes'].append(collections.OrderedDict([
+            ('count', len(indices)), ('indices', [[int(index), int(axis_counts[index])] for index in indices[:limit]])]))
+    return result
+
+def format_diff(name, diff):
+    ''' Return lines describing the result of diff_arrays for the array name.'''
+    if diff['equal']:
+        return ["%s: equal" % name]
+    if diff['shape'][0] != diff['shape'][1]:
+        return ["%s: shape %s, expected %s" % (name, tuple(diff['shape'][1]), tuple(diff['shape'][0]))]
+    lines = []
+    if diff['dtype'][0] != diff['dtype'][1]:
+        lines.append("%s: dtype %s, expected %s" % (name, diff['dtype'][1], diff['dtype'][0]))
+    if 'first' in diff:
+        lines.append("%s: %d elements differ, first at %s: expected %s, actual %s" % (
+            name, diff['differing'], tuple(diff['first']), diff['expected'], diff['actual']))
+        for axis, summary in enumerate(diff['axes']):
+            lines.append("    axis %d: %d indices differ (%s%s)" % (
+                axis, summary['count'], ", ".join("%d: %d" % tuple(pair) for pair in summary['indices']),
+                ", ..." if summary['count'] > len(summary['indices']) else ""))
+    return lines
+
+def diff_months(expected_savedirs, actual_savedirs, dates, save_format="npz"):
+    ''' Compare the months saved in expected_savedirs and actual_savedirs
+        (see main.get_resolution_savedirs), the actual ones saved in
+        save_format. Returns a list of an OrderedDict for each month and
+        resolution, of the 'year', 'month', 'resolution' ("WxHnN"),
+        whether every array is 'equal', and the 'arrays', the result of
+        diff_arrays for each (or 'missing' for a file or array that wasn't
+        saved).'''
+    months = []
+    for (year, month) in dates:
+        for resolution, expected_savedir in expected_savedirs.items():
+            result = collections.OrderedDict([('year', year), ('month', month),
+                                              ('resolution', "%dx%dn%d" % resolution), ('equal', True),
+                                              ('arrays', collections.OrderedDict())])
+            expected = main.load_arrays(main.get_save_filename(year=year, month=month, savedir=expected_savedir))
+            actual_filename = main.get_save_filename(year=year, month=month, savedir=actual_savedirs[resolution],
+                                                     save_format=save_format)
+            actual = main.load_arrays(actual_filename) if os.path.exists(actual_filename) else {}
+            for key in sorted(expected):
+                result['arrays'][key] = diff_arrays(expected[key], actual[key]) if key in actual else 'missing'
+                if result['arrays'][key] == 'missing' or not result['arrays'][key]['equal']:
+                    result['equal'] = False
+            months.append(result)
+    return months
+
+def make_datadir(workdir, dates, datadir=None, lines=None, example=False, synthetic=None, seed=0):
+    ''' Make the months to compare on in workdir, and return the datadir to
+        read them from: datadir itself, or with lines, the first lines of
+        each of its months, or example.csv as each month, or with
+        synthetic, that many lines of made-up trips in each month (see
+        benchmark.write_month).'''
+    if synthetic is None and not example and lines is None:
+        return datadir
+    datadir_out = os.path.join(workdir, "data")
+    for ii, (year, month) in enumerate(dates):
+        filename = main.get_load_filename(year=year, month=month, datadir=datadir_out)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if synthetic is not None:
+            benchmark.write_month(year=year, month=month, lines=synthetic, datadir=datadir_out, seed=seed + ii)
+        elif example:
+            shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), "example.csv"), filename)
+        else:
+            source = readers.read_lines(main.get_load_filename(year=year, month=month, datadir=datadir))
+            with contextlib.closing(source), open(filename, "w") as write_f:
+                for _, line in zip(range(lines + 1), source): # (And the header)
+                    write_f.write(line)
+    return datadir_out
+
+def check(dates, datadir="../decompressed", resolutions=((10, 20, 4),), candidates=tuple(CANDIDATES),
+          batchsize=100000, workdir=None, lines=None, example=False, synthetic=None, seed=0, V=False):
+    ''' Process the months with the original per-line path and with each
+        candidate (see CANDIDATES), and compare what they save.
+
+    # Arguments:
+        dates: List of (year, month) to process.
+        datadir: The directory holding the months. (See main.process)
+        resolutions: List of (width, height, n) to process at.
+        candidates: Names of the candidates to compare.
+        batchsize: Lines per batch for the "batch" engine.
+        workdir: Directory to save the runs in (in a temporary directory,
+            removed afterwards). Default: the system's temporary directory.
+        lines, example, synthetic, seed: What to compare on instead of the
+            months in datadir. (See make_datadir)
+        V: Boolean; if True, print main.process's output, and each
+            candidate's result as it is done.
+    # Returns:
+        An OrderedDict, to be saved as JSON: whether every candidate is
+        'equal', and the 'candidates', with whether each is 'equal', and
+        its 'months'. (See diff_months)
+    '''
+    resolutions = [tuple(resolution) for resolution in resolutions]
+    tempdir = tempfile.mkdtemp(prefix="tmp-golden-", dir=workdir)
+    try:
+        datadir = make_datadir(tempdir, dates, datadir=datadir, lines=lines, example=example,
+                               synthetic=synthetic, seed=seed)
+        def run(name, **kwargs):
+            # Save the months with main.process into their own directory
+            savedir = os.path.join(tempdir, name)
+            os.makedirs(savedir)
+            (year, month), (endyear, endmonth) = dates[0], dates[-1]
+            with contextlib.ExitStack() as stack:
+                if not V:
+                    stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                main.process(startyear=year, startmonth=month, endyear=endyear, endmonth=endmonth,
+                             resolutions=resolutions, batchsize=batchsize, datadir=datadir, savedir=savedir, **kwargs)
+            return main.get_resolution_savedirs(resolutions, savedir=savedir)
+        expected_savedirs = run("reference", engine="line")
+        report = collections.OrderedDict([('equal', True), ('candidates', collections.OrderedDict())])
+        for name in candidates:
+            kwargs = dict(CANDIDATES[name])
+            if name == "cache":
+                kwargs['cachedir'] = os.path.join(tempdir, "tripcache")
+                for (year, month) in dates:
+                    tripcache.ingest_month(main.get_load_filename(year=year, month=month, datadir=datadir),
+                                           tripcache.get_month_cachedir(year=year, month=month,
+                                                                        cachedir=kwargs['cachedir']),
+                                           batchsize=batchsize)
+            months = diff_months(expected_savedirs, run(name, **kwargs), dates,
+                                 save_format=kwargs.get('save_format', "npz"))
+            result = collections.OrderedDict([('equal', all(month['equal'] for month in months)), ('months', months)])
+            report['candidates'][name] = result
+            report['equal'] = report['equal'] and result['equal']
+            if V:
+                print("\n".join(format_report(collections.OrderedDict([('candidates', {name : result})]))))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+    return report
+
+def format_report(report):
+    ''' Return lines describing the result of check.'''
+    lines = []
+    for name, result in report['candidates'].items():
+        lines.append("%s: %s" % (name, "equal" if result['equal'] else "DIFFERS"))
+        for month in result['months']:
+            if month['equal']:
+                continue
+            prefix = "  %d-%02d %s " % (month['year'], month['month'], month['resolution'])
+            for key, diff in month['arrays'].items():
+                if diff != 'missing' and diff['equal']:
+                    continue
+                for line in (["%s: missing" % key] if diff == 'missing' else format_diff(key, diff)):
+                    lines.append(" " * len(prefix) + line if line.startswith(" ") else prefix + line)
+    return lines
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare what faster ways of processing save against the per-line path")
+    parser.add_argument("--startyear", "-sy",
+                        help="Year to start comparing from. Default 2010",
+                        type=int, nargs=1)
+    parser.add_argument("--startmonth", "-sm",
+                        help="Month to start comparing from. Default 1.",
+                        type=int, nargs=1)
+    parser.add_argument("--endyear", "-ey",
+                        help="Year to finish comparing (inclusive). Default: --startyear.",
+                        type=int, nargs=1)
+    parser.add_argument("--endmonth", "-em",
+                        help="Month to finish comparing (inclusive). Default: --startmonth.",
+                        type=int, nargs=1)
+    parser.add_argument("--resolutions", "-R",
+                        help="The grid configurations to compare at, each as WIDTHxHEIGHTnN. (Default 10x20n4)",
+                        type=main.parse_resolution, nargs="+")
+    parser.add_argument("--candidates", "-C",
+                        help="The candidates to compare against the per-line path. (Default all)",
+                        choices=list(CANDIDATES), nargs="+")
+    parser.add_argument("--datadir", "-d",
+                        help="Directory holding the FOIL201* directories of .csv files (or .csv.gz or .csv.zip files), or FOIL201*.zip archives of them. (Default ../decompressed)",
+                        type=str, nargs=1)
+    parser.add_argument("--lines", "-l",
+                        help="Only compare on the first this many lines of each month.",
+                        type=int, nargs=1)
+    parser.add_argument("--example", "-x",
+                        help="Compare on example.csv, as each month, instead of --datadir.",
+                        action="store_true")
+    parser.add_argument("--synthetic", "-s",
+                        help="Compare on this many lines of made-up trips in each month (see benchmark.py), instead of --datadir.",
+                        type=int, nargs=1)
+    parser.add_argument("--seed",
+                        help="Seed of the made-up trips. (Default 0)",
+                        type=int, nargs=1)
+    parser.add_argument("--batchsize", "-b",
+                        help="Number of lines per batch for the batch engine. (Default 100000)",
+                        type=int, nargs=1)
+    parser.add_argument("--workdir", "-w",
+                        help="Directory to save the runs in. (Default: the system's temporary directory)",
+                        type=str, nargs=1)
+    parser.add_argument("--output", "-o",
+                        help="JSON file to save the report to.",
+                        type=str, nargs=1)
+    parser.add_argument("--verbose", "-v",
+                        help="",
+                        action="store_true")
+    args = parser.parse_args()
+
+    if args.example and args.synthetic is not None:
+        parser.error("--example and --synthetic can't be used together")
+
+    startyear   = 2010 if args.startyear  is None else args.startyear[0]
+    startmonth  = 1    if args.startmonth is None else args.startmonth[0]
+    endyear     = startyear  if args.endyear  is None else args.endyear[0]
+    endmonth    = startmonth if args.endmonth is None else args.endmonth[0]
+    report = check(dates       = utils.generate_dates(startyear, startmonth, endyear, endmonth),
+                   datadir     = "../decompressed" if args.datadir is None else args.datadir[0],
+                   resolutions = [(10, 20, 4)] if args.resolutions is None else args.resolutions,
+                   candidates  = list(CANDIDATES) if args.candidates is None else args.candidates,
+                   batchsize   = 100000 if args.batchsize is None else args.batchsize[0],
+                   workdir     = None   if args.workdir   is None else args.workdir[0],
+                   lines       = None   if args.lines     is None else args.lines[0],
+                   example     = args.example,
+                   synthetic   = None   if args.synthetic is None else args.synthetic[0],
+                   seed        = 0      if args.seed      is None else args.seed[0],
+                   V           = args.verbose)
+    if not args.verbose:
+        print("\n".join(format_report(report)))
+    if args.output is not None:
+        with open(args.output[0], "w") as write_f:
+            json.dump(report, write_f, indent=1)
+        print("Saved", args.output[0])
+    sys.exit(0 if report['equal'] else 1)
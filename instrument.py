@@ -0,0 +1,180 @@
+''' Opt-in instrumentation of main.process (see main.py --report).
+
+A MonthStats adds up the time spent in each stage of processing a month,
+and how many items went through it:
+
+    read:       Reading (and decompressing) lines from the .csv. (lines)
+    parse:      Splitting lines and parsing their fields. (lines) With the
+                "line" engine this includes project, as process_entry does both.
+    project:    Mapping GPS coordinates to the grid, and l2 distances. (lines)
+    validate:   utils.check_valid_entries. (entries)
+    accumulate: Adding the valid trips into the arrays. (trips)
+    save:       Compressing and writing the month's files. (bytes written)
+
+With several resolutions, the time of every resolution is counted, but the
+items only once: counts are the same however many resolutions there are.
+
+Time that isn't in any of them (e.g. lines the batch functions can't
+handle, finishing derived resolutions) is reported as 'other'. With
+--pipeline, parse and project run in the worker processes, and aren't
+counted here.
+
+Each month's report (see MonthStats.report) is a line of JSON appended to
+process-report.jsonl in the save directory. profiling runs a profiler over
+a single month.
+'''
+
+import os
+import sys
+import time
+import json
+import shlex
+import signal
+import cProfile
+import resource
+import datetime
+import subprocess
+import contextlib
+import collections
+
+STAGES = ("read", "parse", "project", "validate", "accumulate", "save")
+
+def peak_rss():
+    ''' Return the peak resident set size of this process so far, in bytes.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class MonthStats:
+    ''' The time and counts of each stage (see STAGES) of processing a month.
+
+    # Arguments:
+        year, month: The month being processed.
+        total_bytes: Optional size of the .csv (or of the part of it) being
+            read, to estimate the time left from. (See readers.source_size)
+    '''
+    def __init__(self, year, month, total_bytes=None):
+        self.year = year
+        self.month = month
+        self.total_bytes = total_bytes
+        self.seconds = collections.OrderedDict((stage, 0.0) for stage in STAGES)
+        self.counts = collections.OrderedDict((stage, 0) for stage in STAGES)
+        self.lines = 0
+        self.bytes = 0 # Read so far (counted as characters, the same for the ASCII .csv files)
+        self.saved = collections.OrderedDict() # Filename : bytes
+        self.start = time.time()
+
+    def add(self, stage, seconds, count=0):
+        ''' Add seconds and count to stage.'''
+        self.seconds[stage] += seconds
+        self.counts[stage] += count
+
+    def timed(self, function, stage):
+        ''' Return function, counting the time spent in each call, and the
+            call, as stage.'''
+        def timed_function(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.time() - start
+                self.counts[stage] += 1
+        return timed_function
+
+    def read(self, lines):
+        ''' Yield the lines, counting the time spent getting each as read.'''
+        lines = iter(lines)
+        while True:
+            start = time.time()
+            line = next(lines, None)
+            self.seconds['read'] += time.time() - start
+            if line is None:
+                return
+            self.counts['read'] += 1
+            self.lines += 1
+            self.bytes += len(line)
+            yield line
+
+    def progress(self):
+        ''' Return a line on the lines and bytes read so far, their rates,
+            and (given total_bytes) the estimated time left.'''
+        seconds = max(time.time() - self.start, 1e-9)
+        line = "    Line %d, %.0f lines/s, %.1f MB/s" % (self.lines, self.lines / seconds, self.bytes / seconds / 2**20)
+        if self.total_bytes and self.bytes:
+            left = max(self.total_bytes - self.bytes, 0) * seconds / self.bytes
+            line += ", %.0f%%, ETA %s" % (100.0 * min(self.bytes / self.total_bytes, 1),
+                                          datetime.timedelta(seconds=int(left)))
+        return line
+
+    def report(self):
+        ''' Return a dict of the month's stats, to save as JSON: the lines and
+            bytes read, the seconds since it started, lines_per_sec and
+            bytes_per_sec, the seconds and count of each stage (and 'other'
+            seconds), the files saved and their sizes, and the peak RSS of
+            the process.'''
+        seconds = time.time() - self.start
+        stages = collections.OrderedDict((stage, {'seconds' : self.seconds[stage], 'count' : self.counts[stage]})
+                                         for stage in STAGES)
+        stages['other'] = {'seconds' : max(seconds - sum(self.seconds.values()), 0.0), 'count' : 0}
+        return collections.OrderedDict([
+            ('year', self.year), ('month', self.month), ('lines', self.lines), ('bytes', self.bytes),
+            ('total_bytes', self.total_bytes), ('seconds', seconds),
+            ('lines_per_sec', self.lines / seconds if seconds > 0 else None),
+            ('bytes_per_sec', self.bytes / seconds if seconds > 0 else None),
+            ('stages', stages), ('saved', self.saved), ('peak_rss', peak_rss())])
+
+class _Uncounted:
+    # Adds the time of stages to the MonthStats stats, but not their counts
+    def __init__(self, stats):
+        self.stats = stats
+    
+    def add(self, stage, seconds, count=0):
+        self.stats.add(stage, seconds)
+
+def uncounted(stats):
+    ''' Return stats, for work whose time counts towards its stages, but
+        whose items were already counted (e.g. the same entries accumulated
+        again at another resolution), or None if stats is None.'''
+    return None if stats is None else _Uncounted(stats)
+
+@contextlib.contextmanager
+def timing(stats, stage, count=0):
+    ''' Count the time spent in the with block, and count, as stage of the
+        MonthStats stats. Does nothing if stats is None.'''
+    if stats is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        stats.add(stage, time.time() - start, count)
+
+def write_report(filename, report):
+    ''' Append report (a dict, see MonthStats.report) to filename, as a line of JSON.'''
+    with open(filename, "a") as write_f:
+        write_f.write(json.dumps(report) + "\n")
+
+@contextlib.contextmanager
+def profiling(filename, command=None):
+    ''' Profile the with block. Without a command, with cProfile, saving its
+        stats to filename + ".prof" (see the pstats module). With a command,
+        by running it in the background, with {pid} (this process) and
+        {output} (filename) filled in, e.g. for a sampling profiler:
+        "py-spy record --pid {pid} -o {output}.svg". It's stopped with
+        SIGINT after the block.'''
+    if command is None:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(filename + ".prof")
+        return
+    process = subprocess.Popen(shlex.split(command.format(pid=os.getpid(), output=filename)))
+    try:
+        yield
+    finally:
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+        process.wait()
@@ -1,7 +1,24 @@
+import os
+import re
+import json
+import shutil
 import datetime
 import argparse
+import tempfile
+import contextlib
+import concurrent.futures
 import utils
+import sparseutils
+import readers
+import tripcache
+import slabarray
+import pipeline
+import instrument
+import errorsink
 import numpy as np
+# (get_stdn_filename isn't used here, but is kept importable from main for compatibility)
+from savefiles import (get_load_filename, get_resolution_savedirs, get_save_filename, get_checkpoint_filename,
+                       get_stdn_filename, save_arrays, load_arrays, save_stdn, parse_resolution)
 
 def print_time():
     ''' Print the current time. '''
@@ -14,6 +31,532 @@ def get_next(year, month):
     else:
         return (year, month + 1)
 
+def process_lines( lines,
+                   year,
+                   month,
+                   vdata,
+                   fdata,
+                   vdata_next_mo,
+                   fdata_next_mo,
+                   trips,
+                   width     = 10,
+                   height    = 20,
+                   n         = 4,
+                   V         = False,
+                   engine    = "line",
+                   batchsize = 100000,
+                   unparsable_lines = None,
+                   sink      = None ):
+    ''' Processes the trips in lines into the given numpy arrays.
+    
+    Returns (invalid_count, unparsable_count, line_number):
+        the number of entries that are parsable but are not a valid trip,
+        the number of entries that raise an error on parsing,
+        and the number of lines read.
+    
+    # Arguments:
+        lines: Iterable of lines from a trip_data_*.csv, without the header.
+        year, month: The year and month being processed.
+        vdata, ..., trips: Numpy arrays to update. (See utils.update_data)
+        width, height, n: Grid resolution and number of time slots per hour.
+        V: Boolean; if True, print extra information to console.
+        engine: "line" to process the file one line at a time, or
+            "batch" to process batches of lines at once with numpy.
+            (Both give the same results; "batch" is much faster.)
+        batchsize: Number of lines per batch, for the "batch" engine.
+        unparsable_lines: Optional list. If given, the line numbers of
+            unparsable lines are appended to it instead of being printed.
+        sink: Optional errorsink.ErrorSink. If given, the unparsable and
+            invalid lines are added to it, by reason, instead of being
+            printed.
+    '''
+    resolution = (width, height, n)
+    targets = {resolution : dict(vdata=vdata, fdata=fdata, vdata_next_mo=vdata_next_mo,
+                                 fdata_next_mo=fdata_next_mo, trips=trips)}
+    errors, line_number = process_lines_resolutions(lines            = lines,
+                                                    year             = year,
+                                                    month            = month,
+                                                    targets          = targets,
+                                                    plan             = {resolution : None},
+                                                    V                = V,
+                                                    engine           = engine,
+                                                    batchsize        = batchsize,
+                                                    unparsable_lines = unparsable_lines,
+                                                    sink             = sink)
+    invalid_count, unparsable_count = errors[resolution]
+    return invalid_count, unparsable_count, line_number
+
+def process_lines_resolutions( lines,
+                               year,
+                               month,
+                               targets,
+                               plan,
+                               V         = False,
+                               engine    = "line",
+                               batchsize = 100000,
+                               unparsable_lines = None,
+                               pipe      = None,
+                               stats     = None,
+                               sink      = None ):
+    ''' Processes the trips in lines into the arrays of several resolutions
+        at once. (See process_lines)
+    
+    Returns (errors, line_number): errors maps each resolution to
+        (invalid_count, unparsable_count), and line_number is the number
+        of lines read. Lines that are unparsable at any resolution are
+        reported (printed, or appended to unparsable_lines, or added to
+        sink). Invalid lines are added to sink once, not per resolution.
+    
+    # Arguments:
+        targets: Dict mapping each resolution (width, height, n) to a dict
+            of its 'vdata', 'fdata', 'vdata_next_mo', 'fdata_next_mo' and
+            'trips' arrays.
+        plan: Dict from utils.plan_resolutions. With the "batch" engine,
+            derived resolutions need utils.finish_resolutions afterwards.
+            The "line" engine accumulates every resolution, and ignores it.
+        pipe: Optional pipeline.Pipeline, to read and parse the lines in
+            the background with the "batch" engine.
+        stats: Optional instrument.MonthStats, to count the time spent in
+            each stage in. With V, progress is printed from it.
+        (See process_lines for the rest.)
+    '''
+    def report_unparsable(line_number, line):
+        if sink is not None:
+            sink.add(utils.unparsable_reason(line), line_number, line)
+        if unparsable_lines is not None:
+            unparsable_lines.append(line_number)
+        elif sink is None:
+            print("  ERROR - could not parse line", line_number)
+    
+    invalid_count = {resolution : 0 for resolution in targets}    # Entries that are parsable, but are not a valid trip
+    unparsable_count = {resolution : 0 for resolution in targets} # Entries that raise an error on parsing
+    line_number = 0
+    if stats is not None:
+        lines = stats.read(lines)
+    
+    def print_progress(line_number):
+        print("    Line %d" % line_number if stats is None else stats.progress())
+    
+    if engine == "batch":
+        if pipe is None:
+            batches = ((batch, None) for batch in utils.read_batches(lines, batchsize=batchsize))
+        else:
+            batches = pipe.parse(lines, batchsize=batchsize)
+        for batch, entries in batches:
+            results = utils.process_batch_resolutions(
+                lines             = batch,
+                year              = year,
+                month             = month,
+                targets           = targets,
+                plan              = plan,
+                first_line_number = line_number + 1,
+                entries           = entries,
+                stats             = stats,
+                sink              = sink)
+            batch_unparsable_lines = set()
+            for resolution, (batch_invalid_count, resolution_unparsable_lines) in results.items():
+                invalid_count[resolution] += batch_invalid_count
+                unparsable_count[resolution] += len(resolution_unparsable_lines)
+                batch_unparsable_lines.update(resolution_unparsable_lines)
+            for unparsable_line in sorted(batch_unparsable_lines):
+                report_unparsable(unparsable_line, batch[unparsable_line - line_number - 1])
+            if V and ((line_number + len(batch)) // 1000000 > line_number // 1000000):
+                print_progress(line_number + len(batch))
+            line_number += len(batch)
+    else:
+        process_entry, check_valid, update_data = utils.process_entry, utils.check_valid, utils.update_data
+        if stats is not None:
+            process_entry = stats.timed(process_entry, "parse")
+            check_valid = stats.timed(check_valid, "validate")
+            update_data = stats.timed(update_data, "accumulate")
+        first_resolution = next(iter(targets))
+        for line in lines:
+            line_number += 1
+            if V and ((line_number % 1000000) == 0):
+                print_progress(line_number)
+            unparsable = False
+            for (width, height, n), arrays in targets.items():
+                try:
+                    # This is where the processing happens.
+                    entry = process_entry(line=line, n=n)
+                    if check_valid(entry=entry, year=year, month=month):
+                        update_data(entry=entry,
+                                    w=width,
+                                    h=height,
+                                    n=n,
+                                    **arrays)
+                    else:
+                        invalid_count[(width, height, n)] += 1
+                        if sink is not None and (width, height, n) == first_resolution:
+                            sink.add(utils.invalid_reason(entry, year=year, month=month), line_number, line)
+                except:
+                    unparsable_count[(width, height, n)] += 1
+                    unparsable = True
+            if unparsable:
+                report_unparsable(line_number, line)
+    
+    errors = {resolution : (invalid_count[resolution], unparsable_count[resolution]) for resolution in targets}
+    return errors, line_number
+
+def process_csv(load_filename, byte_range=None, **kwargs):
+    ''' Processes the lines of the .csv at load_filename (or just the
+        lines in byte_range; see readers.split_byte_ranges) with
+        process_lines_resolutions, which kwargs are passed on to.
+        Returns the same.'''
+    with contextlib.ExitStack() as stack:
+        if byte_range is None:
+            # (Decompressed in the background, if need be; see readers.read_lines)
+            lines = stack.enter_context(contextlib.closing(readers.read_lines(load_filename)))
+            header = next(lines, None) # Skip header
+            if kwargs.get('stats') is not None and header is not None:
+                kwargs['stats'].bytes += len(header)
+        else:
+            lines = readers.read_byte_range(load_filename, *byte_range)
+        return process_lines_resolutions(lines=lines, **kwargs)
+
+def parse_month(string):
+    ''' Parse a month given as "YEAR-MONTH" (e.g. "2012-03") into a
+        (year, month) tuple.'''
+    match = re.fullmatch(r"(\d{4})-(\d{1,2})", string)
+    if match is None or not 1 <= int(match.group(2)) <= 12:
+        raise argparse.ArgumentTypeError("month should look like 2012-03, not " + repr(string))
+    return int(match.group(1)), int(match.group(2))
+
+def save_checkpoint(year, month, spill, savedir="."):
+    ''' Save the dict of spill arrays (see add_spill) carried on past the
+        given (year, month) as its checkpoint, atomically: the file appears
+        whole, or not at all. Returns the filename.'''
+    filename = get_checkpoint_filename(year=year, month=month, savedir=savedir)
+    temp_filename = filename[:-len(".npz")] + ".tmp.npz"
+    save_arrays(temp_filename, spill)
+    os.replace(temp_filename, filename)
+    return filename
+
+def has_checkpoint(year, month, savedirs):
+    ''' Return True if the given (year, month) has a checkpoint in each
+        of the directories in the dict savedirs (see get_resolution_savedirs).'''
+    return all(os.path.exists(get_checkpoint_filename(year=year, month=month, savedir=savedir))
+               for savedir in savedirs.values())
+
+def get_byte_ranges(year, month, splits, datadir="../decompressed", cachedir=None):
+    ''' Split the .csv of the given (year, month) into splits ranges of
+        lines (see readers.split_byte_ranges), or return [None] if it has
+        an up to date cache (see tripcache.py) or is read from a compressed
+        file: those months are processed whole.'''
+    load_filename = get_load_filename(year=year, month=month, datadir=datadir)
+    if cachedir is not None and tripcache.has_cache(
+            tripcache.get_month_cachedir(year=year, month=month, cachedir=cachedir), load_filename):
+        return [None]
+    if readers.is_compressed(load_filename):
+        return [None]
+    return readers.split_byte_ranges(load_filename, splits)
+
+def process_month( year,
+                   month,
+                   width      = 10,
+                   height     = 20,
+                   n          = 4,
+                   **kwargs ):
+    ''' Processes the data from a single month, independently of the others.
+    
+    Returns (data, spill, line_number), two dicts of numpy arrays and an int:
+        data: 'vdata', 'fdata', 'trips' and 'errors' for this month,
+            not counting trips from the previous month that end in this one.
+        spill: 'vdata' and 'fdata' sparseutils.SparseArrays for the trips
+            in this month that end in a later month, from the start of the
+            next month on. (See sparseutils.gen_empty_spill and add_spill)
+        line_number: The number of lines read.
+    
+    # Arguments:
+        year, month: The year and month to process.
+        width, height, n: The resolution to process at.
+        (See process_month_resolutions for the rest.)
+    '''
+    resolution = (width, height, n)
+    data, spill, line_number = process_month_resolutions(year=year, month=month, resolutions=[resolution], **kwargs)
+    return data[resolution], spill[resolution], line_number
+
+def process_month_resolutions( year,
+                               month,
+                               resolutions,
+                               V          = False,
+                               engine     = "line",
+                               batchsize  = 100000,
+                               sparse     = False,
+                               datadir    = "../decompressed",
+                               cachedir   = None,
+                               byte_range = None,
+                               unparsable_lines = None,
+                               streamdir  = None,
+                               pipe       = None,
+                               stats      = None,
+                               sink       = None ):
+    ''' Processes the data from a single month at several resolutions, in
+        one pass over the data. (See process_month)
+    
+    Returns (data, spill, line_number): data and spill map each resolution
+        to its data and spill dicts, as returned by process_month.
+    
+    # Arguments:
+        year, month: The year and month to process.
+        resolutions: List of (width, height, n) tuples. With the "batch"
+            engine, resolutions that divide another one are derived from it
+            (see utils.plan_resolutions).
+        byte_range: Optional (start, end) byte offsets, to only process
+            that part of the month's .csv. (See readers.split_byte_ranges)
+            The data from each part of a month can be summed together.
+        unparsable_lines: Optional list. If given, line numbers of
+            unparsable lines (counted from the start of byte_range) are
+            appended to it, instead of being printed.
+        cachedir: Optional directory holding a cache of the .csv files.
+            (See tripcache.py) If the month has an up to date cache, and
+            no byte_range is given, the month is processed from the cache.
+        streamdir: Optional directory. If given, vdata and fdata are
+            accumulated a few hours at a time and written out to .npy files
+            in it as they are finished (see slabarray.py), and returned as
+            memory maps of them. Needs the "batch" engine. The caller
+            removes the files (see slabarray.remove_files).
+        pipe: Optional pipeline.Pipeline, to read and parse the .csv in the
+            background. (See process_lines_resolutions)
+        stats: Optional instrument.MonthStats, to count the time spent in
+            each stage of reading the .csv in. (Not from a cache)
+        sink: Optional errorsink.ErrorSink, to add the unparsable and invalid
+            lines to, by reason, instead of printing them.
+        (See process for the rest.)
+    '''
+    if streamdir is not None and (engine != "batch" or sparse):
+        raise ValueError("Streaming to disk needs the batch engine, and dense fdata.")
+    gen_empty_fdata = sparseutils.gen_empty_sparse_fdata if sparse else utils.gen_empty_fdata
+    
+    resolutions = list(dict.fromkeys(tuple(resolution) for resolution in resolutions))
+    if engine == "batch" and streamdir is None:
+        plan = utils.plan_resolutions(resolutions)
+    else:
+        # (Streamed arrays are written out before they could be coarsened)
+        plan = {resolution : None for resolution in resolutions}
+    
+    targets = {}
+    for (width, height, n) in resolutions:
+        # 'next-month' arrays, sparse: only a few trips cross the boundary
+        #   (E.g. 2-28 at 11:59 to 3:01 at 0:02)
+        spill = sparseutils.gen_empty_spill(w=width, h=height, n=n)
+        targets[(width, height, n)] = {
+            'trips' : np.zeros((2, 2, 2)), # Statistical info about the trips this month. (See README)
+            'vdata' : utils.gen_empty_vdata(year=year, month=month, w=width, h=height, n=n),
+            'fdata' : gen_empty_fdata(year=year, month=month, w=width, h=height, n=n),
+            'vdata_next_mo' : spill['vdata'],
+            'fdata_next_mo' : spill['fdata']}
+        if streamdir is not None:
+            # Only the last few hours are in memory
+            arrays = targets[(width, height, n)]
+            for key, axis in (('vdata', 0), ('fdata', 1)):
+                handle, filename = tempfile.mkstemp(suffix=".npy", dir=streamdir)
+                os.close(handle)
+                arrays[key] = slabarray.SlabArray(filename, arrays[key].shape, dtype=arrays[key].dtype, axis=axis,
+                                                  slabslots=n, maxslabs=12, lag=3*n)
+    
+    load_filename = get_load_filename(year=year, month=month, datadir=datadir)
+    
+    if V:
+        print("Starting on",year,month, "" if byte_range is None else "bytes %d to %d" % byte_range)
+        print_time()
+    
+    month_cachedir = None if cachedir is None else tripcache.get_month_cachedir(year=year, month=month, cachedir=cachedir)
+    if byte_range is None and month_cachedir is not None and tripcache.has_cache(month_cachedir, load_filename):
+        if V:
+            print("    Using cache", month_cachedir)
+        results, line_number = tripcache.process_cached(
+            month_cachedir = month_cachedir,
+            year           = year,
+            month          = month,
+            targets        = targets,
+            plan           = plan,
+            batchsize      = batchsize,
+            sink           = sink)
+        errors = {}
+        cached_unparsable_lines = set()
+        for resolution, (invalid_count, resolution_unparsable_lines) in results.items():
+            errors[resolution] = (invalid_count, len(resolution_unparsable_lines))
+            cached_unparsable_lines.update(resolution_unparsable_lines)
+        if unparsable_lines is not None:
+            unparsable_lines += sorted(cached_unparsable_lines)
+        elif sink is None:
+            for unparsable_line in sorted(cached_unparsable_lines):
+                print("  ERROR - could not parse line", unparsable_line)
+    else:
+        errors, line_number = process_csv(
+            load_filename = load_filename,
+            byte_range    = byte_range,
+            year          = year,
+            month         = month,
+            targets       = targets,
+            plan          = plan,
+            V             = V,
+            engine        = engine,
+            batchsize     = batchsize,
+            unparsable_lines = unparsable_lines,
+            pipe          = pipe,
+            stats         = stats,
+            sink          = sink)
+    utils.finish_resolutions(targets, plan)
+    for arrays in targets.values():
+        for key, array in arrays.items():
+            if isinstance(array, slabarray.SlabArray):
+                arrays[key] = array.finish()
+    
+    if unparsable_lines is None:
+        print("    Line", line_number)
+    
+    data = {}
+    spill = {}
+    for resolution, arrays in targets.items():
+        data[resolution] = {'vdata'  : arrays['vdata'],
+                            'fdata'  : arrays['fdata'],
+                            'trips'  : arrays['trips'],
+                            'errors' : np.array(errors[resolution])}
+        spill[resolution] = {'vdata' : arrays['vdata_next_mo'],
+                             'fdata' : arrays['fdata_next_mo']}
+    return data, spill, line_number
+
+def add_arrays(data, other):
+    ''' Add each array in the dict other into the array with the same key
+        in the dict data, in place. Returns nothing. Used to add the spill
+        from the previous month (see process_month) into a month's data,
+        or to sum the data from parts of a month.'''
+    for key, array in other.items():
+        if isinstance(data[key], sparseutils.SparseArray):
+            data[key].add(array)
+        elif isinstance(array, sparseutils.SparseArray):
+            utils.add_array(data[key], array)
+        else:
+            data[key] += array
+
+def add_spill(data, spill, offset=0):
+    ''' Add the spill of an earlier month (see process_month) into the dict
+        data, in place: its time slots from offset on, for as many slots as
+        the arrays in data have. offset is the number of slots from the
+        start of the month after the spill's month to the start of data's
+        (0 for the next month's data, or the number of slots in the next
+        month to carry the rest of the spill into the next month's spill).
+        Returns nothing.'''
+    for key, array in spill.items():
+        axis = 1 if key == "fdata" else 0 # (The time slot axis)
+        add_arrays(data, {key : array.select_range(offset, offset + data[key].shape[axis], axis=axis)})
+
+def get_stdn_arrays(data):
+    ''' Return (vdata, fdata) with only the trip counts, vdata[..., 1] and
+        fdata[..., 1], from the dict of arrays (fdata dense or sparse).'''
+    fdata = data['fdata']
+    if isinstance(fdata, sparseutils.SparseArray):
+        fdata = fdata.select_last(1).todense()
+    else:
+        fdata = fdata[..., 1]
+    return data['vdata'][..., 1], fdata
+
+def save_month(year, month, data, savedir=".", save_format="npz", n=4, stdn=False):
+    ''' Save the processed dict of arrays of the given (year, month) to
+        savedir, as its (year)-(month)-data file, or, if stdn, as its
+        STDN-volume and STDN-flow files (trip counts only; see save_stdn).
+        Returns the filenames, as a string.'''
+    # (Chunked files hold one day of slots per chunk; see slotreader.py)
+    if stdn:
+        vdata, fdata = get_stdn_arrays(data)
+        return " and ".join(save_stdn(year=year, month=month, vdata=vdata, fdata=fdata, savedir=savedir,
+                                      save_format=save_format, chunkslots=24*n))
+    save_filename = get_save_filename(year=year, month=month, savedir=savedir, save_format=save_format)
+    save_arrays(save_filename, data, chunkslots=24*n)
+    return save_filename
+
+def _get_part_filenames(year, month, part, resolution, tempdir):
+    # The data and spill files of part of a month, at a resolution
+    prefix = os.path.join(tempdir, "%d-%02d-%d-%dx%dn%d" % ((year, month, part) + tuple(resolution)))
+    return prefix + "-data.npz", prefix + "-spill.npz"
+
+def _process_part_to_files(year, month, part, tempdir, error_samples=10, **kwargs):
+    # Worker for the parallel runner: process part of a month, then save its
+    #   data and spill at each resolution as uncompressed files in tempdir
+    #   for the merge step. Returns the report of its errors. (See errorsink.py)
+    sink = errorsink.ErrorSink(samplesize=error_samples)
+    data, spill, line_number = process_month_resolutions(year=year, month=month, unparsable_lines=[],
+                                                         sink=sink, **kwargs)
+    filenames = {}
+    for resolution in data:
+        filenames[resolution] = _get_part_filenames(year, month, part, resolution, tempdir)
+        save_arrays(filenames[resolution][0], data[resolution], compressed=False)
+        save_arrays(filenames[resolution][1], spill[resolution], compressed=False)
+    return filenames, line_number, sink.report()
+
+def process_month_parts(year, month, partsdir, splits, sink=None, error_samples=10, **kwargs):
+    ''' Processes a month as process_month_resolutions does, but in splits
+        ranges of lines, one after the other. The data and spill of each
+        range are saved to partsdir as it is done, so if the run stops,
+        running this again only processes the ranges that aren't saved.
+        The errors of each range (see errorsink.py) are added to sink, or
+        printed without one.
+        Returns (data, spill, line_number), as process_month_resolutions.'''
+    os.makedirs(partsdir, exist_ok=True)
+    resolutions = list(dict.fromkeys(tuple(resolution) for resolution in kwargs['resolutions']))
+    sparse = kwargs.get('sparse', False)
+    byte_ranges = get_byte_ranges(year=year, month=month, splits=splits,
+                                  datadir=kwargs.get('datadir', "../decompressed"), cachedir=kwargs.get('cachedir'))
+    line_number = 0
+    for part, byte_range in enumerate(byte_ranges):
+        # (The part is saved once its marker is)
+        marker = os.path.join(partsdir, "%d-%02d-%d.json" % (year, month, part))
+        if not os.path.exists(marker):
+            _, part_lines, errors = _process_part_to_files(year=year, month=month, part=part, tempdir=partsdir,
+                                                           byte_range=byte_range, error_samples=error_samples,
+                                                           **kwargs)
+            with open(marker + ".tmp", "w") as write_f:
+                json.dump({'lines' : part_lines, 'errors' : errors}, write_f)
+            os.replace(marker + ".tmp", marker)
+        with open(marker, "r") as read_f:
+            counts = json.load(read_f)
+        part_sink = errorsink.ErrorSink.from_report(counts['errors'], samplesize=error_samples)
+        if sink is None:
+            print(part_sink.summary())
+        else:
+            sink.merge(part_sink, offset=line_number)
+        line_number += counts['lines']
+    print("    Line", line_number)
+    
+    data, spill = {}, {}
+    for resolution in resolutions:
+        filenames = [_get_part_filenames(year, month, part, resolution, partsdir) for part in range(len(byte_ranges))]
+        data[resolution] = load_arrays(filenames[0][0], sparse=sparse)
+        spill[resolution] = sparseutils.gen_empty_spill(w=resolution[0], h=resolution[1], n=resolution[2])
+        for part, (data_filename, spill_filename) in enumerate(filenames):
+            if part > 0:
+                add_arrays(data[resolution], load_arrays(data_filename, sparse=sparse))
+            add_arrays(spill[resolution], load_arrays(spill_filename, sparse=True))
+    return data, spill, line_number
+
+def _merge_and_save(data_filenames, spills, year, month, sparse=False, spill_filenames=None, **save_kwargs):
+    # Worker for the parallel runner: sum the data from each part of a month
+    #   and the spills (filename, offset) from each part of the months
+    #   before it that reach it (see add_spill), and save it. (See save_month)
+    #   Removes the month's temporary data files. If the month's own
+    #   spill_filenames are given, also saves its checkpoint.
+    data = load_arrays(data_filenames[0], sparse=sparse)
+    for filename in data_filenames[1:]:
+        add_arrays(data, load_arrays(filename, sparse=sparse))
+    if spill_filenames is not None:
+        n = save_kwargs.get('n', 4)
+        carried = sparseutils.gen_empty_spill(w=data['vdata'].shape[1], h=data['vdata'].shape[2], n=n)
+        for filename in spill_filenames:
+            add_arrays(carried, load_arrays(filename, sparse=True))
+    for filename, offset in spills:
+        spill = load_arrays(filename, sparse=True)
+        add_spill(data, spill, offset=offset)
+        if spill_filenames is not None:
+            add_spill(carried, spill, offset=offset + data['vdata'].shape[0])
+    for filename in data_filenames:
+        os.remove(filename)
+    save_filename = save_month(year=year, month=month, data=data, **save_kwargs)
+    if spill_filenames is not None:
+        save_checkpoint(year=year, month=month, spill=carried, savedir=save_kwargs.get('savedir', "."))
+    return save_filename
+
 def process( startyear  = 2010,
              startmonth = 1,
              endyear    = 2013,
@@ -22,7 +565,25 @@ def process( startyear  = 2010,
              height     = 20,
              n          = 4,
              V          = False,
-             restart    = False ):
+             restart    = False,
+             engine     = "line",
+             batchsize  = 100000,
+             sparse     = False,
+             jobs       = 1,
+             splits     = 1,
+             datadir    = "../decompressed",
+             savedir    = ".",
+             cachedir   = None,
+             resolutions = None,
+             save_format = "npz",
+             stdn       = False,
+             stream     = False,
+             resume     = False,
+             pipeline_workers = None,
+             report     = False,
+             profile_month = None,
+             profiler   = None,
+             error_samples = 10 ):
     ''' Processes data from FOIL201*/trip_data_*.csv into compressed .npz files.
     
     Returns nothing. Processes month-by-month.
@@ -36,80 +597,353 @@ def process( startyear  = 2010,
         V: Boolean; if True, print extra information to console.
         restart: Boolean; if True, don't save the processed data for
             the first year, month.
+        engine: "line" or "batch". (See process_lines)
+        batchsize: Integer, lines per batch for the "batch" engine.
+        sparse: Boolean; if True, accumulate and save fdata as a
+            sparseutils.SparseArray instead of a dense array.
+            (Needs the "batch" engine.)
+        jobs: Integer, the number of months to process in parallel.
+            (With jobs > 1, each month is processed in its own process,
+            and each month's spill is added to the next month afterwards.
+            The saved arrays are the same either way.)
+        splits: Integer; with jobs > 1, split each month's .csv into this
+            many ranges of lines, processed in parallel and summed. (See
+            resume for jobs = 1.)
+        datadir: The directory holding the FOIL201* directories (of .csv
+            files, or .csv.gz or .csv.zip files), or FOIL201*.zip archives
+            of them. (See readers.find_source)
+        savedir: The directory to save the .npz files to.
+        cachedir: Optional directory holding a cache of the .csv files,
+            made with tripcache.py. Months with an up to date cache are
+            processed from it instead of from the .csv; the saved arrays
+            are the same either way.
+        resolutions: Optional list of (width, height, n) tuples, to process
+            at several resolutions in one pass instead of width, height, n.
+            Each resolution is saved in its own subdirectory of savedir.
+            (See get_resolution_savedirs) With the "batch" engine, coarser
+            resolutions are derived from finer ones by summing.
+        save_format: "npz" to save with np.savez_compressed, or "chunked"
+            to save .npzc files, compressed in parallel. (See chunkedio.py)
+        stdn: Boolean; if True, save only the trip counts, to
+            STDN-volume-(year)-(month) and STDN-flow-(year)-(month) files,
+            instead of the (year)-(month)-data files. (The same files
+            script_data_to_stdn.py makes from them; see save_stdn)
+        stream: Boolean; if True, write vdata and fdata to temporary .npy
+            files in savedir a few hours at a time as they are finished,
+            instead of holding a whole month in memory. (See slabarray.py)
+            Needs the "batch" engine and dense fdata, and jobs = 1.
+        resume: Boolean; if True, save a checkpoint next to each month
+            saved (see get_checkpoint_filename), and skip the months that
+            already have one, carrying on from their checkpoints. A run
+            that stopped part way can be run again with the same arguments
+            to pick up at the first month it didn't finish. With jobs = 1
+            and splits > 1, each month is also processed in splits ranges
+            of lines, saved as they are done, so a stopped month picks up
+            at the first range it didn't finish (see process_month_parts).
+            (Not with stream.)
+        pipeline_workers: Optional integer. If given, each month is read
+            ahead in a background thread, parsed in this many processes (0:
+            in this one), and saved in a background thread while the next
+            month is processed, and the time each stage spent blocked is
+            printed at the end. (See pipeline.py) Needs the "batch" engine,
+            and jobs = 1.
+        report: Boolean; if True, count the time spent in each stage of
+            processing each month, print progress from it with V, and append
+            a report on each month to process-report.jsonl in savedir, as a
+            line of JSON. (See instrument.py) Needs jobs = 1.
+        profile_month: Optional (year, month) to profile the processing of,
+            into (year)-(month)-profile files in savedir. (See
+            instrument.profiling) Needs jobs = 1.
+        profiler: Optional command to profile profile_month with (e.g. a
+            sampling profiler), instead of cProfile.
+        error_samples: Integer, the most lines of each kind of error to keep
+            as samples. Instead of printing each line that can't be used,
+            the number of them for each reason, and a sample of them, are
+            saved to (year)-(month)-errors.json in savedir, and a summary
+            of them printed. (See errorsink.py)
     '''
+    if sparse and engine != "batch":
+        raise ValueError("Sparse fdata needs the batch engine.")
+    if stream and (engine != "batch" or sparse or jobs > 1):
+        raise ValueError("Streaming needs the batch engine, dense fdata and jobs = 1.")
+    if stream and resume and splits > 1:
+        raise ValueError("Streamed months can't be checkpointed in parts.")
+    if pipeline_workers is not None and (engine != "batch" or jobs > 1):
+        raise ValueError("The pipeline needs the batch engine and jobs = 1.")
+    if (report or profile_month is not None) and jobs > 1:
+        raise ValueError("Reports and profiles need jobs = 1.")
+    
     # List of year-month dates to iterate over.
     dates = utils.generate_dates(startyear, startmonth, endyear, endmonth)
+    resolutions = [(width, height, n)] if resolutions is None else resolutions
+    resolutions = list(dict.fromkeys(tuple(resolution) for resolution in resolutions))
+    savedirs = get_resolution_savedirs(resolutions, savedir=savedir)
+    for resolution_savedir in savedirs.values():
+        os.makedirs(resolution_savedir, exist_ok=True)
+    month_kwargs = dict(resolutions=resolutions, V=V, engine=engine, batchsize=batchsize,
+                        sparse=sparse, datadir=datadir, cachedir=cachedir)
     
-    # Generate empty arrays for the 'next month' of data.
-    vdata_next_mo = utils.gen_empty_vdata(year=startyear, month=startmonth, w=width, h=height, n=n)
-    fdata_next_mo = utils.gen_empty_fdata(year=startyear, month=startmonth, w=width, h=height, n=n)
-    
-    for (year, month) in dates:
-        trips = np.zeros((2, 2, 2)) # Statistical info about the trips this month. (See README)
-        invalid_count = 0    # Entries that are parsable, but are not a valid trip
-        unparsable_count = 0 # Entries that raise an error on parsing
-        line_number = 0
-        
-        # Shift the vdata, fdata that are in-focus to this month
-        vdata = vdata_next_mo
-        fdata = fdata_next_mo
-        
-        # Generate new, empty 'next-month' arrays
-        #   (For trips that cross the boundary, e.g. 2-28 at 11:59 to 3:01 at 0:02
-        next_year, next_month = get_next(year=year, month=month)
-        vdata_next_mo = utils.gen_empty_vdata(year=next_year, month=next_month, w=width, h=height, n=n)
-        fdata_next_mo = utils.gen_empty_fdata(year=next_year, month=next_month, w=width, h=height, n=n)
-        
-        load_filename = "../decompressed/FOIL"+str(year)+"/trip_data_"+str(month)+".csv"
-        #load_filename = "example.csv"
-        
-        if V:
-            print("Starting on",year,month)
-            print_time()
-        
-        with open(load_filename, "r") as read_f:
-            read_f.readline() # Skip header
-            for line in read_f:
-                line_number += 1
-                if V and ((line_number % 1000000) == 0):
-                    print("    Line", line_number)
-                try:
-                    # This is where the processing happens.
-                    entry = utils.process_entry(line=line, n=n)
-                    if utils.check_valid(entry=entry, year=year, month=month):
-                        utils.update_data(entry=entry,
-                                          vdata=vdata,
-                                          fdata=fdata,
-                                          vdata_next_mo=vdata_next_mo,
-                                          fdata_next_mo=fdata_next_mo,
-                                          trips=trips,
-                                          w=width,
-                                          h=height,
-                                          n=n)
-                    else:
-                        invalid_count += 1
-                except:
-                    unparsable_count += 1
-                    print("  ERROR - could not parse line", line_number)
-        
-        print("    Line", line_number)
-        
+    def should_save(year, month):
         if restart and year == startyear and month == startmonth:
             if V:
                 print("Not saving for", year, month, "due to restart flag.")
-        else:
-            # Save the file
-            save_filename_date = str(year)+"-"+str(month).zfill(2)
-            
-            if V:
-                print("Saving",save_filename_date)
-                print_time()
-            np.savez_compressed(save_filename_date + "-data.npz", vdata = vdata, fdata = fdata, trips = trips, errors = np.array([invalid_count, unparsable_count]))
+            return False
+        return True
+    
+    if jobs > 1:
+        process_parallel(dates, should_save, jobs=jobs, splits=splits, savedir=savedir,
+                         save_format=save_format, stdn=stdn, resume=resume, error_samples=error_samples,
+                         **month_kwargs)
+    else:
+        streamdir = tempfile.mkdtemp(prefix="tmp-stream-", dir=savedir) if stream else None
+        if stream:
+            month_kwargs['streamdir'] = streamdir
+        try:
+            with contextlib.ExitStack() as stack:
+                if pipeline_workers is not None:
+                    # (Closing it waits for the last month to be saved)
+                    month_kwargs['pipe'] = stack.enter_context(pipeline.Pipeline(workers=pipeline_workers))
+                process_sequential(dates, should_save, savedirs=savedirs, save_format=save_format, stdn=stdn,
+                                   resume=resume, splits=splits, partsdir=savedir, report=report,
+                                   profile_month=profile_month, profiler=profiler, error_samples=error_samples,
+                                   **month_kwargs)
+            if pipeline_workers is not None:
+                print(month_kwargs['pipe'].report())
+        finally:
+            if stream:
+                shutil.rmtree(streamdir, ignore_errors=True)
         
     if V:
         print("All finished!")
         print_time()
 
+def process_sequential(dates, should_save, savedirs, save_format="npz", stdn=False, resume=False, splits=1,
+                       partsdir=".", report=False, profile_month=None, profiler=None, error_samples=10,
+                       **month_kwargs):
+    ''' Processes the given months one after the other, adding each month's
+        spill into the next. (See process) With resume, months with a
+        checkpoint are skipped, and (if splits > 1) the others are processed
+        in splits parts, saved in a subdirectory of partsdir. With a
+        month_kwargs['pipe'] (see pipeline.py), each month is saved in the
+        background while the next one is processed. Reports, profiles and
+        error reports (see process) are saved to partsdir too. Returns
+        nothing.'''
+    V = month_kwargs.get('V', False)
+    resolutions = month_kwargs['resolutions']
+    pipe = month_kwargs.get('pipe')
+    
+    def finish_month(year, month, data, spill, in_parts, month_partsdir, stats=None):
+        # Save a processed month (unless it shouldn't be), then clean up after it
+        if should_save(year, month):
+            # Save the files
+            for resolution in resolutions:
+                with instrument.timing(stats, "save"):
+                    save_filename = save_month(year=year, month=month, data=data[resolution],
+                                               savedir=savedirs[resolution], save_format=save_format,
+                                               n=resolution[2], stdn=stdn)
+                if stats is not None:
+                    for filename in save_filename.split(" and "):
+                        stats.saved[filename] = os.path.getsize(filename)
+                        stats.add("save", 0, stats.saved[filename])
+                if V:
+                    print("Saved",save_filename)
+                    print_time()
+            if resume:
+                # (Only once every resolution is saved)
+                for resolution in resolutions:
+                    save_checkpoint(year=year, month=month, spill=spill[resolution], savedir=savedirs[resolution])
+        # (Streamed months are memory maps of temporary files)
+        for resolution in resolutions:
+            slabarray.remove_files(data[resolution])
+        if in_parts:
+            shutil.rmtree(month_partsdir, ignore_errors=True)
+        if stats is not None:
+            instrument.write_report(os.path.join(partsdir, "process-report.jsonl"), stats.report())
+    
+    spill = None # The first month has no trips from the previous month
+    for (year, month) in dates:
+        if resume and has_checkpoint(year=year, month=month, savedirs=savedirs):
+            # Done already: everything it passes on to later months is in its checkpoint
+            if V:
+                print("Already done", year, month)
+            spill = {resolution : load_arrays(get_checkpoint_filename(year=year, month=month,
+                                                                      savedir=savedirs[resolution]), sparse=True)
+                     for resolution in resolutions}
+            continue
+        in_parts = resume and splits > 1
+        month_partsdir = os.path.join(partsdir, "tmp-parts-%d-%02d" % (year, month))
+        stats = None
+        if report:
+            load_filename = get_load_filename(year=year, month=month,
+                                              datadir=month_kwargs.get('datadir', "../decompressed"))
+            stats = instrument.MonthStats(year, month, total_bytes=readers.source_size(load_filename))
+        sink = errorsink.ErrorSink(samplesize=error_samples)
+        with contextlib.ExitStack() as stack:
+            if profile_month is not None and (year, month) == tuple(profile_month):
+                stack.enter_context(instrument.profiling(os.path.join(partsdir, "%d-%02d-profile" % (year, month)),
+                                                         command=profiler))
+            if in_parts:
+                data, next_spill, _ = process_month_parts(year=year, month=month, partsdir=month_partsdir,
+                                                          splits=splits, stats=stats, sink=sink,
+                                                          error_samples=error_samples, **month_kwargs)
+            else:
+                data, next_spill, _ = process_month_resolutions(year=year, month=month, stats=stats, sink=sink,
+                                                                **month_kwargs)
+            print(sink.summary())
+            sink.write(os.path.join(partsdir, "%d-%02d-errors.json" % (year, month)))
+            if spill is not None:
+                for resolution in resolutions:
+                    add_spill(data[resolution], spill[resolution])
+                    # (Trips that end after this month too are carried on in its spill)
+                    add_spill(next_spill[resolution], spill[resolution], offset=data[resolution]['vdata'].shape[0])
+            spill = next_spill
+            
+            if pipe is None:
+                finish_month(year, month, data, spill, in_parts, month_partsdir, stats=stats)
+            else:
+                # Neither data nor spill is changed after this, but the next month reads spill while it's
+                #   saved, and reading a SparseArray merges its buffered updates in place. (See
+                #   SparseArray.compact) So they are merged here first.
+                for resolution in resolutions:
+                    for array in spill[resolution].values():
+                        if isinstance(array, sparseutils.SparseArray):
+                            array.compact()
+                pipe.save(finish_month, year, month, data, spill, in_parts, month_partsdir, stats=stats)
+
+def process_parallel(dates, should_save, jobs, splits=1, savedir=".", save_format="npz", stdn=False,
+                     resume=False, error_samples=10, window=None, **month_kwargs):
+    ''' Processes the given months in a pool of jobs processes. (See process)
+    
+    Each month's .csv is split into splits ranges of lines (unless the month
+    is processed from a cache, see tripcache.py), and each range is
+    processed independently into temporary files, as its data plus its
+    spill into later months. Once a month and every month before it are
+    done, a merge step sums the data and the spills that reach it and saves
+    it (also in the pool), for each resolution. Only a few months are
+    processed at a time (window, by default enough to keep the pool busy):
+    the next month is started once one is saved. With resume, months with a
+    checkpoint are skipped, and stand in for the spills of the months up to
+    them. The errors of each month (see errorsink.py) are saved to savedir.
+    Returns nothing.
+    '''
+    V = month_kwargs.get('V', False)
+    savedirs = get_resolution_savedirs(month_kwargs['resolutions'], savedir=savedir)
+    sparse = month_kwargs.get('sparse', False)
+    datadir = month_kwargs.get('datadir', "../decompressed")
+    cachedir = month_kwargs.get('cachedir')
+    tempdir = tempfile.mkdtemp(prefix="tmp-months-", dir=savedir)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            pending = {} # future -> ("part", index of month, part) or ("merge", index of month, resolution)
+            parts = {} # Index of month -> number of parts
+            checkpointed = [resume and has_checkpoint(year=year, month=month, savedirs=savedirs) for (year, month) in dates]
+            # Months are only started while fewer than window of them are being processed or
+            #   saved, so the temporary files (and, with resume, the checkpoints) keep up
+            window = -(-jobs // splits) + 1 if window is None else window
+            flying = {} # Index of month -> the number of its merges not finished (None until merged)
+            submitted = 0 # Months before this are started (or skipped)
+            
+            def start_months(submitted):
+                # Start the next months, up to the window. Returns the new submitted
+                while submitted < len(dates) and len(flying) < window:
+                    ii = submitted
+                    submitted += 1
+                    if checkpointed[ii]:
+                        continue
+                    year, month = dates[ii]
+                    byte_ranges = get_byte_ranges(year=year, month=month, splits=splits, datadir=datadir,
+                                                  cachedir=cachedir)
+                    parts[ii] = len(byte_ranges)
+                    flying[ii] = None
+                    for part, byte_range in enumerate(byte_ranges):
+                        future = executor.submit(_process_part_to_files, year=year, month=month, part=part,
+                                                 tempdir=tempdir, byte_range=byte_range,
+                                                 error_samples=error_samples, **month_kwargs)
+                        pending[future] = ("part", ii, part)
+                return submitted
+            
+            def merge_month(jj):
+                # Submit the merges of month jj, at each resolution. Returns how many
+                year, month = dates[jj]
+                count = 0
+                # Spills from the last checkpoint before this month on (or from the first month)
+                first = max([kk for kk in range(jj) if checkpointed[kk]], default=0)
+                for resolution, resolution_savedir in savedirs.items():
+                    data_filenames = [results[jj][part][0][resolution][0] for part in range(parts[jj])]
+                    if not should_save(year, month):
+                        for filename in data_filenames:
+                            os.remove(filename)
+                        continue
+                    spills = []
+                    for kk in range(first, jj):
+                        offset = int(utils.spill_offset(dates[kk][0], dates[kk][1], year, month, n=resolution[2]))
+                        if offset >= sparseutils.SPILL_DAYS*24*resolution[2]:
+                            continue
+                        if checkpointed[kk]:
+                            spills.append((get_checkpoint_filename(year=dates[kk][0], month=dates[kk][1],
+                                                                   savedir=resolution_savedir), offset))
+                        else:
+                            spills += [(results[kk][part][0][resolution][1], offset) for part in range(parts[kk])]
+                    spill_filenames = [results[jj][part][0][resolution][1]
+                                       for part in range(parts[jj])] if resume else None
+                    future = executor.submit(_merge_and_save, data_filenames, spills,
+                                             year=year, month=month, sparse=sparse,
+                                             spill_filenames=spill_filenames,
+                                             savedir=resolution_savedir, save_format=save_format,
+                                             n=resolution[2], stdn=stdn)
+                    pending[future] = ("merge", jj, resolution)
+                    count += 1
+                return count
+            
+            results = [{} for _ in dates] # Index of month -> part -> results
+            done = set(ii for ii in range(len(dates)) if checkpointed[ii]) # Indices of months with every part done
+            merged = 0 # Months before this are merged (or skipped)
+            submitted = start_months(submitted)
+            while pending:
+                finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    kind, ii, part = pending.pop(future)
+                    if kind == "merge":
+                        if V:
+                            print("Saved", future.result())
+                            print_time()
+                        else:
+                            future.result()
+                        flying[ii] -= 1
+                        if flying[ii] == 0:
+                            del flying[ii]
+                        continue
+                    results[ii][part] = future.result()
+                    if len(results[ii]) < parts[ii]:
+                        continue
+                    done.add(ii)
+                    
+                    # Report errors and line counts, offsetting line numbers by the parts before
+                    line_number = 0
+                    sink = errorsink.ErrorSink(samplesize=error_samples)
+                    for part in range(parts[ii]):
+                        _, part_lines, errors = results[ii][part]
+                        sink.merge(errorsink.ErrorSink.from_report(errors, samplesize=error_samples), offset=line_number)
+                        line_number += part_lines
+                    print("    Line", line_number, "of", dates[ii])
+                    print(sink.summary(), "of", dates[ii])
+                    sink.write(os.path.join(savedir, "%d-%02d-errors.json" % dates[ii]))
+                    
+                    # A month can be merged once it and every month before it are done
+                    #   (A spill can reach more than one month on)
+                    while merged in done:
+                        jj = merged
+                        merged += 1
+                        if checkpointed[jj]:
+                            continue
+                        flying[jj] = merge_month(jj)
+                        if flying[jj] == 0:
+                            del flying[jj]
+                submitted = start_months(submitted)
+    finally:
+        # (Including the spills, which are kept until every month they reach is merged)
+        shutil.rmtree(tempdir, ignore_errors=True)
+
 if __name__ == '__main__':
     # Parse arguments
     parser = argparse.ArgumentParser(description="NYC Dataset processing")
@@ -134,12 +968,66 @@ if __name__ == '__main__':
     parser.add_argument("--nslotsperhour", "-n",
                         help="Discretize time into n slots per hour. Must be integer divisor of 60. (Default 4)",
                         type=int, nargs=1)
+    parser.add_argument("--resolutions", "-R",
+                        help="Process several resolutions in one pass, each given as WIDTHxHEIGHTnN (e.g. -R 10x20n4 5x10n2), instead of --width, --height and --nslotsperhour. Each is saved in its own subdirectory of --savedir.",
+                        type=parse_resolution, nargs="+")
     parser.add_argument("--verbose", "-v",
                         help="",
                         action="store_true")
     parser.add_argument("--restart", "-r",
                         help="Does not save the first month of data. Used to restart code when it crashes. (E.g. 2010 08 can have trips starting in 2010 07 that end in 2010 08)",
                         action="store_true")
+    parser.add_argument("--engine", "-e",
+                        help="'line' processes one line at a time, 'batch' processes batches of lines with numpy. Same output, 'batch' is faster. (Default line)",
+                        choices=["line", "batch"], nargs=1)
+    parser.add_argument("--batchsize", "-b",
+                        help="Number of lines per batch with '--engine batch'. (Default 100000)",
+                        type=int, nargs=1)
+    parser.add_argument("--jobs", "-j",
+                        help="Number of months to process in parallel. (Default 1)",
+                        type=int, nargs=1)
+    parser.add_argument("--report", "-i",
+                        help="Count the time spent reading, parsing, projecting, validating, accumulating and saving, print progress with lines/s, MB/s and an ETA with --verbose, and append a report on each month to process-report.jsonl in --savedir. Not with --jobs.",
+                        action="store_true")
+    parser.add_argument("--profile-month", "-pm",
+                        help="Profile the processing of one month, given as YEAR-MONTH (e.g. 2012-03), into (year)-(month)-profile.prof in --savedir, with cProfile. Not with --jobs.",
+                        type=parse_month, nargs=1)
+    parser.add_argument("--profiler",
+                        help="With --profile-month, a command to profile with instead of cProfile, with {pid} and {output} filled in, e.g. a sampling profiler: \"py-spy record --pid {pid} -o {output}.svg\". It is stopped with SIGINT once the month is processed.",
+                        type=str, nargs=1)
+    parser.add_argument("--error-samples", "-es",
+                        help="The most lines of each kind of error (e.g. bad_timestamp, too_fast) to save in (year)-(month)-errors.json in --savedir, along with the number of each. (Default 10)",
+                        type=int, nargs=1)
+    parser.add_argument("--pipeline", "-P",
+                        help="Read each month ahead in a thread, parse it in this many processes (0: in the main one) and save it in a thread while the next month is processed, then print how long each stage was blocked. Needs '--engine batch', not with --jobs.",
+                        type=int, nargs=1)
+    parser.add_argument("--splits", "-p",
+                        help="With --jobs, split each month into this many parts, processed in parallel. (Default 1)",
+                        type=int, nargs=1)
+    parser.add_argument("--datadir", "-d",
+                        help="Directory holding the FOIL201* directories of .csv files (or .csv.gz or .csv.zip files), or FOIL201*.zip archives of them. (Default ../decompressed)",
+                        type=str, nargs=1)
+    parser.add_argument("--savedir", "-o",
+                        help="Directory to save the .npz files to. (Default: the current directory)",
+                        type=str, nargs=1)
+    parser.add_argument("--cachedir", "-c",
+                        help="Directory holding a cache of the .csv files made with tripcache.py. Months in the cache are processed from it. (Default: no cache)",
+                        type=str, nargs=1)
+    parser.add_argument("--format", "-f",
+                        help="'npz' saves each month with np.savez_compressed. 'chunked' saves .npzc files, compressed in parallel (see chunkedio.py). (Default npz)",
+                        choices=["npz", "chunked"], nargs=1)
+    parser.add_argument("--sparse", "-s",
+                        help="Accumulate and save fdata in a sparse format (see sparseutils.py). Needs '--engine batch'.",
+                        action="store_true")
+    parser.add_argument("--stdn", "-t",
+                        help="Save only the trip counts, to STDN-volume-(year)-(month) and STDN-flow-(year)-(month) files, instead of the (year)-(month)-data files. (As script_data_to_stdn.py does)",
+                        action="store_true")
+    parser.add_argument("--resume", "-u",
+                        help="Save a checkpoint next to each month saved, and skip the months that already have one. Run again with the same arguments to pick up where a run stopped. Without --jobs, --splits also saves each month in that many parts as they are done.",
+                        action="store_true")
+    parser.add_argument("--stream", "-w",
+                        help="Write vdata and fdata to temporary files in --savedir a few hours at a time as they are finished, instead of holding a whole month in memory (see slabarray.py). Needs '--engine batch', and can't be used with --sparse or --jobs.",
+                        action="store_true")
 
     args = parser.parse_args()
     
@@ -151,8 +1039,36 @@ if __name__ == '__main__':
     width       = 10    if args.width       is None else args.width[0]
     height      = 20    if args.height      is None else args.height[0]
     n           = 4     if args.nslotsperhour is None else args.nslotsperhour[0]
+    engine      = "line" if args.engine      is None else args.engine[0]
+    batchsize   = 100000 if args.batchsize   is None else args.batchsize[0]
+    jobs        = 1     if args.jobs        is None else args.jobs[0]
+    splits      = 1     if args.splits      is None else args.splits[0]
+    datadir     = "../decompressed" if args.datadir is None else args.datadir[0]
+    savedir     = "."   if args.savedir     is None else args.savedir[0]
+    cachedir    = None  if args.cachedir    is None else args.cachedir[0]
+    resolutions = args.resolutions
+    save_format = "npz" if args.format     is None else args.format[0]
+    pipeline_workers = None if args.pipeline is None else args.pipeline[0]
+    profile_month = None if args.profile_month is None else args.profile_month[0]
+    profiler    = None  if args.profiler    is None else args.profiler[0]
+    error_samples = 10  if args.error_samples is None else args.error_samples[0]
     V = args.verbose
     restart = args.restart
+    sparse = args.sparse
+    stdn = args.stdn
+    stream = args.stream
+    resume = args.resume
+    
+    if sparse and engine != "batch":
+        parser.error("--sparse needs --engine batch")
+    if stream and (engine != "batch" or sparse or jobs > 1):
+        parser.error("--stream needs --engine batch, and can't be used with --sparse or --jobs")
+    if stream and resume and splits > 1:
+        parser.error("--stream can't be used with --resume and --splits")
+    if pipeline_workers is not None and (engine != "batch" or jobs > 1):
+        parser.error("--pipeline needs --engine batch, and can't be used with --jobs")
+    if (args.report or profile_month is not None) and jobs > 1:
+        parser.error("--report and --profile-month can't be used with --jobs")
     
     print("NYCDataProcessing/main.py started.")
     
@@ -161,8 +1077,13 @@ if __name__ == '__main__':
         print("Running with arguments:")
         print("  Verbose")
         print("  ",startyear, ", ", startmonth, " to ", endyear, ", ", endmonth, ".",sep="")
-        print("  With",n,"samples year hour.")
-        print("  On a grid of size ",width,"x",height,".", sep="")
+        if resolutions is None:
+            print("  With",n,"samples year hour.")
+            print("  On a grid of size ",width,"x",height,".", sep="")
+        else:
+            for (res_width, res_height, res_n) in resolutions:
+                print("  With ",res_n," samples per hour, on a grid of size ",res_width,"x",res_height,".", sep="")
+        print("  Using the",engine,"engine.")
     
     # Begin processing data
     process( startyear  = startyear,
@@ -173,5 +1094,23 @@ if __name__ == '__main__':
              height     = height,
              n          = n,
              V          = V,
-             restart    = restart)
+             restart    = restart,
+             engine     = engine,
+             batchsize  = batchsize,
+             sparse     = sparse,
+             jobs       = jobs,
+             splits     = splits,
+             datadir    = datadir,
+             savedir    = savedir,
+             cachedir   = cachedir,
+             resolutions = resolutions,
+             save_format = save_format,
+             stdn       = stdn,
+             stream     = stream,
+             resume     = resume,
+             pipeline_workers = pipeline_workers,
+             report     = args.report,
+             profile_month = profile_month,
+             profiler   = profiler,
+             error_samples = error_samples)
     
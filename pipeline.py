@@ -0,0 +1,143 @@
+''' Overlap the stages of processing a month (see main.process --pipeline).
+
+Without it, each month goes strictly read -> parse -> accumulate -> save.
+A Pipeline runs them at once, with bounded queues between them:
+
+    read:       A background thread reads the .csv (decompressing it, if
+                need be) into batches of lines, up to queuesize batches
+                ahead of the parsing.
+    parse:      The batches are parsed (utils.process_entries) in a pool of
+                worker processes, up to 2 batches per worker ahead of the
+                accumulating. (Parsing is pure python, so threads wouldn't
+                run it in parallel.)
+    accumulate: The parsed batches are added into the month's arrays, in
+                order, in the calling thread. (See utils.accumulate_resolutions)
+    save:       Once a month is done, it is saved by a background thread,
+                while the next month is read and accumulated. At most one
+                month is being saved at a time.
+
+The saved arrays are the same as without it. The Pipeline adds up how long
+each stage spent blocked: waiting for the stage before it to hand it work,
+or for the stage after it to take its work. (See Pipeline.report) The
+stage that is blocked least is the one holding the others up.
+'''
+
+import time
+import threading
+import contextlib
+import collections
+import concurrent.futures
+import utils
+import readers
+
+STAGES = ("read", "parse", "accumulate", "save")
+
+class Pipeline:
+    ''' The worker pools and blocked times of a pipeline, shared by the
+        months processed through it. Use it as a context manager, or call
+        close() when done.
+
+    # Arguments:
+        workers: The number of processes to parse batches in. With 0, the
+            batches are parsed in the calling thread (but still read ahead).
+        queuesize: The number of batches of lines read ahead.
+    '''
+    def __init__(self, workers=1, queuesize=4):
+        self.workers = workers
+        self.queuesize = queuesize
+        self.lock = threading.Lock()
+        self.blocked = collections.OrderedDict((stage, 0.0) for stage in STAGES)
+        self.parse_executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.save_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.saving = None # The future of the month being saved
+        self.saved_time = None # When the last month finished saving
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_blocked(self, stage, seconds):
+        ''' Add seconds to the time stage spent blocked.'''
+        with self.lock:
+            self.blocked[stage] += seconds
+
+    @contextlib.contextmanager
+    def blocking(self, stage):
+        ''' Count the time spent in the with block as stage being blocked.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_blocked(stage, time.time() - start)
+
+    def parse(self, lines, batchsize=100000):
+        ''' Yield (batch, entries) for each batch of up to batchsize lines,
+            in order: the lines of the batch, and utils.process_entries of
+            them. Closing the generator stops the reading.'''
+        batches = readers.prefetch(utils.read_batches(lines, batchsize=batchsize), queuesize=self.queuesize,
+                                   blocked=lambda seconds: self.add_blocked("read", seconds))
+        with contextlib.closing(batches):
+            def next_batch():
+                with self.blocking("parse"):
+                    return next(batches, None)
+            if self.parse_executor is None:
+                batch = next_batch()
+                while batch is not None:
+                    yield batch, utils.process_entries(batch)
+                    batch = next_batch()
+                return
+            pending = collections.deque()
+            try:
+                batch = next_batch()
+                while batch is not None or pending:
+                    if batch is not None:
+                        pending.append((batch, self.parse_executor.submit(utils.process_entries, batch)))
+                        if len(pending) < 2 * self.workers:
+                            batch = next_batch()
+                            continue
+                    done_batch, future = pending.popleft()
+                    with self.blocking("accumulate"):
+                        entries = future.result()
+                    yield done_batch, entries
+                    if batch is not None:
+                        batch = next_batch()
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def save(self, function, *args, **kwargs):
+        ''' Call function(*args, **kwargs) in the save thread, once the
+            month being saved (if any) is done. Errors from it are raised
+            by the next call to save or wait.'''
+        self.wait()
+        if self.saved_time is not None:
+            self.add_blocked("save", time.time() - self.saved_time)
+        def run():
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.saved_time = time.time()
+        self.saving = self.save_executor.submit(run)
+
+    def wait(self):
+        ''' Wait for the month being saved (if any) to be done. Returns nothing.'''
+        if self.saving is not None:
+            saving, self.saving = self.saving, None
+            with self.blocking("accumulate"):
+                saving.result()
+
+    def close(self):
+        ''' Wait for the last save, and shut down the worker pools.'''
+        try:
+            self.wait()
+        finally:
+            self.save_executor.shutdown()
+            if self.parse_executor is not None:
+                self.parse_executor.shutdown()
+
+    def report(self):
+        ''' Return a line giving the seconds each stage spent blocked.'''
+        with self.lock:
+            return "Blocked: " + ", ".join("%s %.1fs" % (stage, seconds) for stage, seconds in self.blocked.items())
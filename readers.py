@@ -0,0 +1,196 @@
+''' Functions for reading the trip_data_*.csv files in main.py.
+
+The .csv files can also be read straight from the compressed files they
+come in (see find_source), without inflating them onto disk first; they
+are decompressed in a background thread (see read_lines).'''
+
+import io
+import os
+import gzip
+import time
+import queue
+import locale
+import zipfile
+import threading
+import contextlib
+
+def split_byte_ranges(filename, parts):
+    ''' Split the .csv into (up to) parts ranges of bytes, each starting
+        at the beginning of a line, skipping the header.
+        Returns a list of (start, end) byte offsets, end exclusive.'''
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as read_f:
+        read_f.readline() # Skip header
+        header_end = read_f.tell()
+        bounds = [header_end]
+        for part in range(1, parts):
+            target = header_end + (size - header_end) * part // parts
+            if target <= bounds[-1]:
+                continue
+            # Move on to the start of the next line
+            read_f.seek(target - 1)
+            read_f.readline()
+            if bounds[-1] < read_f.tell() < size:
+                bounds.append(read_f.tell())
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def read_byte_range(filename, start, end, blocksize=1<<24, encoding=None):
+    ''' Yield the lines of the file from byte start to byte end, as open()
+        in text mode would. start should be the beginning of a line (see
+        split_byte_ranges), and the range ends with the line holding the
+        byte before end. Reads blocksize bytes at a time.'''
+    encoding = locale.getpreferredencoding(False) if encoding is None else encoding
+    with open(filename, "rb") as read_f:
+        read_f.seek(start)
+        remaining = end - start
+        leftover = b""
+        while remaining > 0:
+            block = read_f.read(min(blocksize, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            block = leftover + block
+            # Only hand over whole lines; keep the rest for the next block.
+            cut = len(block) if remaining <= 0 else block.rfind(b"\n") + 1
+            leftover = block[cut:]
+            yield from io.StringIO(block[:cut].decode(encoding), newline=None)
+        if leftover:
+            yield from io.StringIO(leftover.decode(encoding), newline=None)
+
+def _find_member(archive_filename, basename):
+    # The name of the member of the .zip named basename (in any directory), or None
+    with zipfile.ZipFile(archive_filename) as archive:
+        for name in archive.namelist():
+            if os.path.basename(name) == basename:
+                return name
+    return None
+
+def find_source(filename):
+    ''' Find the file to read the .csv at filename from: filename itself,
+        or else (the first that exists) filename.gz, filename.zip, or a .zip
+        of its directory holding a member of the same name (e.g.
+        FOIL2010.zip holding trip_data_1.csv, for FOIL2010/trip_data_1.csv).
+        Returns (path, member): member is the name of the .csv in a .zip,
+        or None. Returns (filename, None) if none of them exist.'''
+    basename = os.path.basename(filename)
+    if os.path.exists(filename):
+        return filename, None
+    if os.path.exists(filename + ".gz"):
+        return filename + ".gz", None
+    for archive_filename in (filename + ".zip", os.path.dirname(os.path.abspath(filename)) + ".zip"):
+        if os.path.exists(archive_filename):
+            member = _find_member(archive_filename, basename)
+            if member is not None:
+                return archive_filename, member
+    return filename, None
+
+def is_compressed(filename):
+    ''' Return True if the .csv at filename is read from a compressed file.
+        (See find_source) These can't be split into byte ranges.'''
+    return find_source(filename)[0] != filename
+
+def source_size(filename):
+    ''' Return the size in bytes of the .csv at filename (see find_source),
+        uncompressed, or None if it isn't known without reading it all (for
+        a .gz) or there's no such file.'''
+    path, member = find_source(filename)
+    if member is not None:
+        with zipfile.ZipFile(path) as archive:
+            return archive.getinfo(member).file_size
+    if path != filename or not os.path.exists(path):
+        return None
+    return os.path.getsize(path)
+
+@contextlib.contextmanager
+def open_source(filename):
+    ''' Open the .csv at filename (see find_source) for reading, in binary
+        mode, decompressing it if needed.'''
+    path, member = find_source(filename)
+    with contextlib.ExitStack() as stack:
+        if member is not None:
+            archive = stack.enter_context(zipfile.ZipFile(path))
+            yield stack.enter_context(archive.open(member))
+        elif path != filename:
+            yield stack.enter_context(gzip.open(path, "rb"))
+        else:
+            yield stack.enter_context(open(path, "rb"))
+
+def prefetch(iterable, queuesize=4, blocked=None):
+    ''' Yield the items of iterable, produced in a background thread up to
+        queuesize items ahead of the ones yielded. Errors are raised where
+        the item would have been yielded. Closing the generator stops the
+        thread. If given, blocked is called with the number of seconds the
+        thread spent waiting for room in the queue each time it waited.'''
+    items = queue.Queue(maxsize=queuesize)
+    stop = threading.Event()
+    done = object() # (Marks the end of the items)
+    
+    def put(item):
+        # (Give up if the items are no longer wanted)
+        start = time.time()
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        if blocked is not None and time.time() - start > 0.001:
+            blocked(time.time() - start)
+    
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                put((item, None))
+            put((done, None))
+        except BaseException as error:
+            put((done, error))
+    
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def _read_text_blocks(filename, blocksize=1<<24, encoding=None):
+    # Yield the decompressed text of the .csv at filename, blocksize bytes
+    #   at a time, cut at the end of a line
+    with open_source(filename) as read_f:
+        leftover = b""
+        while True:
+            block = read_f.read(blocksize)
+            if not block:
+                break
+            # Only hand over whole lines; keep the rest for the next block.
+            block = leftover + block
+            cut = block.rfind(b"\n") + 1
+            leftover = block[cut:]
+            yield block[:cut].decode(encoding)
+        if leftover:
+            yield leftover.decode(encoding)
+
+def read_lines(filename, blocksize=1<<24, queuesize=4, encoding=None):
+    ''' Yield the lines of the .csv at filename, header included, as open()
+        in text mode would. If it is read from a compressed file (see
+        find_source), that is decompressed in a background thread, blocksize
+        bytes at a time, up to queuesize blocks ahead of the lines yielded,
+        so decompressing overlaps with processing the lines.'''
+    if not is_compressed(filename):
+        with open(filename, "r") as read_f:
+            yield from read_f
+        return
+    encoding = locale.getpreferredencoding(False) if encoding is None else encoding
+    with contextlib.closing(prefetch(_read_text_blocks(filename, blocksize=blocksize, encoding=encoding),
+                                     queuesize=queuesize)) as blocks:
+        for block in blocks:
+            yield from io.StringIO(block, newline=None)
@@ -0,0 +1,170 @@
+''' Coarsen the months saved by main.py to a lower resolution.
+
+E.g. data at w=10, h=20, n=4 can be reduced to w=5, h=10, n=2 (see Warning
+4 in the README) by summing blocks of 2x2 grid cells and 2 time slots.
+fdata is read a slab of time slots at a time (see slotreader.iter_slabs)
+and summed into a memory-mapped .npy, so only about --memory bytes of it
+are in memory at once, across the --jobs months coarsened in parallel.
+A sparse fdata is coarsened (and saved) sparse. trips and errors don't
+depend on the resolution, and are copied.
+
+Block sums are not always exactly what processing at the coarse resolution
+gives (main.py --resolutions): a trip that crosses a fine time slot
+boundary inside one coarse slot stays in fdata[1], not fdata[0], and (by
+floating point rounding) a trip very near a cell border can be mapped to
+a neighbouring coarse cell.
+
+    python3.6 regrid.py -d . -R 5x10n2 -j 4
+'''
+
+import os
+import argparse
+import concurrent.futures
+import numpy as np
+import utils
+import chunkedio
+import sparseutils
+from savefiles import get_save_filename, save_arrays, parse_resolution
+from slotreader import get_data_filename, read_header, iter_slabs
+
+def get_resolution(year, month, vdata_shape):
+    ''' Return the resolution (w, h, n) of the vdata of (year, month), given its shape.'''
+    samples = utils.no_days_in_mo(year=year, month=month) * 24
+    if vdata_shape[0] % samples:
+        raise ValueError("vdata of " + str(year) + "-" + str(month) + " has " + str(vdata_shape[0]) +
+                         " time slots, not a whole number per hour")
+    return (vdata_shape[1], vdata_shape[2], vdata_shape[0] // samples)
+
+def regrid_month(year, month, resolution, datadir=".", savedir=".", save_format="npz", memory=1<<30):
+    ''' Coarsen the arrays main.py saved for (year, month) in datadir to
+        resolution (w, h, n), and save them to savedir.
+
+    # Arguments:
+        year, month: The month to coarsen.
+        resolution: The (w, h, n) to coarsen to. w, h and n must divide the
+            width, height and slots per hour of the saved arrays.
+        datadir: The directory holding the (year)-(month)-data file.
+        savedir: The directory to save the coarsened file to.
+        save_format: "npz" or "chunked". (See main.process)
+        memory: About how many bytes of fdata to read at once.
+    # Returns:
+        The filename saved to.
+    '''
+    filename = get_data_filename(year=year, month=month, savedir=datadir)
+    if chunkedio.is_chunked(filename):
+        names = chunkedio.read_chunked_names(filename)
+        data = chunkedio.load_chunked(filename, keys=[name for name in names if not name.startswith("fdata")])
+    else:
+        with np.load(filename) as npz:
+            names = list(npz.keys())
+            data = {name : npz[name] for name in names if not name.startswith("fdata")}
+    source = get_resolution(year, month, data['vdata'].shape)
+    factors = utils.resolution_factors(source, resolution)
+    if factors is None:
+        raise ValueError("Can't coarsen %s from %dx%dn%d to %dx%dn%d: the width, height and slots per hour "
+                         "must divide those of the data" % ((filename,) + source + tuple(resolution)))
+    arrays = {name : utils.coarsen(array, utils.array_factors(name, factors)) if name.startswith("vdata") else array
+              for name, array in data.items()}
+    save_filename = get_save_filename(year=year, month=month, savedir=savedir, save_format=save_format)
+
+    if sparseutils.is_sparse(names, "fdata"):
+        if chunkedio.is_chunked(filename):
+            fdata = sparseutils.load_array(chunkedio.load_chunked(filename, keys=[name for name in names
+                                                                                  if name.startswith("fdata")]),
+                                           "fdata", dense=False)
+        else:
+            with np.load(filename) as npz:
+                fdata = sparseutils.load_array(npz, "fdata", dense=False)
+        arrays['fdata'] = utils.coarsen(fdata, utils.array_factors("fdata", factors))
+        save_arrays(save_filename, arrays, chunkslots=24*resolution[2])
+        return save_filename
+
+    shape, dtype = read_header(filename, "fdata")
+    fdata_factors = utils.array_factors("fdata", factors)
+    kt = factors[2]
+    # Whole coarse slots per slab (about memory bytes, with the sum of a slab)
+    slot_bytes = int(np.prod(shape[2:], dtype=np.int64)) * dtype.itemsize
+    slab_slots = max(kt, memory // (2 * slot_bytes) // kt * kt)
+    npy_filename = save_filename + ".tmp.npy"
+    try:
+        fdata = np.lib.format.open_memmap(npy_filename, mode="w+", dtype=dtype,
+                                          shape=tuple(size // factor for size, factor in zip(shape, fdata_factors)))
+        for index, slab in iter_slabs(filename, "fdata", slab_slots):
+            # index is (kind or all kinds, slots); the slab has no axis for an integer kind
+            slab_factors = fdata_factors[1:] if len(slab.shape) < len(shape) else fdata_factors
+            fdata[index[0], index[1].start // kt : index[1].stop // kt] = utils.coarsen(slab, slab_factors)
+        fdata.flush()
+        arrays['fdata'] = fdata
+        save_arrays(save_filename, arrays, chunkslots=24*resolution[2])
+    finally:
+        # (Close the memory map before removing its file)
+        fdata = arrays = None
+        if os.path.exists(npy_filename):
+            os.remove(npy_filename)
+    return save_filename
+
+def regrid(startyear=2010, startmonth=1, endyear=2013, endmonth=12, resolution=(5, 10, 2), datadir=".",
+           savedir=None, save_format="npz", jobs=1, memory=1<<30):
+    ''' Coarsen the months from (startyear, startmonth) to (endyear, endmonth)
+        in datadir to resolution (see regrid_month), jobs months at a time,
+        using about memory bytes in all. Saves to savedir (default: the
+        WxHnN subdirectory of datadir, as with main.py --resolutions).
+        Returns nothing.'''
+    savedir = os.path.join(datadir, "%dx%dn%d" % tuple(resolution)) if savedir is None else savedir
+    os.makedirs(savedir, exist_ok=True)
+    dates = utils.generate_dates(startyear, startmonth, endyear, endmonth)
+    kwargs = dict(resolution=resolution, datadir=datadir, savedir=savedir, save_format=save_format)
+    if jobs <= 1:
+        for (year, month) in dates:
+            print("Saved", regrid_month(year=year, month=month, memory=memory, **kwargs))
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(regrid_month, year=year, month=month, memory=memory // jobs, **kwargs)
+                   for (year, month) in dates]
+        for future in futures:
+            print("Saved", future.result())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Coarsen processed months to a lower resolution")
+    parser.add_argument("--resolution", "-R",
+                        help="The resolution to coarsen to, as WIDTHxHEIGHTnN (e.g. 5x10n2). Its width, height and n must divide those of the data.",
+                        type=parse_resolution, nargs=1, required=True)
+    parser.add_argument("--startyear", "-sy",
+                        help="Year to start coarsening from. Default 2010",
+                        type=int, nargs=1)
+    parser.add_argument("--startmonth", "-sm",
+                        help="Month to start coarsening from. Default 1.",
+                        type=int, nargs=1)
+    parser.add_argument("--endyear", "-ey",
+                        help="Year to finish coarsening (inclusive). Default 2013.",
+                        type=int, nargs=1)
+    parser.add_argument("--endmonth", "-em",
+                        help="Month to finish coarsening (inclusive). Default 12.",
+                        type=int, nargs=1)
+    parser.add_argument("--datadir", "-d",
+                        help="Directory holding the (year)-(month)-data files. (Default: the current directory)",
+                        type=str, nargs=1)
+    parser.add_argument("--savedir", "-o",
+                        help="Directory to save the coarsened files to. (Default: the WxHnN subdirectory of --datadir)",
+                        type=str, nargs=1)
+    parser.add_argument("--format", "-f",
+                        help="'npz' saves with np.savez_compressed. 'chunked' saves .npzc files, compressed in parallel (see chunkedio.py). (Default npz)",
+                        choices=["npz", "chunked"], nargs=1)
+    parser.add_argument("--jobs", "-j",
+                        help="The number of months to coarsen in parallel. (Default 1)",
+                        type=int, nargs=1)
+    parser.add_argument("--memory", "-m",
+                        help="About how many MB of fdata to read at once, across all jobs. (Default 1024)",
+                        type=int, nargs=1)
+    args = parser.parse_args()
+
+    regrid(startyear   = 2010  if args.startyear   is None else args.startyear[0],
+           startmonth  = 1     if args.startmonth  is None else args.startmonth[0],
+           endyear     = 2013  if args.endyear     is None else args.endyear[0],
+           endmonth    = 12    if args.endmonth    is None else args.endmonth[0],
+           resolution  = args.resolution[0],
+           datadir     = "."   if args.datadir     is None else args.datadir[0],
+           savedir     = None  if args.savedir     is None else args.savedir[0],
+           save_format = "npz" if args.format      is None else args.format[0],
+           jobs        = 1     if args.jobs        is None else args.jobs[0],
+           memory      = (1024 if args.memory      is None else args.memory[0]) << 20)
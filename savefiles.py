@@ -0,0 +1,97 @@
+''' The names and formats of the files main.py reads and writes.
+
+Kept apart from main.py, so the modules that read what it saved (e.g.
+slotreader.py, regrid.py, script_data_to_stdn.py) don't import the whole
+of processing along with them.'''
+
+import os
+import re
+import argparse
+import contextlib
+import numpy as np
+import chunkedio
+import sparseutils
+
+def get_load_filename(year, month, datadir="../decompressed"):
+    ''' Get the filename of the .csv holding the trips of the given (year, month)
+        (It can also be read from a .gz or .zip of it; see readers.find_source)'''
+    return os.path.join(datadir, "FOIL"+str(year), "trip_data_"+str(month)+".csv")
+
+def get_resolution_savedirs(resolutions, savedir="."):
+    ''' Map each (width, height, n) in resolutions to the directory to save
+        its .npz files to: savedir itself for a single resolution, or else a
+        subdirectory of savedir named after it, e.g. "5x10n2".'''
+    if len(resolutions) == 1:
+        return {resolutions[0] : savedir}
+    return {resolution : os.path.join(savedir, "%dx%dn%d" % resolution) for resolution in resolutions}
+
+def get_save_filename(year, month, savedir=".", save_format="npz"):
+    ''' Get the filename of the .npz (or, with save_format "chunked", the
+        .npzc; see chunkedio.py) to save the given (year, month) to'''
+    extension = chunkedio.extension if save_format == "chunked" else ".npz"
+    return os.path.join(savedir, str(year)+"-"+str(month).zfill(2)+"-data"+extension)
+
+def get_checkpoint_filename(year, month, savedir="."):
+    ''' Get the filename of the checkpoint of the given (year, month), saved
+        next to its data file with resume (see process): the spill of it
+        and every month before it into the months after it. Once it
+        exists, the month is done.'''
+    return os.path.join(savedir, str(year)+"-"+str(month).zfill(2)+"-checkpoint.npz")
+
+def get_stdn_filename(year, month, name, savedir=".", save_format="npz"):
+    ''' Get the filename of the STDN-(name)-(year)-(month).npz (or .npzc)
+        to save the trip counts of the given (year, month) to, where name
+        is "volume" (for vdata) or "flow" (for fdata)'''
+    extension = chunkedio.extension if save_format == "chunked" else ".npz"
+    return os.path.join(savedir, "STDN-%s-%d-%02d%s" % (name, year, month, extension))
+
+def save_arrays(filename, arrays, compressed=True, chunkslots=None):
+    ''' Save the dict of arrays (any of which may be sparse) to an .npz,
+        or to a chunked file if filename ends in .npzc (see chunkedio.py),
+        with chunkslots time slots in each chunk if given.'''
+    arrays = dict(arrays)
+    for key, array in list(arrays.items()):
+        if isinstance(array, sparseutils.SparseArray):
+            arrays.update(arrays.pop(key).to_arrays(key))
+    if chunkedio.is_chunked(filename):
+        chunkedio.save_chunked(filename, arrays, chunkslots=chunkslots)
+    elif compressed:
+        np.savez_compressed(filename, **arrays)
+    else:
+        np.savez(filename, **arrays)
+
+def load_arrays(filename, sparse=False):
+    ''' Load a dict of arrays saved with save_arrays.
+        If sparse, 'fdata' (and any other array saved sparse) is loaded as
+        a sparseutils.SparseArray.'''
+    with contextlib.ExitStack() as stack:
+        if chunkedio.is_chunked(filename):
+            data = chunkedio.load_chunked(filename)
+        else:
+            data = stack.enter_context(np.load(filename))
+        names = {key.split("_")[0] for key in data}
+        arrays = {name : sparseutils.load_array(data, name, dense=not sparse)
+                  if name == "fdata" or sparseutils.is_sparse(data, name) else data[name] for name in names}
+    return arrays
+
+def save_stdn(year, month, vdata, fdata, savedir=".", save_format="npz", chunkslots=None):
+    ''' Save the trip counts vdata and fdata (see main.get_stdn_arrays) of the
+        given (year, month) to its STDN-volume and STDN-flow files, as
+        script_data_to_stdn.py does. Returns the filenames.'''
+    filenames = []
+    for name, array, axis in (("volume", vdata, 0), ("flow", fdata, 1)):
+        filename = get_stdn_filename(year=year, month=month, name=name, savedir=savedir, save_format=save_format)
+        if chunkedio.is_chunked(filename):
+            chunkedio.save_chunked(filename, {'arr_0' : array}, axes={'arr_0' : axis}, chunkslots=chunkslots)
+        else:
+            np.savez_compressed(filename, array)
+        filenames.append(filename)
+    return filenames
+
+def parse_resolution(string):
+    ''' Parse a resolution given as "WIDTHxHEIGHTnN" (e.g. "5x10n2")
+        into a (width, height, n) tuple.'''
+    match = re.fullmatch(r"(\d+)x(\d+)n(\d+)", string)
+    if match is None:
+        raise argparse.ArgumentTypeError("resolution should look like 5x10n2, not " + repr(string))
+    return tuple(int(value) for value in match.groups())
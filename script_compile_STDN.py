@@ -1,134 +1,134 @@
+import os
+import zipfile
+import argparse
 import numpy as np
+import chunkedio
 from utils import generate_dates
 
 ''' Use this to take all the individual STDN files in data/
     and put them into four large numpy arrays
-'''
-
 
-# First batch of filenames
-fns_f = ["STDN-flow-2010-01.npz",
-        "STDN-flow-2010-02.npz",
-        "STDN-flow-2010-03.npz",
-        "STDN-flow-2010-04.npz",
-        "STDN-flow-2010-05.npz",
-        "STDN-flow-2010-06.npz",
-        "STDN-flow-2010-07.npz",
-        "STDN-flow-2010-08.npz",
-        "STDN-flow-2010-09.npz",
-        "STDN-flow-2010-10.npz",
-        "STDN-flow-2010-11.npz",
-        "STDN-flow-2010-12.npz",
-        "STDN-flow-2011-01.npz",
-        "STDN-flow-2011-02.npz",
-        "STDN-flow-2011-03.npz",
-        "STDN-flow-2011-04.npz",
-        "STDN-flow-2011-05.npz",
-        "STDN-flow-2011-06.npz",
-        "STDN-flow-2011-07.npz",
-        "STDN-flow-2011-08.npz",
-        "STDN-flow-2011-09.npz",
-        "STDN-flow-2011-10.npz",
-        "STDN-flow-2011-11.npz",
-        "STDN-flow-2011-12.npz",
-        "STDN-flow-2012-01.npz",
-        "STDN-flow-2012-02.npz",
-        "STDN-flow-2012-03.npz",
-        "STDN-flow-2012-04.npz",
-        "STDN-flow-2012-05.npz",
-        "STDN-flow-2012-06.npz",
-        "STDN-flow-2012-07.npz",
-        "STDN-flow-2012-08.npz",
-        "STDN-flow-2012-09.npz",
-        "STDN-flow-2012-10.npz",
-        "STDN-flow-2012-11.npz",
-        "STDN-flow-2012-12.npz",
-        "STDN-flow-2013-01.npz",
-        "STDN-flow-2013-02.npz",
-        "STDN-flow-2013-03.npz",
-        "STDN-flow-2013-04.npz",
-        "STDN-flow-2013-05.npz",
-        "STDN-flow-2013-06.npz",
-        "STDN-flow-2013-07.npz",
-        "STDN-flow-2013-08.npz",
-        "STDN-flow-2013-09.npz",
-        "STDN-flow-2013-10.npz",
-        "STDN-flow-2013-11.npz",
-        "STDN-flow-2013-12.npz"]
+Each month is read from its .npz and written into its slice of one
+preallocated, memory-mapped .npy (so only about one month is in memory
+at a time), which is then compressed into the .npz (or, with --format
+chunked, a .npzc; see chunkedio.py), unless --format npy. The monthly
+files can be .npz or .npzc.
+'''
 
-fns_v = ["STDN-volume-2010-01.npz",
-        "STDN-volume-2010-02.npz",
-        "STDN-volume-2010-03.npz",
-        "STDN-volume-2010-04.npz",
-        "STDN-volume-2010-05.npz",
-        "STDN-volume-2010-06.npz",
-        "STDN-volume-2010-07.npz",
-        "STDN-volume-2010-08.npz",
-        "STDN-volume-2010-09.npz",
-        "STDN-volume-2010-10.npz",
-        "STDN-volume-2010-11.npz",
-        "STDN-volume-2010-12.npz",
-        "STDN-volume-2011-01.npz",
-        "STDN-volume-2011-02.npz",
-        "STDN-volume-2011-03.npz",
-        "STDN-volume-2011-04.npz",
-        "STDN-volume-2011-05.npz",
-        "STDN-volume-2011-06.npz",
-        "STDN-volume-2011-07.npz",
-        "STDN-volume-2011-08.npz",
-        "STDN-volume-2011-09.npz",
-        "STDN-volume-2011-10.npz",
-        "STDN-volume-2011-11.npz",
-        "STDN-volume-2011-12.npz",
-        "STDN-volume-2012-01.npz",
-        "STDN-volume-2012-02.npz",
-        "STDN-volume-2012-03.npz",
-        "STDN-volume-2012-04.npz",
-        "STDN-volume-2012-05.npz",
-        "STDN-volume-2012-06.npz",
-        "STDN-volume-2012-07.npz",
-        "STDN-volume-2012-08.npz",
-        "STDN-volume-2012-09.npz",
-        "STDN-volume-2012-10.npz",
-        "STDN-volume-2012-11.npz",
-        "STDN-volume-2012-12.npz",
-        "STDN-volume-2013-01.npz",
-        "STDN-volume-2013-02.npz",
-        "STDN-volume-2013-03.npz",
-        "STDN-volume-2013-04.npz",
-        "STDN-volume-2013-05.npz",
-        "STDN-volume-2013-06.npz",
-        "STDN-volume-2013-07.npz",
-        "STDN-volume-2013-08.npz",
-        "STDN-volume-2013-09.npz",
-        "STDN-volume-2013-10.npz",
-        "STDN-volume-2013-11.npz",
-        "STDN-volume-2013-12.npz"]
+def read_npz_header(filename, key="arr_0"):
+    ''' Return (shape, dtype) of the array key in the .npz at filename,
+        from the header of the .npy inside it, without loading the array.
+        (Or from the .npzc at filename; see chunkedio.py)'''
+    if chunkedio.is_chunked(filename):
+        return chunkedio.read_chunked_header(filename, key)
+    with zipfile.ZipFile(filename) as archive:
+        with archive.open(key + ".npy") as read_f:
+            version = np.lib.format.read_magic(read_f)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(read_f)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(read_f)
+    return shape, dtype
 
-# vdata
-# Load from the first line
-print("Loading from", fns_v[0])
-vdata = np.load("data/" + fns_v[0])['arr_0']
-# And then concate from the rest of the lines
-for fname in fns_v[1:]:
-    print("Loading from", fname)
-    vdata = np.concatenate((vdata, np.load("data/" + fname)['arr_0']), axis=0)
+def compile_months(filenames, save_filename, axis, key="arr_0"):
+    ''' Concatenate the arrays in the .npz files along axis, into the .npy
+        at save_filename, one file at a time.
 
-print("Saving to STDN-volume.npz")
-np.savez_compressed("data/STDN-volume.npz",vdata)
-del(vdata) # Free from memory!
+    # Arguments:
+        filenames: List of the .npz files, in order.
+        save_filename: The .npy file to write, as a memory map.
+        axis: The axis to concatenate along (the time slot axis).
+        key: The name of the array in each .npz.
+    # Returns:
+        The compiled array, as a read-only memory map of save_filename.
+    '''
+    headers = [read_npz_header(filename, key=key) for filename in filenames]
+    shape, dtype = headers[0]
+    for filename, (month_shape, month_dtype) in zip(filenames, headers):
+        if (month_shape[:axis] + month_shape[axis+1:] != shape[:axis] + shape[axis+1:]) or month_dtype != dtype:
+            raise ValueError("Can't concatenate " + filename + " of shape " + str(month_shape) +
+                             " and dtype " + str(month_dtype) + " with shape " + str(shape) +
+                             " and dtype " + str(dtype))
+    total = sum(month_shape[axis] for (month_shape, _) in headers)
 
+    compiled = np.lib.format.open_memmap(save_filename, mode="w+", dtype=dtype,
+                                         shape=shape[:axis] + (total,) + shape[axis+1:])
+    start = 0
+    for filename, (month_shape, _) in zip(filenames, headers):
+        print("Loading from", filename)
+        index = [slice(None)] * len(shape)
+        index[axis] = slice(start, start + month_shape[axis])
+        if chunkedio.is_chunked(filename):
+            compiled[tuple(index)] = chunkedio.load_chunked(filename, keys=[key])[key]
+        else:
+            with np.load(filename) as data:
+                compiled[tuple(index)] = data[key]
+        start += month_shape[axis]
+    compiled.flush()
+    del compiled
+    return np.load(save_filename, mmap_mode="r")
 
-# fdata
-# Load from the first line
-fdata = np.load("data/" + fns_f[0])['arr_0']
+def compile_stdn(startyear=2010, startmonth=1, endyear=2013, endmonth=12, datadir="data", save_format="npz"):
+    ''' Compile the STDN-volume-*.npz and STDN-flow-*.npz files in datadir
+        from (startyear, startmonth) to (endyear, endmonth) into
+        STDN-volume and STDN-flow, saved as .npz (compressed, like the
+        monthly files), .npzc ("chunked"; see chunkedio.py) or as .npy
+        (which can be memory-mapped). Monthly .npzc files are used instead
+        of the .npz ones if they exist. Returns nothing.'''
+    dates = generate_dates(startyear, startmonth, endyear, endmonth)
+    # (name, axis of the time slots)
+    for name, axis in (("volume", 0), ("flow", 1)):
+        filenames = []
+        for (year, month) in dates:
+            filename = os.path.join(datadir, "STDN-%s-%d-%02d" % (name, year, month))
+            filenames.append(filename + (chunkedio.extension if os.path.exists(filename + chunkedio.extension) else ".npz"))
+        if save_format == "npy":
+            save_filename = os.path.join(datadir, "STDN-" + name + ".npy")
+            compile_months(filenames, save_filename, axis=axis)
+            print("Saved to", save_filename)
+            continue
 
-# And then concate from the rest of the lines
-for fname in fns_f[1:]:
-    print("Loading from",fname)
-    fdata = np.concatenate((fdata, np.load("data/" + fname)['arr_0']), axis=1)
+        npy_filename = os.path.join(datadir, "STDN-" + name + ".tmp.npy")
+        try:
+            compiled = compile_months(filenames, npy_filename, axis=axis)
+            if save_format == "chunked":
+                print("Saving to STDN-" + name + chunkedio.extension)
+                chunkedio.save_chunked(os.path.join(datadir, "STDN-" + name + chunkedio.extension),
+                                       {'arr_0' : compiled}, axes={'arr_0' : axis})
+            else:
+                print("Saving to STDN-" + name + ".npz")
+                # (Written to the .npz in chunks, straight from the memory map)
+                np.savez_compressed(os.path.join(datadir, "STDN-" + name + ".npz"), compiled)
+            del compiled
+        finally:
+            if os.path.exists(npy_filename):
+                os.remove(npy_filename)
 
-print("Saving to STDN-flow.npz")
-np.savez_compressed("data/STDN-flow.npz",fdata)
-del(fdata) # Free from memory!
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile the monthly STDN files into single arrays")
+    parser.add_argument("--startyear", "-sy",
+                        help="Year to start compiling from. Default 2010",
+                        type=int, nargs=1)
+    parser.add_argument("--startmonth", "-sm",
+                        help="Month to start compiling from. Default 1.",
+                        type=int, nargs=1)
+    parser.add_argument("--endyear", "-ey",
+                        help="Year to finish compiling (inclusive). Default 2013.",
+                        type=int, nargs=1)
+    parser.add_argument("--endmonth", "-em",
+                        help="Month to finish compiling (inclusive). Default 12.",
+                        type=int, nargs=1)
+    parser.add_argument("--datadir", "-d",
+                        help="Directory holding the STDN-*.npz files, and to save to. (Default data)",
+                        type=str, nargs=1)
+    parser.add_argument("--format", "-f",
+                        help="'npz' saves STDN-volume.npz and STDN-flow.npz, compressed. 'chunked' saves .npzc files, compressed in parallel (see chunkedio.py). 'npy' saves uncompressed .npy files, which can be loaded with np.load(..., mmap_mode='r'). (Default npz)",
+                        choices=["npz", "chunked", "npy"], nargs=1)
+    args = parser.parse_args()
 
+    compile_stdn(startyear   = 2010  if args.startyear   is None else args.startyear[0],
+                 startmonth  = 1     if args.startmonth  is None else args.startmonth[0],
+                 endyear     = 2013  if args.endyear     is None else args.endyear[0],
+                 endmonth    = 12    if args.endmonth    is None else args.endmonth[0],
+                 datadir     = "data" if args.datadir    is None else args.datadir[0],
+                 save_format = "npz" if args.format      is None else args.format[0])
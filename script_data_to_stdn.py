@@ -1,76 +1,108 @@
+import os
+import argparse
+import concurrent.futures
 import numpy as np
-from utils import generate_dates
+import chunkedio
+from utils import generate_dates, no_days_in_mo
+from savefiles import get_stdn_filename, save_stdn
+from slotreader import get_data_filename, read_header, iter_slabs
 
 '''
 After being run through the data processor, use this script to:
     1. Remove the pcount/tcount axis, looking only at the trip count.
 This assumes all data is in a /data folder.
 
+fdata is read a slab of time slots at a time, and its trip counts are
+written into a memory-mapped .npy before being compressed, so neither
+the whole fdata nor its pcount channel is ever in memory. Months are
+converted in parallel with --jobs, with slabs sized so that all the jobs
+together hold about --memory bytes of them.
+(main.py --stdn saves these files directly, without the full files.)
+
 Use 'script_compile_STDN' to further compile this data.
 '''
 
-fnames = ["2010-01-data.npz",
-          "2010-02-data.npz",
-          "2010-03-data.npz",
-          "2010-04-data.npz",
-          "2010-05-data.npz",
-          "2010-06-data.npz",
-          "2010-07-data.npz",
-          "2010-08-data.npz",
-          "2010-09-data.npz",
-          "2010-10-data.npz",
-          "2010-11-data.npz",
-          "2010-12-data.npz",
-          "2011-01-data.npz",
-          "2011-02-data.npz",
-          "2011-03-data.npz",
-          "2011-04-data.npz",
-          "2011-05-data.npz",
-          "2011-06-data.npz",
-          "2011-07-data.npz",
-          "2011-08-data.npz",
-          "2011-09-data.npz",
-          "2011-10-data.npz",
-          "2011-11-data.npz",
-          "2011-12-data.npz",
-          "2012-01-data.npz",
-          "2012-02-data.npz",
-          "2012-03-data.npz",
-          "2012-04-data.npz",
-          "2012-05-data.npz",
-          "2012-06-data.npz",
-          "2012-07-data.npz",
-          "2012-08-data.npz",
-          "2012-09-data.npz",
-          "2012-10-data.npz",
-          "2012-11-data.npz",
-          "2012-12-data.npz",
-          "2013-01-data.npz",
-          "2013-02-data.npz",
-          "2013-03-data.npz",
-          "2013-04-data.npz",
-          "2013-05-data.npz",
-          "2013-06-data.npz",
-          "2013-07-data.npz",
-          "2013-08-data.npz",
-          "2013-09-data.npz",
-          "2013-10-data.npz",
-          "2013-11-data.npz",
-          "2013-12-data.npz"]
+def convert_month(year, month, datadir="data", save_format="npz", memory=1<<30):
+    ''' Save the trip counts of the processed (year, month) in datadir to its
+        STDN-volume and STDN-flow files, reading fdata in slabs of about
+        memory bytes. Returns the filenames.'''
+    filename = get_data_filename(year=year, month=month, savedir=datadir)
+    if chunkedio.is_chunked(filename):
+        vdata = chunkedio.load_chunked(filename, keys=["vdata"])['vdata'][..., 1]
+    else:
+        with np.load(filename) as data:
+            vdata = data['vdata'][..., 1]
+    shape, dtype = read_header(filename, "fdata")
+    slot_bytes = int(np.prod(shape[2:], dtype=np.int64)) * dtype.itemsize
+    # (Two kinds per slot, and the trip counts of a slab are copied once more)
+    slab_slots = max(1, memory // (3 * slot_bytes))
+    n = vdata.shape[0] // (no_days_in_mo(year=year, month=month) * 24)
 
+    npy_filename = get_stdn_filename(year=year, month=month, name="flow", savedir=datadir) + ".tmp.npy"
+    try:
+        fdata = np.lib.format.open_memmap(npy_filename, mode="w+", dtype=dtype, shape=tuple(shape[:-1]))
+        for index, slab in iter_slabs(filename, "fdata", slab_slots):
+            fdata[index] = slab[..., 1]
+        fdata.flush()
+        return save_stdn(year=year, month=month, vdata=vdata, fdata=fdata, savedir=datadir,
+                         save_format=save_format, chunkslots=24*n)
+    finally:
+        fdata = None
+        if os.path.exists(npy_filename):
+            os.remove(npy_filename)
 
-for fname in fnames:
-    datestr = fname[0:7]
-    data = np.load("data/"+fname)
+def data_to_stdn(startyear=2010, startmonth=1, endyear=2013, endmonth=12, datadir="data", save_format="npz",
+                 jobs=1, memory=1<<30):
+    ''' Convert the processed months from (startyear, startmonth) to
+        (endyear, endmonth) in datadir to STDN-volume and STDN-flow files
+        (see convert_month), jobs months at a time, using about memory bytes
+        in all. Returns nothing.'''
+    dates = generate_dates(startyear, startmonth, endyear, endmonth)
+    if jobs <= 1:
+        for (year, month) in dates:
+            print("Converting", year, month)
+            print("Saved", " and ".join(convert_month(year=year, month=month, datadir=datadir,
+                                                      save_format=save_format, memory=memory)))
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(convert_month, year=year, month=month, datadir=datadir,
+                                   save_format=save_format, memory=memory // jobs) for (year, month) in dates]
+        for future in futures:
+            print("Saved", " and ".join(future.result()))
 
-    vdata = data['vdata'][:,:,:,:,1]
-    fdata = data['fdata'][:,:,:,:,:,:,1]
-    
-    # Assuming vdata and fdata have the same size/resolution!!
-    samples = vdata.shape[0]
-    w = vdata.shape[1]
-    h = vdata.shape[2]
-    n = 2
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Save the trip counts of the processed months as STDN files")
+    parser.add_argument("--startyear", "-sy",
+                        help="Year to start converting from. Default 2010",
+                        type=int, nargs=1)
+    parser.add_argument("--startmonth", "-sm",
+                        help="Month to start converting from. Default 1.",
+                        type=int, nargs=1)
+    parser.add_argument("--endyear", "-ey",
+                        help="Year to finish converting (inclusive). Default 2013.",
+                        type=int, nargs=1)
+    parser.add_argument("--endmonth", "-em",
+                        help="Month to finish converting (inclusive). Default 12.",
+                        type=int, nargs=1)
+    parser.add_argument("--datadir", "-d",
+                        help="Directory holding the (year)-(month)-data files, and to save to. (Default data)",
+                        type=str, nargs=1)
+    parser.add_argument("--format", "-f",
+                        help="'npz' saves with np.savez_compressed. 'chunked' saves .npzc files, compressed in parallel (see chunkedio.py). (Default npz)",
+                        choices=["npz", "chunked"], nargs=1)
+    parser.add_argument("--jobs", "-j",
+                        help="The number of months to convert in parallel. (Default 1)",
+                        type=int, nargs=1)
+    parser.add_argument("--memory", "-m",
+                        help="About how many MB of fdata to read at once, across all jobs. (Default 1024)",
+                        type=int, nargs=1)
+    args = parser.parse_args()
 
-    np.savez_compressed("data/STDN-volume-"+datestr+".npz", vdata)
-    np.savez_compressed("data/STDN-flow-"+datestr+".npz", fdata)
+    data_to_stdn(startyear   = 2010  if args.startyear   is None else args.startyear[0],
+                 startmonth  = 1     if args.startmonth  is None else args.startmonth[0],
+                 endyear     = 2013  if args.endyear     is None else args.endyear[0],
+                 endmonth    = 12    if args.endmonth    is None else args.endmonth[0],
+                 datadir     = "data" if args.datadir    is None else args.datadir[0],
+                 save_format = "npz" if args.format      is None else args.format[0],
+                 jobs        = 1     if args.jobs        is None else args.jobs[0],
+                 memory      = (1024 if args.memory      is None else args.memory[0]) << 20)
@@ -0,0 +1,115 @@
+''' An array that is accumulated in memory only a few hours at a time.
+
+While a month is processed, vdata and fdata get updates at the time slots
+of the trips being read. Trips are roughly sorted by pickup time, so once
+the trips being read start well after a time slot, it (almost) never gets
+updated again. A SlabArray keeps only a window of slabs (blocks of time
+slots) in memory as dense arrays, writes each slab to a memory-mapped .npy
+once the trips being read start more than lag slots after it (the
+watermark), and keeps updates outside the window (late trips, or trips
+that end far ahead) in a small SparseArray of corrections, added in at the
+end. The result is exactly the array accumulating everything in memory
+would have given.
+'''
+
+import os
+import numpy as np
+import sparseutils
+
+class SlabArray:
+    ''' An array of a given shape, accumulated through add_at (like a
+        sparseutils.SparseArray) into a memory-mapped .npy at filename.
+
+    # Arguments:
+        filename: The .npy file to write the array to.
+        shape: Tuple of ints, the shape of the array.
+        dtype: The dtype of the array. (Default int16)
+        axis: The time slot axis. (0 for vdata, 1 for fdata)
+        slabslots: The number of time slots in a slab. (E.g. n, one hour)
+        maxslabs: The number of slabs kept in memory, from the watermark on.
+        lag: How many slots before the (median) start slot of the trips
+            being read the watermark is. (See advance_watermark)
+    '''
+    def __init__(self, filename, shape, dtype=np.int16, axis=0, slabslots=4, maxslabs=12, lag=12):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.axis = axis
+        self.slabslots = slabslots
+        self.maxslabs = maxslabs
+        self.lag = lag
+        self.out = np.lib.format.open_memmap(filename, mode="w+", dtype=self.dtype, shape=self.shape)
+        self.flushed = 0 # Slots before this are written to out
+        self.slabs = {} # Slab number : dense array of its slots
+        self.corrections = sparseutils.SparseArray(self.shape, dtype=self.dtype)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _slab_shape(self, slab):
+        shape = list(self.shape)
+        shape[self.axis] = min(self.slabslots, self.shape[self.axis] - slab * self.slabslots)
+        return tuple(shape)
+
+    def add_at(self, index, values):
+        ''' Like np.add.at(dense, index, values), for a tuple of index arrays.'''
+        index = tuple(np.asarray(ii, dtype=np.int64) for ii in index)
+        values = np.broadcast_to(np.asarray(values), index[0].shape)
+        slots = index[self.axis]
+        in_window = (slots >= self.flushed) & (slots < self.flushed + self.maxslabs * self.slabslots)
+        if not in_window.all():
+            self.corrections.add_at(tuple(ii[~in_window] for ii in index), values[~in_window])
+        slab_numbers = slots[in_window] // self.slabslots
+        index = tuple(ii[in_window] for ii in index)
+        values = values[in_window]
+        for slab in np.unique(slab_numbers):
+            mask = slab_numbers == slab
+            if slab not in self.slabs:
+                self.slabs[slab] = np.zeros(self._slab_shape(slab), dtype=self.dtype)
+            local = list(ii[mask] for ii in index)
+            local[self.axis] = local[self.axis] - slab * self.slabslots
+            data = self.slabs[slab]
+            np.add.at(data.reshape(-1), np.ravel_multi_index(tuple(local), data.shape), values[mask].astype(self.dtype))
+
+    def _write_slab(self, slab):
+        index = [slice(None)] * self.ndim
+        index[self.axis] = slice(slab * self.slabslots, slab * self.slabslots + self.slabs[slab].shape[self.axis])
+        self.out[tuple(index)] = self.slabs.pop(slab)
+
+    def advance_watermark(self, start_slots):
+        ''' Given the start slots of the trips just read, write out the slabs
+            that end more than lag slots before their median. Later updates
+            to those slots go to the corrections.'''
+        if len(start_slots) == 0:
+            return
+        watermark = int(np.median(start_slots)) - self.lag
+        flushed = max(self.flushed, (watermark // self.slabslots) * self.slabslots)
+        if flushed == self.flushed:
+            return
+        for slab in sorted(self.slabs):
+            if (slab + 1) * self.slabslots <= flushed:
+                self._write_slab(slab)
+        self.flushed = flushed
+
+    def finish(self):
+        ''' Write out the rest of the slabs and add in the corrections.
+            Returns the array, a numpy memory map of filename.'''
+        for slab in sorted(self.slabs):
+            self._write_slab(slab)
+        self.flushed = self.shape[self.axis]
+        index, values = self.corrections.index, self.corrections.values
+        flat = self.out.reshape(-1)
+        # Summed as int64; converting back wraps around as accumulating would have
+        flat[index] = (flat[index].astype(np.int64) + values).astype(self.dtype)
+        self.corrections = sparseutils.SparseArray(self.shape, dtype=self.dtype)
+        self.out.flush()
+        return self.out
+
+def remove_files(arrays):
+    ''' Remove the files of the memory maps (e.g. from SlabArray.finish) in
+        the dict of arrays. Returns nothing.'''
+    for array in arrays.values():
+        if isinstance(array, np.memmap) and array.filename is not None and os.path.exists(array.filename):
+            # (The memory map stays usable until it is garbage collected)
+            os.remove(array.filename)
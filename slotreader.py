@@ -0,0 +1,342 @@
+''' Read a range of time slots of vdata or fdata across many months.
+
+main.py saves one file per month, with each month's time slots numbered
+from 0. A SlotReader numbers the slots of a range of months as one
+timeline (slot 0 is the first slot of the first month), and reads any
+range of it, e.g. a random training window. With chunked files (main.py
+--format chunked, which puts one day of slots in each chunk), only the
+chunks holding the range are decompressed; .npz files are decompressed
+whole. Sparse fdata (--sparse) is densified for the range only.
+
+A MonthlyDataset goes further, and exposes vdata and fdata of all the
+months as two (lazy) arrays, which can be indexed like numpy arrays
+(e.g. dataset.fdata[:, t0:t1]) without ever holding more than a few
+months in memory: decoded months are kept in an LRU cache of a given
+size. Both can also read the STDN-volume/STDN-flow files made by
+script_data_to_stdn.py.
+
+iter_slabs reads a whole array of one month a slab of time slots at a
+time instead (even from an .npz), for tools that convert months without
+holding them in memory.
+'''
+
+import os
+import zipfile
+import collections
+import numpy as np
+import utils
+import chunkedio
+import sparseutils
+from savefiles import get_save_filename, get_stdn_filename
+
+def get_data_filename(year, month, savedir="."):
+    ''' Return the file main.py saved (year, month) to in savedir: the
+        .npzc if it exists, else the .npz.'''
+    filename = get_save_filename(year=year, month=month, savedir=savedir, save_format="chunked")
+    if os.path.exists(filename):
+        return filename
+    return get_save_filename(year=year, month=month, savedir=savedir)
+
+def _sparse_keys(name):
+    return [name + suffix for suffix in ("_shape", "_dtype", "_index", "_values")]
+
+def _read_npy_header(read_f):
+    # (shape, dtype, fortran_order) from the header of an .npy file object
+    version = np.lib.format.read_magic(read_f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(read_f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(read_f)
+    return shape, dtype, fortran_order
+
+def read_header(filename, name):
+    ''' Return (shape, dtype) of the array name in the file at filename
+        (dense or sparse, .npz or .npzc), without loading it.'''
+    if chunkedio.is_chunked(filename):
+        if not sparseutils.is_sparse(chunkedio.read_chunked_names(filename), name):
+            return chunkedio.read_chunked_header(filename, name)
+        data = chunkedio.load_chunked(filename, keys=[name + "_shape", name + "_dtype"])
+        return tuple(data[name + "_shape"]), np.dtype(str(data[name + "_dtype"]))
+    with np.load(filename) as data:
+        if sparseutils.is_sparse(data, name):
+            return tuple(data[name + "_shape"]), np.dtype(str(data[name + "_dtype"]))
+    with zipfile.ZipFile(filename) as archive:
+        with archive.open(name + ".npy") as read_f:
+            return _read_npy_header(read_f)[:2]
+
+def iter_slabs(filename, name, slab_slots):
+    ''' Read the array name (e.g. 'fdata', with its time slots in axis 1;
+        or 'vdata', in axis 0) from the file at filename, slab_slots time
+        slots at a time. Yields (index, slab), where slab is array[index].
+        (From an .npz, the .npy inside is decompressed as a stream, so only a
+        slab is in memory at a time. A sparse array is densified by slabs.)'''
+    axis = 1 if name.startswith("fdata") else 0
+    if chunkedio.is_chunked(filename):
+        if not sparseutils.is_sparse(chunkedio.read_chunked_names(filename), name):
+            shape, _ = chunkedio.read_chunked_header(filename, name)
+            for start in range(0, shape[axis], slab_slots):
+                end = min(start + slab_slots, shape[axis])
+                yield (slice(None),) * axis + (slice(start, end),), chunkedio.load_range(filename, name, start, end)
+            return
+        array = sparseutils.SparseArray.from_arrays(chunkedio.load_chunked(filename, keys=_sparse_keys(name)), name)
+    else:
+        with np.load(filename) as data:
+            array = sparseutils.SparseArray.from_arrays(data, name) if sparseutils.is_sparse(data, name) else None
+        if array is None:
+            with zipfile.ZipFile(filename) as archive:
+                with archive.open(name + ".npy") as read_f:
+                    shape, dtype, fortran_order = _read_npy_header(read_f)
+                    if fortran_order:
+                        raise ValueError("Can't read " + name + " from " + filename + ": it is in Fortran order.")
+                    slot_size = int(np.prod(shape[axis+1:], dtype=np.int64))
+                    # (C order: for fdata, all the slots of kind 0, then of kind 1)
+                    for before in np.ndindex(*shape[:axis]):
+                        for start in range(0, shape[axis], slab_slots):
+                            end = min(start + slab_slots, shape[axis])
+                            slab = np.frombuffer(read_f.read((end - start) * slot_size * dtype.itemsize), dtype=dtype)
+                            yield before + (slice(start, end),), slab.reshape((end - start,) + tuple(shape[axis+1:]))
+            return
+    for start in range(0, array.shape[axis], slab_slots):
+        end = min(start + slab_slots, array.shape[axis])
+        yield (slice(None),) * axis + (slice(start, end),), array.dense_range(start, end, axis=axis)
+
+class SlotReader:
+    ''' Reads ranges of time slots from the files saved by main.py.
+
+    # Arguments:
+        savedir: The directory holding the (year)-(month)-data files.
+        startyear, startmonth, endyear, endmonth: The months to read from,
+            inclusive, as with main.py.
+        n: The number of slots in an hour the files were processed with.
+        workers: Number of threads to decompress with. (Default: one per CPU)
+        stdn: If True, read vdata from the STDN-volume-(year)-(month) files
+            and fdata from the STDN-flow-(year)-(month) files in savedir
+            instead. (See script_data_to_stdn.py)
+    '''
+    def __init__(self, savedir=".", startyear=2010, startmonth=1, endyear=2013, endmonth=12, n=4, workers=None,
+                 stdn=False):
+        self.savedir = savedir
+        self.n = n
+        self.workers = workers
+        self.stdn = stdn
+        self.dates = utils.generate_dates(startyear, startmonth, endyear, endmonth)
+        # offsets[ii] is the slot that month ii starts at (and offsets[-1] the total)
+        self.offsets = np.cumsum([0] + [utils.no_samples_in_mo(year=year, month=month, n=n)
+                                        for (year, month) in self.dates])
+
+    @property
+    def slots(self):
+        ''' The total number of time slots.'''
+        return int(self.offsets[-1])
+
+    def slot(self, year, month, t=0):
+        ''' Return the slot number of time slot t of (year, month).'''
+        return int(self.offsets[self.dates.index((year, month))]) + t
+
+    def get_filename(self, year, month, name="vdata"):
+        ''' Return the file the array name of (year, month) is read from:
+            the .npzc if it exists, else the .npz.'''
+        if self.stdn:
+            stdn_name = "flow" if name.startswith("fdata") else "volume"
+            filename = get_stdn_filename(year=year, month=month, name=stdn_name, savedir=self.savedir,
+                                         save_format="chunked")
+            if os.path.exists(filename):
+                return filename
+            return get_stdn_filename(year=year, month=month, name=stdn_name, savedir=self.savedir)
+        return get_data_filename(year=year, month=month, savedir=self.savedir)
+
+    def get_key(self, name):
+        ''' Return the name the array name is stored under in its file.'''
+        return "arr_0" if self.stdn else name
+
+    def read_month(self, year, month, name, start, end):
+        ''' Return slots start to end (exclusive) of the array name
+            ('vdata' or 'fdata') of (year, month), as a dense array.'''
+        filename = self.get_filename(year, month, name)
+        axis = 1 if name.startswith("fdata") else 0
+        key = self.get_key(name)
+        if chunkedio.is_chunked(filename):
+            names = chunkedio.read_chunked_names(filename)
+            if not sparseutils.is_sparse(names, key):
+                return chunkedio.load_range(filename, key, start, end, workers=self.workers)
+            data = chunkedio.load_chunked(filename, keys=_sparse_keys(key), workers=self.workers)
+            return sparseutils.SparseArray.from_arrays(data, key).dense_range(start, end, axis=axis)
+        with np.load(filename) as data:
+            if sparseutils.is_sparse(data, key):
+                return sparseutils.SparseArray.from_arrays(data, key).dense_range(start, end, axis=axis)
+            index = [slice(None)] * data[key].ndim
+            index[axis] = slice(start, end)
+            return data[key][tuple(index)]
+
+    def read(self, name, start_slot, end_slot):
+        ''' Return slots start_slot to end_slot (exclusive) of the array name
+            ('vdata' or 'fdata'), concatenated across months along the time
+            slot axis (0 for vdata, 1 for fdata).'''
+        if not 0 <= start_slot <= end_slot <= self.slots:
+            raise ValueError("Can't read slots " + str(start_slot) + " to " + str(end_slot) +
+                             " of " + str(self.slots))
+        axis = 1 if name.startswith("fdata") else 0
+        first = min(int(np.searchsorted(self.offsets, start_slot, side="right")) - 1, len(self.dates) - 1)
+        parts = []
+        for ii in range(first, len(self.dates)):
+            offset = int(self.offsets[ii])
+            if offset >= end_slot and parts:
+                break
+            year, month = self.dates[ii]
+            parts.append(self.read_month(year, month, name,
+                                         start = max(start_slot, offset) - offset,
+                                         end   = min(end_slot, int(self.offsets[ii+1])) - offset))
+        return np.concatenate(parts, axis=axis)
+
+class MonthlyDataset(SlotReader):
+    ''' The months of data saved by main.py (or script_data_to_stdn.py),
+        as lazy arrays vdata and fdata spanning all of them.
+
+        E.g. dataset.vdata[t0:t1] and dataset.fdata[:, t0:t1, 2, 3] are the
+        same as indexing the arrays concatenated across months (along their
+        time slot axes), where t0 and t1 are slot numbers (see slot). Only
+        the months holding the slots are loaded. Decoded months are kept in
+        an LRU cache of up to cachebytes bytes. (Sparse fdata is cached
+        sparse, and densified for the slots read only.)
+
+    # Arguments:
+        cachebytes: The most (decoded) bytes to keep in the cache.
+            (Default 2GB, about two months of fdata at 10x20)
+        The other arguments are as with SlotReader.
+    '''
+    def __init__(self, savedir=".", startyear=2010, startmonth=1, endyear=2013, endmonth=12, n=4, workers=None,
+                 stdn=False, cachebytes=2<<30):
+        super().__init__(savedir=savedir, startyear=startyear, startmonth=startmonth, endyear=endyear,
+                         endmonth=endmonth, n=n, workers=workers, stdn=stdn)
+        self.cachebytes = cachebytes
+        self.cache = collections.OrderedDict() # (name, month index) : decoded month
+        self.cached_bytes = 0
+        self.vdata = LazyArray(self, "vdata")
+        self.fdata = LazyArray(self, "fdata")
+
+    def __getstate__(self):
+        # (E.g. to send to a worker process; the cache stays behind)
+        state = dict(self.__dict__)
+        state['cache'] = collections.OrderedDict()
+        state['cached_bytes'] = 0
+        return state
+
+    def month_header(self, ii, name):
+        ''' Return (shape, dtype) of the array name of month ii, without
+            loading it.'''
+        return read_header(self.get_filename(*self.dates[ii], name=name), self.get_key(name))
+
+    def load_month(self, ii, name):
+        ''' Return the array name of month ii (a numpy array, or a
+            SparseArray if it was saved sparse), from the cache if it is there.
+            (A numpy array is read-only, as it is shared through the cache)'''
+        if (name, ii) in self.cache:
+            self.cache.move_to_end((name, ii))
+            return self.cache[(name, ii)]
+        filename = self.get_filename(*self.dates[ii], name=name)
+        key = self.get_key(name)
+        if chunkedio.is_chunked(filename):
+            names = chunkedio.read_chunked_names(filename)
+            keys = _sparse_keys(key) if sparseutils.is_sparse(names, key) else [key]
+            month = sparseutils.load_array(chunkedio.load_chunked(filename, keys=keys, workers=self.workers),
+                                           key, dense=not sparseutils.is_sparse(names, key))
+        else:
+            with np.load(filename) as data:
+                month = sparseutils.load_array(data, key, dense=not sparseutils.is_sparse(data, key))
+        
+        if isinstance(month, np.ndarray):
+            month.setflags(write=False)
+        size = month.index.nbytes + month.values.nbytes if isinstance(month, sparseutils.SparseArray) else month.nbytes
+        if size <= self.cachebytes:
+            while self.cached_bytes + size > self.cachebytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= evicted.index.nbytes + evicted.values.nbytes \
+                                     if isinstance(evicted, sparseutils.SparseArray) else evicted.nbytes
+            self.cache[(name, ii)] = month
+            self.cached_bytes += size
+        return month
+
+class LazyArray:
+    ''' The array name of a MonthlyDataset: all of its months, concatenated
+        along the time slot axis, loaded only when indexed.
+        Supports indexing with integers, slices (with positive steps) and
+        Ellipsis, like a numpy array.'''
+    def __init__(self, dataset, name):
+        self.dataset = dataset
+        self.name = name
+        self.axis = 1 if name.startswith("fdata") else 0
+        shape, self.dtype = dataset.month_header(0, name)
+        shape = list(shape)
+        shape[self.axis] = dataset.slots
+        self.shape = tuple(shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[...], dtype=dtype)
+
+    def _normalize(self, key):
+        # Return key as a list of one int or slice per axis
+        key = list(key) if isinstance(key, tuple) else [key]
+        if any(part is Ellipsis for part in key):
+            ii = [part is Ellipsis for part in key].index(True)
+            key = key[:ii] + [slice(None)] * (self.ndim - len(key) + 1) + key[ii+1:]
+        if len(key) > self.ndim:
+            raise IndexError("too many indices: " + str(self.ndim) + " dimensions, " + str(len(key)) + " indexed")
+        for part in key:
+            if not isinstance(part, (slice, int, np.integer)) or isinstance(part, bool):
+                raise IndexError("only integers, slices and Ellipsis are supported, not " + repr(part))
+        return key + [slice(None)] * (self.ndim - len(key))
+
+    def _index_month(self, ii, key, local):
+        # Index month ii with key, where local is the index into its time slot axis
+        month = self.dataset.load_month(ii, self.name)
+        if isinstance(month, sparseutils.SparseArray):
+            lo = local if isinstance(local, (int, np.integer)) else local.start
+            hi = lo + 1 if isinstance(local, (int, np.integer)) else local.stop
+            month = month.dense_range(lo, hi, axis=self.axis)
+            local = 0 if isinstance(local, (int, np.integer)) else slice(0, hi - lo, local.step)
+        key = list(key)
+        key[self.axis] = local
+        if isinstance(month, np.ndarray):
+            # (A copy, as slices across months are, not a view into the cache)
+            return month[tuple(key)].copy()
+        return month[tuple(key)]
+
+    def __getitem__(self, key):
+        key = self._normalize(key)
+        offsets = self.dataset.offsets
+        part = key[self.axis]
+        if not isinstance(part, slice):
+            t = int(part) + (self.dataset.slots if part < 0 else 0)
+            if not 0 <= t < self.dataset.slots:
+                raise IndexError("index " + str(part) + " is out of bounds for axis " + str(self.axis) +
+                                 " with size " + str(self.dataset.slots))
+            ii = int(np.searchsorted(offsets, t, side="right")) - 1
+            return self._index_month(ii, key, t - int(offsets[ii]))
+        
+        start, stop, step = part.indices(self.dataset.slots)
+        if step < 0:
+            raise IndexError("slices with negative steps are not supported")
+        parts = []
+        for ii in range(int(np.searchsorted(offsets, start, side="right")) - 1, len(self.dataset.dates)):
+            lo, hi = int(offsets[ii]), int(offsets[ii+1])
+            if lo >= stop:
+                break
+            # The first slot >= lo in start, start + step, ...
+            first = start + max(0, -(-(lo - start) // step)) * step
+            if first < min(stop, hi):
+                parts.append(self._index_month(ii, key, slice(first - lo, min(stop, hi) - lo, step)))
+        # The time slot axis of the result (integer indices remove axes)
+        axis = sum(1 for part in key[:self.axis] if isinstance(part, slice))
+        if not parts:
+            # (Empty, in the right shape, without loading anything)
+            shape = list(self.shape)
+            shape[self.axis] = 0
+            return np.broadcast_to(np.zeros((), dtype=self.dtype), shape)[tuple(key)].copy()
+        return np.concatenate(parts, axis=axis)
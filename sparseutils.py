@@ -0,0 +1,242 @@
+''' A sparse (COO) alternative to the dense numpy arrays used for fdata.
+
+Most (kind, slot, origin, destination) cells of fdata are zero, so the
+dense array wastes most of its ~1GB per month. A SparseArray stores only
+the nonzero cells, as sorted linear indices into the dense shape plus
+their values, and can be densified (whole, or one slice at a time) on
+demand.
+'''
+
+import numpy as np
+import utils
+
+class SparseArray:
+    ''' A sparse array of a given shape, stored as (index, value) pairs.
+
+    Updates (add_at) are buffered and merged into the sorted, unique
+    index/values arrays once enough of them pile up, or when the data
+    is read. Values are summed as int64; converting to a dense array of
+    a smaller dtype (e.g. int16) wraps around exactly as accumulating
+    into that dense array would have.
+
+    # Arguments:
+        shape: Tuple of ints, the shape of the equivalent dense array.
+        dtype: The dtype of the equivalent dense array. (Default int16)
+        buffersize: Number of buffered updates before they are merged.
+    '''
+    def __init__(self, shape, dtype=np.int16, buffersize=4000000):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.buffersize = buffersize
+        self._index = np.zeros(0, dtype=np.int64)
+        self._values = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._pending_count = 0
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def index(self):
+        ''' Sorted, unique linear indices of the stored cells.'''
+        self.compact()
+        return self._index
+
+    @property
+    def values(self):
+        ''' int64 values of the stored cells, matching index.'''
+        self.compact()
+        return self._values
+
+    @property
+    def nnz(self):
+        ''' The number of stored cells.'''
+        return len(self.index)
+
+    def add_at(self, index, values):
+        ''' Like np.add.at(dense, index, values), for a tuple of index arrays.'''
+        self.add_at_linear(np.ravel_multi_index(index, self.shape), values)
+
+    def add_at_linear(self, index, values):
+        ''' Like np.add.at(dense.reshape(-1), index, values).'''
+        index = np.asarray(index, dtype=np.int64)
+        if len(index) == 0:
+            return
+        self._pending.append((index, np.broadcast_to(np.asarray(values, dtype=np.int64), index.shape)))
+        self._pending_count += len(index)
+        if self._pending_count >= self.buffersize:
+            self.compact()
+
+    def compact(self):
+        ''' Merge buffered updates into the sorted index/values arrays.'''
+        if not self._pending:
+            return
+        index = np.concatenate([self._index] + [ii for (ii, _) in self._pending])
+        values = np.concatenate([self._values] + [vv for (_, vv) in self._pending])
+        self._pending = []
+        self._pending_count = 0
+        self._index, inverse = np.unique(index, return_inverse=True)
+        self._values = np.zeros(len(self._index), dtype=np.int64)
+        np.add.at(self._values, inverse.reshape(-1), values)
+
+    def add(self, other):
+        ''' Add another SparseArray (or dense array) of the same shape into this one.'''
+        if isinstance(other, SparseArray):
+            self.add_at_linear(other.index, other.values)
+        else:
+            index = np.flatnonzero(other)
+            self.add_at_linear(index, np.asarray(other).reshape(-1)[index])
+
+    def todense(self, dtype=None):
+        ''' Return the equivalent dense numpy array.'''
+        dense = np.zeros(self.shape, dtype=self.dtype if dtype is None else dtype)
+        dense.reshape(-1)[self.index] = self.values.astype(dense.dtype)
+        return dense
+
+    def _slice_order(self, axis):
+        # Position along axis of each stored cell, and the stored cells sorted by it.
+        stride = int(np.prod(self.shape[axis+1:], dtype=np.int64))
+        positions = (self.index // stride) % self.shape[axis]
+        order = np.argsort(positions, kind='stable')
+        bounds = np.searchsorted(positions[order], np.arange(self.shape[axis] + 1))
+        return order, bounds
+
+    def _dense_slice(self, axis, cells):
+        # Dense slice holding the given stored cells, which all share one position along axis.
+        shape = self.shape[:axis] + self.shape[axis+1:]
+        dense = np.zeros(shape, dtype=self.dtype)
+        coords = np.unravel_index(self.index[cells], self.shape)
+        coords = coords[:axis] + coords[axis+1:]
+        dense.reshape(-1)[np.ravel_multi_index(coords, shape)] = self.values[cells].astype(self.dtype)
+        return dense
+
+    def dense_slice(self, position, axis=1):
+        ''' Return the dense array at the given position along axis.
+            (E.g. for fdata, dense_slice(t) is fdata[:, t].) '''
+        stride = int(np.prod(self.shape[axis+1:], dtype=np.int64))
+        cells = np.flatnonzero((self.index // stride) % self.shape[axis] == position)
+        return self._dense_slice(axis, cells)
+
+    def dense_slices(self, axis=1, start=0, end=None):
+        ''' Yield (position, dense slice) for each position along axis,
+            from start to end (exclusive; default: the end of the axis).
+            (E.g. for fdata, yields each time slot t and fdata[:, t].) '''
+        order, bounds = self._slice_order(axis)
+        end = self.shape[axis] if end is None else end
+        for position in range(start, end):
+            yield position, self._dense_slice(axis, order[bounds[position]:bounds[position+1]])
+
+    def dense_range(self, start, end, axis=1):
+        ''' Return the dense array of positions start to end (exclusive)
+            along axis. (E.g. for fdata, dense_range(s, e) is fdata[:, s:e].) '''
+        stride = int(np.prod(self.shape[axis+1:], dtype=np.int64))
+        positions = (self.index // stride) % self.shape[axis]
+        cells = np.flatnonzero((positions >= start) & (positions < end))
+        shape = self.shape[:axis] + (end - start,) + self.shape[axis+1:]
+        dense = np.zeros(shape, dtype=self.dtype)
+        coords = list(np.unravel_index(self.index[cells], self.shape))
+        coords[axis] = coords[axis] - start
+        dense.reshape(-1)[np.ravel_multi_index(tuple(coords), shape)] = self.values[cells].astype(self.dtype)
+        return dense
+
+    def select_range(self, start, end, axis=1):
+        ''' Return the SparseArray of positions start to end (exclusive)
+            along axis, which can run past the end of the axis (those
+            positions are all zero). (E.g. like dense[:, start:end], padded)'''
+        stride = int(np.prod(self.shape[axis+1:], dtype=np.int64))
+        positions = (self.index // stride) % self.shape[axis]
+        cells = np.flatnonzero((positions >= start) & (positions < end))
+        array = SparseArray(self.shape[:axis] + (end - start,) + self.shape[axis+1:], dtype=self.dtype,
+                            buffersize=self.buffersize)
+        coords = list(np.unravel_index(self.index[cells], self.shape))
+        coords[axis] = coords[axis] - start
+        # (Still sorted: shifting one axis keeps the order of the cells)
+        array._index = np.ravel_multi_index(tuple(coords), array.shape).astype(np.int64)
+        array._values = self.values[cells]
+        return array
+    
+    def select_last(self, position):
+        ''' Return the SparseArray at the given position along the last
+            axis, without that axis. (E.g. dense[..., position]) '''
+        size = self.shape[-1]
+        cells = np.flatnonzero(self.index % size == position)
+        array = SparseArray(self.shape[:-1], dtype=self.dtype, buffersize=self.buffersize)
+        array._index = self.index[cells] // size
+        array._values = self.values[cells]
+        return array
+
+    def coarsen(self, factors):
+        ''' Return a SparseArray with each block of factors[i] positions
+            along each axis i summed together. (See utils.coarsen)'''
+        shape = tuple(size // factor for size, factor in zip(self.shape, factors))
+        coords = np.unravel_index(self.index, self.shape)
+        array = SparseArray(shape, dtype=self.dtype, buffersize=self.buffersize)
+        array.add_at(tuple(coord // factor for coord, factor in zip(coords, factors)), self.values)
+        return array
+
+    def to_arrays(self, name):
+        ''' Return a dict of numpy arrays representing this array, to be
+            saved in an .npz with np.savez_compressed(filename, **arrays).'''
+        return {name + "_shape"  : np.array(self.shape, dtype=np.int64),
+                name + "_dtype"  : np.array(self.dtype.str),
+                name + "_index"  : self.index,
+                name + "_values" : self.values}
+
+    @classmethod
+    def from_arrays(cls, data, name):
+        ''' Return the SparseArray stored under name in data (e.g. a loaded .npz).'''
+        array = cls(shape=tuple(data[name + "_shape"]), dtype=np.dtype(str(data[name + "_dtype"])))
+        array._index = data[name + "_index"].astype(np.int64)
+        array._values = data[name + "_values"].astype(np.int64)
+        return array
+
+    @classmethod
+    def from_dense(cls, dense):
+        ''' Return a SparseArray equivalent to the dense numpy array.'''
+        array = cls(shape=dense.shape, dtype=dense.dtype)
+        array.add(dense)
+        return array
+
+def gen_empty_sparse_fdata(year, month, w=10, h=20, n=4):
+    ''' Return an empty SparseArray in the shape of an 'fdata' array.
+    (See utils.gen_empty_fdata.) '''
+    samples = utils.no_samples_in_mo(year=year, month=month, n=n)
+    return SparseArray((2, samples, w, h, w, h, 2), dtype=np.int16)
+
+# How far after the end of a month its spill reaches (see gen_empty_spill)
+SPILL_DAYS = 366
+
+def gen_empty_spill(w=10, h=20, n=4):
+    ''' Return a dict of empty 'vdata' and 'fdata' SparseArrays for the
+    spill of a month: its trips that end in a later month. Their time slots
+    are counted from the start of the next month, and run SPILL_DAYS days,
+    so trips that end more than one month later are kept too.
+    (See utils.spill_offset and main.add_spill) '''
+    samples = SPILL_DAYS*24*n
+    return {'vdata' : SparseArray((samples, w, h, 2, 2), dtype=np.int16),
+            'fdata' : SparseArray((2, samples, w, h, w, h, 2), dtype=np.int16)}
+
+def is_sparse(data, name):
+    ''' Return True if the array name is stored sparse in data (e.g. a loaded .npz).'''
+    return (name + "_index") in data
+
+def load_array(data, name, dense=True):
+    ''' Return the array stored under name in data (e.g. a loaded .npz),
+        whether it was saved dense or as a SparseArray.
+        If dense is False, return it as a SparseArray instead.'''
+    if is_sparse(data, name):
+        array = SparseArray.from_arrays(data, name)
+        return array.todense() if dense else array
+    return data[name] if dense else SparseArray.from_dense(data[name])
+
+def iter_slots(data, name="fdata", start=0, end=None):
+    ''' Yield (t, fdata[:, t]) for each time slot t stored in data
+        (e.g. a loaded .npz), without densifying the whole array.'''
+    if is_sparse(data, name):
+        yield from SparseArray.from_arrays(data, name).dense_slices(axis=1, start=start, end=end)
+    else:
+        fdata = data[name]
+        end = fdata.shape[1] if end is None else end
+        for t in range(start, end):
+            yield t, fdata[:, t]
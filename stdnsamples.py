@@ -0,0 +1,222 @@
+''' Generate STDN training samples from volume and flow arrays.
+
+STDN predicts the (start, end) volume of a cell at a time slot t from:
+ * the volume and flow in a window of (2*radius+1)^2 cells around it,
+   at each of the lookback slots before t (short-term), and
+ * the same, at period_slots slots either side of the same time of day
+   (t - period) on each of the periods days before (periodic).
+
+The volume array is STDN-volume (T, w, h, 2) and the flow array STDN-flow
+(2, T, w, h, w, h), as made by script_data_to_stdn.py and
+script_compile_STDN.py, either loaded, memory-mapped (e.g. the .npy from
+script_compile_STDN.py --format npy), or a lazy view over the monthly
+files (slotreader.MonthlyDataset(..., stdn=True)). The flow features of a
+neighbouring cell are (in this order) the flow into the centre cell from
+it in the same slot and from an earlier slot, then out of the centre cell
+into it in the same slot and into a later slot. Cells outside the grid
+are zeros.
+
+A sample is just a number, which encodes its (t, x, y); batches are built
+with precomputed offset arrays and numpy advanced indexing, so only the
+values in a batch are ever read or copied. With a lazy view (which only
+supports slices), the needed time slots are read first.
+
+Run it to measure throughput:
+    python3.6 stdnsamples.py -vf data/STDN-volume.npy -ff data/STDN-flow.npy -j 4
+'''
+
+import os
+import time
+import argparse
+import collections
+import concurrent.futures
+import numpy as np
+
+def _take_slots(array, slots, axis):
+    # array's time slots (in axis) slots, stacked (for arrays that only support basic indexing)
+    index = [slice(None)] * axis
+    return np.stack([np.asarray(array[tuple(index + [int(slot)])]) for slot in slots], axis=axis)
+
+class STDNSampler:
+    ''' Builds batches of STDN samples from a volume and a flow array.
+
+    # Arguments:
+        volume: STDN-volume, (T, w, h, 2), or the filename of a .npy of it,
+            which is memory-mapped.
+        flow: STDN-flow, (2, T, w, h, w, h), or the filename of a .npy.
+        radius: The window around each cell is (2*radius+1)^2 cells.
+        lookback: The number of slots before t for the short-term input.
+        periods: The number of earlier days (periods) for the periodic input.
+        period_slots: The number of slots either side of t - period to take.
+        n: The number of slots in an hour.
+        period: The number of slots in a period. (Default one day, 24*n.
+            E.g. 7*24*n for weekly periods)
+        start_slot, end_slot: Only make samples for t in this range.
+            (Default: every slot with enough slots before it)
+    '''
+    def __init__(self, volume, flow, radius=3, lookback=7, periods=3, period_slots=1, n=2, period=None,
+                 start_slot=None, end_slot=None):
+        self.volume_filename = volume if isinstance(volume, str) else None
+        self.flow_filename = flow if isinstance(flow, str) else None
+        self.volume = np.load(volume, mmap_mode="r") if isinstance(volume, str) else volume
+        self.flow = np.load(flow, mmap_mode="r") if isinstance(flow, str) else flow
+        self.slots, self.w, self.h = self.volume.shape[:3]
+        if tuple(self.flow.shape) != (2, self.slots, self.w, self.h, self.w, self.h):
+            raise ValueError("The flow array should have shape " + str((2, self.slots, self.w, self.h, self.w, self.h)) +
+                             ", not " + str(tuple(self.flow.shape)))
+        self.radius = radius
+        self.lookback = lookback
+        self.periods = periods
+        self.period_slots = period_slots
+        self.period = 24*n if period is None else period
+        if period_slots >= self.period:
+            raise ValueError("period_slots must be less than the period, " + str(self.period))
+
+        # The slots of each sample relative to t: short-term (oldest first), periodic, then t itself
+        periodic = -np.arange(periods, 0, -1)[:, None]*self.period + np.arange(-period_slots, period_slots + 1)[None, :]
+        self.offsets = np.concatenate([np.arange(-lookback, 0), periodic.reshape(-1), [0]]).astype(np.int64)
+        first = -int(self.offsets.min())
+        self.start_slot = first if start_slot is None else max(first, start_slot)
+        self.end_slot = self.slots if end_slot is None else min(self.slots, end_slot)
+        self.samples = max(0, self.end_slot - self.start_slot) * self.w * self.h
+        self.window = np.arange(-radius, radius + 1)
+
+    def __len__(self):
+        return self.samples
+
+    def __getstate__(self):
+        # Memory maps are reopened from their files, rather than copied
+        state = dict(self.__dict__)
+        if self.volume_filename is not None:
+            state['volume'] = None
+        if self.flow_filename is not None:
+            state['flow'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.volume is None:
+            self.volume = np.load(self.volume_filename, mmap_mode="r")
+        if self.flow is None:
+            self.flow = np.load(self.flow_filename, mmap_mode="r")
+
+    def sample_coords(self, samples):
+        ''' Return the (t, x, y) arrays of the given sample numbers.'''
+        samples = np.asarray(samples, dtype=np.int64)
+        t, cell = np.divmod(samples, self.w * self.h)
+        x, y = np.divmod(cell, self.h)
+        return t + self.start_slot, x, y
+
+    def batch(self, samples):
+        ''' Return the batch of the given sample numbers, a dict of:
+            'volume'          (B, lookback, S, S, 2)
+            'flow'            (B, lookback, S, S, 4)
+            'periodic_volume' (B, periods, 2*period_slots+1, S, S, 2)
+            'periodic_flow'   (B, periods, 2*period_slots+1, S, S, 4)
+            'target'          (B, 2), the volume to predict
+            't', 'x', 'y'     (B,), the slot and cell of each sample
+        where B is the number of samples and S = 2*radius+1.'''
+        t, x, y = self.sample_coords(samples)
+        times = t[:, None] + self.offsets[None, :] # (B, K)
+        if isinstance(self.volume, np.ndarray) and isinstance(self.flow, np.ndarray):
+            volume, flow = self.volume, self.flow
+        else:
+            slots, times = np.unique(times, return_inverse=True)
+            times = times.reshape(len(t), len(self.offsets))
+            volume, flow = _take_slots(self.volume, slots, axis=0), _take_slots(self.flow, slots, axis=1)
+
+        # Index arrays, broadcasting to (B, K, S, S)
+        tt = times[:, :, None, None]
+        nx = x[:, None, None, None] + self.window[None, None, :, None]
+        ny = y[:, None, None, None] + self.window[None, None, None, :]
+        inside = ((nx >= 0) & (nx < self.w) & (ny >= 0) & (ny < self.h))[..., None]
+        nx, ny = np.clip(nx, 0, self.w - 1), np.clip(ny, 0, self.h - 1)
+        cx, cy = x[:, None, None, None], y[:, None, None, None]
+
+        volumes = volume[tt, nx, ny] * inside
+        flows = np.stack([flow[0, tt, nx, ny, cx, cy], flow[1, tt, nx, ny, cx, cy],
+                          flow[0, tt, cx, cy, nx, ny], flow[1, tt, cx, cy, nx, ny]], axis=-1) * inside
+        periodic = (len(t), self.periods, 2*self.period_slots + 1) + volumes.shape[2:4]
+        return {'volume'          : volumes[:, :self.lookback],
+                'flow'            : flows[:, :self.lookback],
+                'periodic_volume' : volumes[:, self.lookback:-1].reshape(periodic + (2,)),
+                'periodic_flow'   : flows[:, self.lookback:-1].reshape(periodic + (4,)),
+                'target'          : volumes[:, -1, self.radius, self.radius],
+                't'               : t,
+                'x'               : x,
+                'y'               : y}
+
+    def batches(self, batchsize=64, shuffle=True, seed=None, workers=1):
+        ''' Yield batches (see batch) of batchsize samples, covering every
+            sample once, in a random order if shuffle.
+            With workers > 1, batches are built in that many processes.'''
+        order = np.random.RandomState(seed).permutation(self.samples) if shuffle else np.arange(self.samples)
+        chunks = (order[ii:ii+batchsize] for ii in range(0, len(order), batchsize))
+        if workers <= 1:
+            for samples in chunks:
+                yield self.batch(samples)
+            return
+        # (The sampler is sent to each worker once, rather than with every batch)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_worker_init,
+                                                    initargs=(self,)) as executor:
+            pending = collections.deque()
+            for samples in chunks:
+                pending.append(executor.submit(_worker_batch, samples))
+                # (Keep a few batches ahead of the consumer)
+                if len(pending) >= 2*workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+# The sampler each worker process uses, kept (with its open memory maps,
+#   or the cache of a lazy view) between batches
+_worker_sampler = None
+
+def _worker_init(sampler):
+    global _worker_sampler
+    _worker_sampler = sampler
+
+def _worker_batch(samples):
+    return _worker_sampler.batch(samples)
+
+def measure_throughput(sampler, batchsize=64, batches=100, workers=1, seed=None):
+    ''' Return the number of samples per second sampler.batches generates,
+        timing the first batches batches.'''
+    start = time.time()
+    count = 0
+    for ii, batch in enumerate(sampler.batches(batchsize=batchsize, seed=seed, workers=workers)):
+        count += len(batch['t'])
+        if ii + 1 >= batches:
+            break
+    return count / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure how fast STDN samples can be generated")
+    parser.add_argument("--volume", "-vf",
+                        help="The STDN-volume .npy file (memory-mapped). (Default data/STDN-volume.npy)",
+                        type=str, nargs=1)
+    parser.add_argument("--flow", "-ff",
+                        help="The STDN-flow .npy file (memory-mapped). (Default data/STDN-flow.npy)",
+                        type=str, nargs=1)
+    parser.add_argument("--nslotsperhour", "-n",
+                        help="The number of slots in an hour. (Default 2)",
+                        type=int, nargs=1)
+    parser.add_argument("--batchsize", "-b",
+                        help="The number of samples per batch. (Default 64)",
+                        type=int, nargs=1)
+    parser.add_argument("--batches", "-B",
+                        help="The number of batches to time. (Default 100)",
+                        type=int, nargs=1)
+    parser.add_argument("--jobs", "-j",
+                        help="The number of worker processes. (Default 1)",
+                        type=int, nargs=1)
+    args = parser.parse_args()
+
+    sampler = STDNSampler(volume = os.path.join("data", "STDN-volume.npy") if args.volume is None else args.volume[0],
+                          flow   = os.path.join("data", "STDN-flow.npy")   if args.flow   is None else args.flow[0],
+                          n      = 2 if args.nslotsperhour is None else args.nslotsperhour[0])
+    rate = measure_throughput(sampler,
+                              batchsize = 64  if args.batchsize is None else args.batchsize[0],
+                              batches   = 100 if args.batches   is None else args.batches[0],
+                              workers   = 1   if args.jobs      is None else args.jobs[0])
+    print("%d samples, %.0f samples per second" % (len(sampler), rate))
@@ -1,8 +1,34 @@
 import unittest as ut
 import numpy as np
 import random
-from GPSUtils import gps_to_xy, pgps_to_xy, gps_distance
+from datetime import datetime
+from GPSUtils import gps_to_xy, pgps_to_xy, gps_distance, pgps_to_xy_batch, gps_distance_batch
+import GPSUtils
+import os
+import sys
+import shutil
+import tempfile
+import json
+import zipfile
+import subprocess
+import gzip
 import utils
+import sparseutils
+import readers
+import tripcache
+import script_compile_STDN
+import chunkedio
+import slotreader
+import stdnsamples
+import script_data_to_stdn
+import regrid
+import slabarray
+import pipeline
+import benchmark
+import instrument
+import errorsink
+import golden
+import main
 
 class GPSUtilsTest(ut.TestCase):
     ''' Meant to test the function according to our Manhattan grid.'''
@@ -112,6 +138,42 @@ class GPSUtilsTest(ut.TestCase):
         self.assertTrue(max_difference >= d_or_to_tr)
         self.assertTrue(max_difference >= d_br_to_tl)
 
+    def test_batch_equal_values(self):
+        '''... Test that the batch functions give the same values as the scalar ones.'''
+        # (To the last bit: summing the products of the matmul one by one is off in about half of them)
+        lon = self.orlon + 2*(np.random.random(20000) - .5)
+        lat = self.orlat + 2*(np.random.random(20000) - .5)
+        x, y = pgps_to_xy_batch(lon, lat)
+        distances = gps_distance_batch(lat, lon, lat[::-1], lon[::-1])
+        self.assertTrue(list(zip(x, y)) == [pgps_to_xy(lon[ii], lat[ii]) for ii in range(20000)])
+        self.assertTrue(list(distances) == [gps_distance((lat[ii], lon[ii]), (lat[-ii-1], lon[-ii-1]))
+                                            for ii in range(20000)])
+        
+        # pgps_to_xy itself is still the matmul, not the products summed one by one
+        c = np.matmul((-73.97, 40.79) - GPSUtils.origin_array, GPSUtils.inv_basis)
+        self.assertEqual(pgps_to_xy(-73.97, 40.79), (c[0], c[1]))
+        
+        # Writing into caller-supplied buffers
+        out_x, out_y, out = np.empty(20000), np.empty(20000), np.empty(20000)
+        pgps_to_xy_batch(lon, lat, out_x=out_x, out_y=out_y)
+        gps_distance_batch(lat, lon, lat[::-1], lon[::-1], out=out)
+        self.assertTrue(np.array_equal(out_x, x))
+        self.assertTrue(np.array_equal(out_y, y))
+        self.assertTrue(np.array_equal(out, distances))
+    
+    def test_gps_distance_errors(self):
+        '''... Infinite coordinates are a math domain error, NaN coordinates are not.'''
+        orcorner = (self.orlat, self.orlon)
+        self.assertRaises(ValueError, gps_distance, orcorner, (float('inf'), self.orlon))
+        self.assertRaises(ValueError, gps_distance, orcorner, (self.orlat, float('-inf')))
+        self.assertTrue(np.isnan(gps_distance(orcorner, (float('nan'), self.orlon))))
+        
+        errors = np.zeros(3, dtype=bool)
+        gps_distance_batch(np.array([self.orlat]*3), np.array([self.orlon]*3),
+                           np.array([float('inf'), float('nan'), self.tllat]),
+                           np.array([self.orlon]*3), errors=errors)
+        self.assertEqual(list(errors), [True, False, False])
+
 class UtilsMiscTest(ut.TestCase):
     # Test the simpler utils
     def setUp(self):
@@ -217,10 +279,10 @@ class UtilsMiscTest(ut.TestCase):
                          # Invalid due to negative trip time (-115 s!)
                          '2010000001,2010000001,"VTS",1,,"2011-03-14 23:59:55","2011-03-14 23:58:00",4,-55,1.1,-73.970610,40.793724,-73.974672,40.783098\n']
         for line in valid_lines:
-            entry = utils.process_entry(line=line, n=4)
+            entry = utils.process_entry(line=line, n=n)
             self.assertTrue(utils.check_valid(entry=entry, year=start_year, month=start_month))
         for line in invalid_lines:
-            entry = utils.process_entry(line=line, n=4)
+            entry = utils.process_entry(line=line, n=n)
             self.assertFalse(utils.check_valid(entry=entry, year=start_year, month=start_month))
 
 class UtilsProcessEntryTest(ut.TestCase):
@@ -461,10 +523,1230 @@ class UtilsUpdateDataTest(ut.TestCase):
     
         # TODO: More extensive tests could be good. (E.g. trips outside manhattan, trips that start outside and end up inside, vice versa, etc.)
 
+class UtilsBatchTest(ut.TestCase):
+    # Make sure the batch functions give the same results as the per-line ones.
+    def setUp(self):
+        with open("example.csv", "r") as read_f:
+            read_f.readline() # Skip header
+            self.lines = read_f.readlines()
+        # Lines that the per-line functions either reject or raise an error on
+        self.lines += ['2010000001,2010000001,"VTS",1,,"2010-01-31 23:59:10","2010-02-01 00:04:11",4,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n', # Ends next month
+                       '2010000001,2010000001,"VTS",1,,"2010-01-31 23:59:10","2010-03-31 00:04:11",4,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n', # Ends past next month
+                       '2010000001,2010000001,"VTS",1,,"2010-01-14 23:50:10","2010-01-15 00:04:11",4,301,1.1,-73.92568926,40.78907511,-73.974672,40.783098\n', # Starts on the corner (1,1)
+                       '2010000001,2010000001,"VTS",1,,"2010-01-14 23:50:10","2010-01-15 00:04:11",4,301,1.1,-73.970610,40.793724,-73.92568926,40.78907511\n', # Ends on the corner (1,1)
+                       '2010000001,2010000001,"VTS",1,,"2010-02-30 23:50:10","2010-01-15 00:04:11",4,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n', # Bad date
+                       '2010000001,2010000001,"VTS",1,,"2010-01-14 23:50:10","2010-01-15 00:04:11",,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n', # No pcount
+                       '2010000001,2010000001,"VTS",1,,"2010-01-14 23:50:10","2010-01-15 00:04:11",4,301,1.1,-73.970610,inf,-73.974672,40.783098\n', # Infinite latitude
+                       '2010000001,2010000001,"VTS",1,,"2010-01-14 23:50:10","2010-01-15 00:04:11",4,301,1.1,nan,40.793724,-73.974672,40.783098\n', # NaN longitude
+                       '2010000001,2010000001,"VTS",1,,"2010-01-14 23:50:10","2010-01-15 00:04:11",4,301\n', # Missing columns
+                       '\n']
+    
+    def tearDown(self):
+        pass
+    
+    def process(self, batch, w, h, n):
+        # Run either process_batch or the per-line functions over self.lines
+        year, month = (2010, 1)
+        arrays = (utils.gen_empty_vdata(year=year, month=month, w=w, h=h, n=n),
+                  utils.gen_empty_fdata(year=year, month=month, w=w, h=h, n=n),
+                  utils.gen_empty_vdata(year=year, month=month+1, w=w, h=h, n=n),
+                  utils.gen_empty_fdata(year=year, month=month+1, w=w, h=h, n=n),
+                  np.zeros((2,2,2)))
+        vdata, fdata, vdata_next_mo, fdata_next_mo, trips = arrays
+        if batch:
+            invalid_count, unparsable_lines = utils.process_batch(
+                lines=self.lines, year=year, month=month, vdata=vdata, fdata=fdata,
+                vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                trips=trips, w=w, h=h, n=n)
+            return arrays, invalid_count, unparsable_lines
+        invalid_count = 0
+        unparsable_lines = []
+        for line_number, line in enumerate(self.lines, 1):
+            try:
+                entry = utils.process_entry(line=line, n=n)
+                if utils.check_valid(entry=entry, year=year, month=month):
+                    utils.update_data(entry=entry, vdata=vdata, fdata=fdata,
+                                      vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                                      trips=trips, w=w, h=h, n=n)
+                else:
+                    invalid_count += 1
+            except:
+                unparsable_lines.append(line_number)
+        return arrays, invalid_count, unparsable_lines
+    
+    def test_process_entries(self):
+        entries = utils.process_entries(self.lines[:100], n=12)
+        for ii, line in enumerate(self.lines[:100]):
+            entry = utils.process_entry(line=line, n=12)
+            self.assertTrue(entries['ok'][ii])
+            for key in entry:
+                self.assertEqual(entries[key][ii], entry[key])
+        
+        entries = utils.process_entries(self.lines[-6:], n=12)
+        self.assertEqual(list(entries['ok']), [False, False, False, True, False, False])
+    
+    def test_parse_times(self):
+        strings = ['2011-11-04 13:15:12', '"2011-11-04 13:15:12"', ' 2011-11-04 13:15:12',
+                   'x"2011-11-04 13:15:12"x', '2012-02-29 23:59:59', '2011-02-29 23:59:59',
+                   '2011-12-31 24:00:00', '2011-12-31 23:60:00', '2011-12-31 23:59:60',
+                   '0000-01-01 00:00:00', '2011-1-04 13:15:12', '2011/11/04 13:15:12',
+                   '2011-11-04 13:15:1', '2011-11-04T13:15:12', '', '"2011-11-04 13:15:12']
+        times, ok = utils.parse_times(strings, n=12)
+        for ii, string in enumerate(strings):
+            try:
+                time_string = utils.re.search(utils.regex_format, string).group()
+                time = datetime.strptime(time_string, utils.time_format)
+            except (AttributeError, ValueError):
+                self.assertFalse(ok[ii])
+                continue
+            self.assertTrue(ok[ii])
+            self.assertEqual(times['year'][ii], time.year)
+            self.assertEqual(times['month'][ii], time.month)
+            self.assertEqual(times['day'][ii], time.day)
+            self.assertEqual(times['hour'][ii], time.hour)
+            self.assertEqual(times['minute'][ii], time.minute)
+            self.assertEqual(times['second'][ii], time.second)
+            self.assertEqual(times['epoch'][ii], (time - datetime(1970, 1, 1)).total_seconds())
+            self.assertEqual(times['slot'][ii], utils.get_t(day=time.day, hour=time.hour, minute=time.minute, n=12))
+        self.assertEqual(list(ok), [True, True, True, True, True, False, False, False,
+                                    False, False, False, False, False, False, False, True])
+    
+    def test_deltat(self):
+        # Midnight crossings, negative trip times and trips longer than a day
+        base = '2010000001,2010000001,"VTS",1,,"{}","{}",4,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n'
+        times = [('2011-03-14 23:59:10', '2011-03-15 00:04:11'), ('2011-03-14 23:59:55', '2011-03-14 23:58:00'),
+                 ('2011-03-14 10:00:00', '2011-03-14 10:00:00'), ('2011-03-14 10:00:00', '2011-03-16 10:00:05'),
+                 ('2011-03-16 10:00:05', '2011-03-14 10:00:00'), ('2011-02-28 23:00:00', '2012-02-29 01:00:00')]
+        lines = [base.format(start, end) for (start, end) in times]
+        entries = utils.process_entries(lines, n=4)
+        for ii, line in enumerate(lines):
+            self.assertEqual(entries['deltat'][ii], utils.process_entry(line=line, n=4)['deltat'])
+    
+    def test_process_batch(self):
+        for (w, h, n) in [(10, 20, 4), (1, 1, 4), (3, 7, 12)]:
+            arrays_l, invalid_count_l, unparsable_lines_l = self.process(batch=False, w=w, h=h, n=n)
+            arrays_b, invalid_count_b, unparsable_lines_b = self.process(batch=True, w=w, h=h, n=n)
+            self.assertEqual(invalid_count_l, invalid_count_b)
+            self.assertEqual(unparsable_lines_l, unparsable_lines_b)
+            for array_l, array_b in zip(arrays_l, arrays_b):
+                self.assertTrue(np.array_equal(array_l, array_b))
+        # Make sure some of the trips were actually counted!
+        self.assertTrue(np.sum(arrays_b[0]) > 0)
+        self.assertTrue(np.sum(arrays_b[1]) > 0)
+        self.assertTrue(np.sum(arrays_b[2]) > 0)
+    
+    def test_validate_entries(self):
+        # Each set of thresholds gives what check_valid does with them, one line at a time
+        year, month = (2010, 1)
+        entries = utils.process_entries(self.lines)
+        entries = utils.select_entries(entries, entries['ok'])
+        thresholds = [{}, dict(min_time=300), dict(max_speed=5, min_distance=1000), dict(min_time=1, max_speed=1e9, min_distance=0)]
+        valid, rejections = utils.validate_entries(entries, year=year, month=month, thresholds=thresholds)
+        self.assertEqual(valid.shape, (len(thresholds), len(entries['ok'])))
+        self.assertTrue(np.array_equal(valid[0], utils.check_valid_entries(entries, year=year, month=month)))
+        lines = [line for line, ok in zip(self.lines, utils.process_entries(self.lines)['ok']) if ok]
+        for threshold, threshold_valid, counts in zip(thresholds, valid, rejections):
+            reasons = [utils.invalid_reason(utils.process_entry(line=line), year=year, month=month, **threshold)
+                       for line in lines]
+            self.assertEqual(list(threshold_valid), [reason is None for reason in reasons])
+            self.assertEqual(list(counts.items()), [(reason, reasons.count(reason)) for reason in utils.INVALID_REASONS])
+        self.assertEqual(len(set(tuple(counts.values()) for counts in rejections)), len(thresholds))
+        valid, rejections = utils.validate_entries(entries, year=year, month=month, thresholds=[])
+        self.assertEqual((valid.shape, rejections), ((0, len(entries['ok'])), []))
+    
+    def test_plan_resolutions(self):
+        plan = utils.plan_resolutions([(5, 10, 2), (10, 20, 4), (10, 20, 12), (5, 10, 2), (3, 7, 5), (1, 1, 1)])
+        # Each derived resolution comes from the smallest accumulated one it divides
+        self.assertEqual(list(plan.items()), [((10, 20, 12), None), ((3, 7, 5), None), ((5, 10, 2), (10, 20, 12)),
+                                              ((10, 20, 4), (10, 20, 12)), ((1, 1, 1), (3, 7, 5))])
+        self.assertEqual(utils.resolution_factors((10, 20, 12), (5, 4, 3)), (2, 5, 4))
+        self.assertEqual(utils.resolution_factors((10, 20, 7), (5, 4, 7)), None)
+    
+    def test_process_batch_resolutions(self):
+        # Derived resolutions, including grid sizes where coarsening is off
+        #   by floating point rounding for coordinates next to cell borders
+        year, month = (2010, 1)
+        resolutions = [(25, 2, 2), (5, 2, 2), (5, 1, 1), (3, 7, 4), (3, 7, 2)]
+        entries = utils.process_entries(self.lines)
+        ok = entries['ok']
+        entries = utils.select_entries(entries, ok)
+        for key in ('sx', 'sy', 'ex', 'ey'):
+            border = np.arange(len(entries[key])) % 6 / 5
+            entries[key][::2] = (border - (np.arange(len(border)) % 40 - 3)*2.0**-53)[::2]
+        fallback = np.flatnonzero(~ok)
+        def process(plan):
+            targets = {(w, h, n) : dict(vdata=utils.gen_empty_vdata(year=year, month=month, w=w, h=h, n=n),
+                                        fdata=utils.gen_empty_fdata(year=year, month=month, w=w, h=h, n=n),
+                                        vdata_next_mo=utils.gen_empty_vdata(year=year, month=month+1, w=w, h=h, n=n),
+                                        fdata_next_mo=utils.gen_empty_fdata(year=year, month=month+1, w=w, h=h, n=n),
+                                        trips=np.zeros((2,2,2)))
+                       for (w, h, n) in resolutions}
+            results = utils.accumulate_resolutions(entries, np.flatnonzero(ok) + 1, [self.lines[ii] for ii in fallback],
+                                                   fallback + 1, year=year, month=month, targets=targets, plan=plan)
+            utils.finish_resolutions(targets, plan)
+            return targets, results
+        plan = utils.plan_resolutions(resolutions)
+        self.assertEqual(plan[(5, 1, 1)], (25, 2, 2))
+        self.assertFalse(utils.derivable_entries(entries, (25, 2, 2), (5, 2, 2)).all())
+        targets_d, results_d = process(plan)
+        targets_a, results_a = process({resolution : None for resolution in resolutions})
+        self.assertEqual(results_d, results_a)
+        for resolution in resolutions:
+            for key in targets_a[resolution]:
+                self.assertTrue(np.array_equal(targets_d[resolution][key], targets_a[resolution][key]))
+
+class SparseUtilsTest(ut.TestCase):
+    def setUp(self):
+        with open("example.csv", "r") as read_f:
+            read_f.readline() # Skip header
+            self.lines = read_f.readlines()
+        self.lines.append('2010000001,2010000001,"VTS",1,,"2010-1-31 23:59:10","2010-02-01 00:04:11",4,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n')
+        self.year, self.month = (2010, 1)
+        self.w, self.h, self.n = (3, 7, 4)
+    
+    def tearDown(self):
+        pass
+    
+    def process(self, sparse):
+        gen_empty_fdata = sparseutils.gen_empty_sparse_fdata if sparse else utils.gen_empty_fdata
+        vdata = utils.gen_empty_vdata(year=self.year, month=self.month, w=self.w, h=self.h, n=self.n)
+        fdata = gen_empty_fdata(year=self.year, month=self.month, w=self.w, h=self.h, n=self.n)
+        vdata_next_mo = utils.gen_empty_vdata(year=self.year, month=self.month+1, w=self.w, h=self.h, n=self.n)
+        fdata_next_mo = gen_empty_fdata(year=self.year, month=self.month+1, w=self.w, h=self.h, n=self.n)
+        trips = np.zeros((2,2,2))
+        counts = utils.process_batch(lines=self.lines, year=self.year, month=self.month,
+                                     vdata=vdata, fdata=fdata, vdata_next_mo=vdata_next_mo,
+                                     fdata_next_mo=fdata_next_mo, trips=trips, w=self.w, h=self.h, n=self.n)
+        return (vdata, fdata, vdata_next_mo, fdata_next_mo, trips), counts
+    
+    def test_sparse_accumulation(self):
+        arrays_d, counts_d = self.process(sparse=False)
+        arrays_s, counts_s = self.process(sparse=True)
+        self.assertEqual(counts_d, counts_s)
+        for array_d, array_s in zip(arrays_d, arrays_s):
+            if isinstance(array_s, sparseutils.SparseArray):
+                self.assertEqual(array_s.shape, array_d.shape)
+                self.assertEqual(array_s.nnz, np.count_nonzero(array_d))
+                array_s = array_s.todense()
+            self.assertEqual(array_s.dtype, array_d.dtype)
+            self.assertTrue(np.array_equal(array_d, array_s))
+    
+    def test_small_buffer(self):
+        # Merging buffered updates many times gives the same result
+        fdata = utils.gen_empty_fdata(year=self.year, month=self.month, w=self.w, h=self.h, n=self.n)
+        sdata = sparseutils.SparseArray(fdata.shape, buffersize=10)
+        for _ in range(100):
+            index = tuple(np.random.randint(0, size, 20) for size in fdata.shape)
+            values = np.random.randint(-5, 10, 20)
+            np.add.at(fdata, index, values.astype(fdata.dtype))
+            sdata.add_at(index, values)
+        self.assertTrue(np.array_equal(fdata, sdata.todense()))
+        self.assertTrue(np.array_equal(fdata, sparseutils.SparseArray.from_dense(fdata).todense()))
+    
+    def test_slices_and_saving(self):
+        arrays, _ = self.process(sparse=True)
+        fdata = arrays[1]
+        dense = fdata.todense()
+        for t, fdata_t in fdata.dense_slices(axis=1, start=10, end=200):
+            self.assertTrue(np.array_equal(fdata_t, dense[:, t]))
+        self.assertTrue(np.array_equal(fdata.dense_slice(100, axis=1), dense[:, 100]))
+        self.assertTrue(np.array_equal(fdata.dense_slice(2, axis=4), dense[:, :, :, :, 2]))
+        self.assertTrue(np.array_equal(fdata.dense_range(95, 105, axis=1), dense[:, 95:105]))
+        self.assertTrue(np.array_equal(fdata.dense_range(1, 3, axis=4), dense[:, :, :, :, 1:3]))
+        self.assertTrue(np.array_equal(fdata.select_last(1).todense(), dense[..., 1]))
+        
+        saved = {}
+        saved.update(fdata.to_arrays("fdata"))
+        saved.update({"vdata" : dense})
+        self.assertTrue(np.array_equal(sparseutils.load_array(saved, "fdata"), dense))
+        self.assertTrue(np.array_equal(sparseutils.load_array(saved, "vdata"), dense))
+        for (t_s, fdata_s), (t_d, fdata_d) in zip(sparseutils.iter_slots(saved, "fdata", start=5, end=50),
+                                                  sparseutils.iter_slots(saved, "vdata", start=5, end=50)):
+            self.assertEqual(t_s, t_d)
+            self.assertTrue(np.array_equal(fdata_s, fdata_d))
+    
+    def test_coarsen(self):
+        arrays, _ = self.process(sparse=True)
+        fdata = arrays[1]
+        factors = utils.array_factors("fdata", (3, 7, 2))
+        coarse = utils.coarsen(fdata.todense(), factors)
+        self.assertEqual(coarse.shape, (2, fdata.shape[1] // 2, 1, 1, 1, 1, 2))
+        self.assertTrue(np.array_equal(coarse, fdata.coarsen(factors).todense()))
+        self.assertEqual(np.sum(coarse[..., 1]), np.sum(fdata.todense()[..., 1]))
+        
+        dense = np.zeros(coarse.shape, dtype=coarse.dtype)
+        utils.add_array(dense, fdata.coarsen(factors))
+        utils.add_array(dense, coarse, sign=-1)
+        self.assertFalse(dense.any())
+    
+    def test_slab_array(self):
+        # Updates behind the watermark, or far ahead of it, still add up (and wrap around) exactly
+        tempdir = tempfile.mkdtemp()
+        try:
+            for axis in (0, 1):
+                shape = (50, 3, 2) if axis == 0 else (2, 50, 3)
+                dense = np.zeros(shape, dtype=np.int16)
+                slabs = slabarray.SlabArray(os.path.join(tempdir, "%d.npy" % axis), shape, axis=axis,
+                                            slabslots=4, maxslabs=3, lag=2)
+                for t in range(0, 50, 5):
+                    index = [np.random.randint(0, size, 30) for size in shape]
+                    index[axis] = np.clip(t + np.random.randint(-10, 20, 30), 0, shape[axis] - 1)
+                    values = np.random.randint(-20000, 20000, 30)
+                    np.add.at(dense, tuple(index), values.astype(dense.dtype))
+                    slabs.add_at(tuple(index), values)
+                    slabs.advance_watermark(np.full(10, t))
+                self.assertGreater(slabs.flushed, 0)
+                self.assertGreater(slabs.corrections.nnz, 0)
+                array = slabs.finish()
+                self.assertEqual(array.dtype, dense.dtype)
+                self.assertTrue(np.array_equal(array, dense))
+                self.assertTrue(np.array_equal(np.load(os.path.join(tempdir, "%d.npy" % axis)), dense))
+                slabarray.remove_files({'array' : array})
+                self.assertFalse(os.path.exists(os.path.join(tempdir, "%d.npy" % axis)))
+        finally:
+            shutil.rmtree(tempdir)
+
+class MainProcessTest(ut.TestCase):
+    # Run main.process over a few small, made-up months of data
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.datadir = os.path.join(self.tempdir, "decompressed")
+        self.dates = [(2010, 11), (2010, 12), (2011, 1)]
+        with open("example.csv", "r") as read_f:
+            header = read_f.readline()
+            lines = read_f.readlines()[:500]
+        crossing = '2010000001,2010000001,"VTS",1,,"{}-{:02d}-{:02d} 23:50:10","{}-{:02d}-01 00:10:11",4,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n'
+        for (year, month) in self.dates:
+            os.makedirs(os.path.join(self.datadir, "FOIL"+str(year)), exist_ok=True)
+            day = utils.no_days_in_mo(year=year, month=month)
+            next_year, next_month = main.get_next(year=year, month=month)
+            with open(main.get_load_filename(year=year, month=month, datadir=self.datadir), "w") as write_f:
+                write_f.write(header)
+                for line in lines:
+                    write_f.write(line.replace("2010-01-01", "%d-%02d-%02d" % (year, month, day)))
+                for _ in range(month):
+                    write_f.write(crossing.format(year, month, day, next_year, next_month))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def add_overflowing_pcounts(self):
+        # Add trips with a passenger count that doesn't fit into int16 to each month: starting inside the
+        #   grid, ending inside it, all outside it, and ending inside it in the next month
+        trip = '2010000001,2010000001,"VTS",1,,"{}-{:02d}-{:02d} 23:10:10","{}-{:02d}-{:02d} {}",40000,301,1.1,{},{}\n'
+        inside, outside = "-73.970610,40.793724", "-73.800000,40.650000"
+        for (year, month) in self.dates:
+            day = utils.no_days_in_mo(year=year, month=month)
+            next_year, next_month = main.get_next(year=year, month=month)
+            with open(main.get_load_filename(year=year, month=month, datadir=self.datadir), "a") as write_f:
+                for start, end in [(inside, outside), (outside, inside), (outside, outside)]:
+                    write_f.write(trip.format(year, month, day, year, month, day, "23:59:10", start, end))
+                write_f.write(trip.format(year, month, day, next_year, next_month, 1, "00:10:11", outside, inside))
+    
+    def run_process(self, name, **kwargs):
+        savedir = os.path.join(self.tempdir, name)
+        os.makedirs(savedir)
+        main.process(startyear=2010, startmonth=11, endyear=2011, endmonth=1,
+                     width=2, height=3, n=2, datadir=self.datadir, savedir=savedir, **kwargs)
+        return savedir
+    
+    def assertSameOutput(self, savedir_1, savedir_2, dates=None, save_format="npz"):
+        for (year, month) in (self.dates if dates is None else dates):
+            data_1 = main.load_arrays(main.get_save_filename(year=year, month=month, savedir=savedir_1))
+            data_2 = main.load_arrays(main.get_save_filename(year=year, month=month, savedir=savedir_2,
+                                                             save_format=save_format))
+            self.assertEqual(sorted(data_1.keys()), sorted(data_2.keys()))
+            for key in data_1:
+                self.assertEqual(data_1[key].dtype, data_2[key].dtype)
+                self.assertTrue(np.array_equal(data_1[key], data_2[key]))
+    
+    def test_spill(self):
+        savedir = self.run_process("line")
+        for (year, month) in self.dates:
+            data = main.load_arrays(main.get_save_filename(year=year, month=month, savedir=savedir))
+            self.assertEqual(data['vdata'].shape, (utils.no_samples_in_mo(year=year, month=month, n=2), 2, 3, 2, 2))
+            # Trips that ended in the first hour of the month came from the previous month
+            spilled = 0 if (year, month) == self.dates[0] else month - 1 if month > 1 else 12
+            self.assertEqual(np.sum(data['vdata'][0:2, :, :, 1, 1]), spilled)
+    
+    def test_long_spill(self):
+        # A trip from November that ends in January (past a year-end) is added to January, in every mode
+        with open(main.get_load_filename(year=2010, month=11, datadir=self.datadir), "a") as write_f:
+            write_f.write('2010000001,2010000001,"VTS",1,,"2010-11-30 23:50:10","2011-01-01 00:10:11",4,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n')
+        savedir_line = self.run_process("line")
+        data = main.load_arrays(main.get_save_filename(year=2011, month=1, savedir=savedir_line))
+        self.assertEqual(np.sum(data['vdata'][0:2, :, :, 1, 1]), 12 + 1)
+        data = main.load_arrays(main.get_save_filename(year=2010, month=12, savedir=savedir_line))
+        self.assertEqual(np.sum(data['vdata'][0:2, :, :, 1, 1]), 11)
+        self.assertSameOutput(savedir_line, self.run_process("batch", engine="batch", batchsize=64))
+        self.assertSameOutput(savedir_line, self.run_process("jobs", engine="batch", jobs=2, splits=2))
+        self.assertSameOutput(savedir_line, self.run_process("stream", engine="batch", stream=True))
+        
+        # Spills are sparse, and what reaches past the next month is carried on
+        spill = sparseutils.gen_empty_spill(w=2, h=3, n=2)
+        spill['vdata'].add_at((np.array([5, 31*48 + 5]), np.array([0, 1]), np.array([0, 2]), np.array([1, 1]),
+                               np.array([1, 1])), np.array([1, 2]))
+        data = {'vdata' : utils.gen_empty_vdata(year=2010, month=12, w=2, h=3, n=2)}
+        next_spill = {'vdata' : sparseutils.gen_empty_spill(w=2, h=3, n=2)['vdata']}
+        main.add_spill(data, {'vdata' : spill['vdata']})
+        main.add_spill(next_spill, {'vdata' : spill['vdata']}, offset=data['vdata'].shape[0])
+        self.assertEqual(data['vdata'][5, 0, 0, 1, 1], 1)
+        self.assertEqual(np.sum(data['vdata']), 1)
+        self.assertEqual(next_spill['vdata'].nnz, 1)
+        self.assertEqual(next_spill['vdata'].todense()[5, 1, 2, 1, 1], 2)
+        self.assertEqual(utils.spill_offset(2010, 11, 2011, 1, n=2), 31*48)
+        self.assertEqual(utils.spill_offset(2010, 12, 2011, 1, n=2), 0)
+    
+    def test_compressed_input(self):
+        savedir_line = self.run_process("line")
+        # November as a .gz, December as a .zip, and January in an archive of FOIL2011
+        for (year, month) in self.dates:
+            load_filename = main.get_load_filename(year=year, month=month, datadir=self.datadir)
+            with open(load_filename, "rb") as read_f:
+                contents = read_f.read()
+            if month == 11:
+                with gzip.open(load_filename + ".gz", "wb") as write_f:
+                    write_f.write(contents)
+            elif month == 12:
+                with zipfile.ZipFile(load_filename + ".zip", "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                    archive.writestr(os.path.basename(load_filename), contents)
+            else:
+                with zipfile.ZipFile(os.path.join(self.datadir, "FOIL2011.zip"), "w",
+                                     compression=zipfile.ZIP_DEFLATED) as archive:
+                    archive.writestr("FOIL2011/" + os.path.basename(load_filename), contents)
+            os.remove(load_filename)
+        self.assertSameOutput(savedir_line, self.run_process("line_compressed"))
+        self.assertSameOutput(savedir_line, self.run_process("batch", engine="batch"))
+        self.assertSameOutput(savedir_line, self.run_process("splits", engine="batch", jobs=2, splits=3))
+        
+        cachedir = os.path.join(self.tempdir, "tripcache")
+        year, month = self.dates[0]
+        load_filename = main.get_load_filename(year=year, month=month, datadir=self.datadir)
+        month_cachedir = tripcache.get_month_cachedir(year=year, month=month, cachedir=cachedir)
+        tripcache.ingest_month(load_filename, month_cachedir)
+        self.assertTrue(tripcache.has_cache(month_cachedir, load_filename))
+        self.assertSameOutput(savedir_line, self.run_process("cache", engine="batch", cachedir=cachedir))
+    
+    def test_engines_and_jobs(self):
+        savedir_line = self.run_process("line")
+        self.assertSameOutput(savedir_line, self.run_process("batch", engine="batch"))
+        self.assertSameOutput(savedir_line, self.run_process("sparse", engine="batch", sparse=True))
+        self.assertSameOutput(savedir_line, self.run_process("jobs", engine="batch", jobs=2))
+        self.assertSameOutput(savedir_line, self.run_process("jobs_sparse", engine="batch", jobs=3, sparse=True))
+        self.assertSameOutput(savedir_line, self.run_process("splits", engine="batch", jobs=2, splits=3))
+        self.assertSameOutput(savedir_line, self.run_process("splits_line", jobs=3, splits=4))
+    
+    def test_split_line_numbers(self):
+        # Unparsable line numbers, counted from the start of each range, add up
+        year, month = self.dates[0]
+        with open(main.get_load_filename(year=year, month=month, datadir=self.datadir), "a") as write_f:
+            write_f.write("garbage\n" * 5)
+        kwargs = dict(year=year, month=month, width=2, height=3, n=2, datadir=self.datadir)
+        unparsable_lines = []
+        main.process_month(unparsable_lines=unparsable_lines, **kwargs)
+        self.assertEqual(len(unparsable_lines), 5)
+        
+        load_filename = main.get_load_filename(year=year, month=month, datadir=self.datadir)
+        split_unparsable_lines = []
+        line_number = 0
+        for byte_range in readers.split_byte_ranges(load_filename, 7):
+            part_unparsable_lines = []
+            _, _, part_lines = main.process_month(byte_range=byte_range, unparsable_lines=part_unparsable_lines, **kwargs)
+            split_unparsable_lines += [line_number + ii for ii in part_unparsable_lines]
+            line_number += part_lines
+        self.assertEqual(unparsable_lines, split_unparsable_lines)
+    
+    def test_parallel_window(self):
+        # With a window of one month, each month is saved (and checkpointed) before the next one is started
+        savedir = os.path.join(self.tempdir, "window")
+        os.makedirs(savedir)
+        main.process_parallel(self.dates, lambda year, month: True, jobs=2, splits=2, savedir=savedir, resume=True,
+                              window=1, resolutions=[(2, 3, 2)], engine="batch", datadir=self.datadir)
+        self.assertSameOutput(self.run_process("line"), savedir)
+        for (year, month), (next_year, next_month) in zip(self.dates, self.dates[1:]):
+            checkpoint = main.get_checkpoint_filename(year=year, month=month, savedir=savedir)
+            errors = os.path.join(savedir, "%d-%02d-errors.json" % (next_year, next_month))
+            self.assertTrue(os.path.getmtime(checkpoint) <= os.path.getmtime(errors))
+    
+    def test_restart(self):
+        savedir = self.run_process("restart", engine="batch", jobs=2, restart=True)
+        # (Errors are reported for every month processed)
+        self.assertEqual(sorted(os.listdir(savedir)), ["2010-11-errors.json", "2010-12-data.npz", "2010-12-errors.json",
+                                                       "2011-01-data.npz", "2011-01-errors.json"])
+        self.assertSameOutput(self.run_process("line"), savedir, dates=self.dates[1:])
+    
+    def test_cache(self):
+        # Add some lines the batch functions can't handle, which the cache keeps as text
+        year, month = self.dates[1]
+        with open(main.get_load_filename(year=year, month=month, datadir=self.datadir), "a") as write_f:
+            write_f.write("garbage\n" * 3)
+            write_f.write('2010000001,2010000001,"VTS",1,,"2010-12-05 10:50:10","2010-12-05 11:10:11",40000,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n')
+            # (One that parses, so it's cached, but ends too late to be added)
+            write_f.write('2010000001,2010000001,"VTS",1,,"2010-12-05 10:50:10","2012-01-05 11:10:11",1,301,1.1,-73.970610,40.793724,-73.974672,40.783098\n')
+        cachedir = os.path.join(self.tempdir, "tripcache")
+        for (year, month) in self.dates[:2]:
+            # (As tripcache.py does)
+            tripcache._ingest(year, month, self.datadir, cachedir, batchsize=100, V=False)
+        savedir_line = self.run_process("line")
+        self.assertSameOutput(savedir_line, self.run_process("cache", engine="batch", cachedir=cachedir, batchsize=64))
+        self.assertSameOutput(savedir_line, self.run_process("cache_jobs", jobs=2, splits=2, cachedir=cachedir))
+        # The same errors are reported, without the text of the cached lines (the .csv isn't read)
+        for (year, month) in self.dates:
+            reports = []
+            for savedir in (savedir_line, os.path.join(self.tempdir, "cache")):
+                with open(os.path.join(savedir, "%d-%02d-errors.json" % (year, month)), "r") as read_f:
+                    reports.append(json.load(read_f))
+            self.assertEqual(reports[0]['counts'], reports[1]['counts'])
+            with open(main.get_load_filename(year=year, month=month, datadir=self.datadir), "r") as read_f:
+                lines = read_f.read().split("\n")
+            for reason, samples in reports[1]['samples'].items():
+                self.assertTrue(all(text is None or text == lines[line_number] for line_number, text in samples))
+        # With load_filename, their text is read back from the .csv
+        year, month = self.dates[1]
+        load_filename = main.get_load_filename(year=year, month=month, datadir=self.datadir)
+        spill = sparseutils.gen_empty_spill(w=2, h=3, n=2)
+        targets = {(2, 3, 2) : dict(vdata=utils.gen_empty_vdata(year=year, month=month, w=2, h=3, n=2),
+                                    fdata=sparseutils.gen_empty_sparse_fdata(year=year, month=month, w=2, h=3, n=2),
+                                    vdata_next_mo=spill['vdata'], fdata_next_mo=spill['fdata'], trips=np.zeros((2, 2, 2)))}
+        sink = errorsink.ErrorSink()
+        tripcache.process_cached(tripcache.get_month_cachedir(year=year, month=month, cachedir=cachedir), year, month,
+                                 targets, {(2, 3, 2) : None}, sink=sink, load_filename=load_filename)
+        with open(os.path.join(savedir_line, "%d-%02d-errors.json" % (year, month)), "r") as read_f:
+            self.assertEqual(sink.counts, json.load(read_f)['counts'])
+        with open(load_filename, "r") as read_f:
+            lines = read_f.read().split("\n")
+        for reason, samples in sink.samples.items():
+            self.assertTrue(all(text == lines[line_number] for line_number, text in samples))
+            if reason in utils.UNPARSABLE_REASONS:
+                self.assertTrue(all(utils.unparsable_reason(text) == reason for _, text in samples))
+        self.assertEqual(sink.counts['out_of_range'], 2)
+        
+        month_cachedir = tripcache.get_month_cachedir(year=year, month=month, cachedir=cachedir)
+        unparsable_lines = []
+        _, _, line_number = main.process_month(year=year, month=month, width=2, height=3, n=2, datadir=self.datadir,
+                                               cachedir=cachedir, unparsable_lines=unparsable_lines)
+        self.assertEqual(line_number, 500 + month + 5)
+        # (The passenger count that doesn't fit in int16 can't be added to vdata either)
+        self.assertEqual(unparsable_lines, [500 + month + ii for ii in range(1, 6)])
+        self.assertEqual(len(tripcache.load_columns(month_cachedir)['fallback_text']), 4)
+        # The trips each set of thresholds keeps, from the cache
+        data, _, _ = main.process_month(year=year, month=month, width=2, height=3, n=2, datadir=self.datadir)
+        kept, rejections = tripcache.validate_cached(month_cachedir, year, month,
+                                                     thresholds=[utils.DEFAULT_THRESHOLDS, dict(min_time=0)], batchsize=64,
+                                                     w=2, h=3, n=2)
+        self.assertEqual(sum(rejections[0].values()), data['errors'][0])
+        self.assertEqual(kept[0] + sum(rejections[0].values()), line_number - data['errors'][1])
+        self.assertTrue(kept[1] > kept[0] and rejections[1]['too_short'] == 0)
+        
+        # A changed .csv makes the cache stale
+        self.assertTrue(tripcache.has_cache(month_cachedir, load_filename))
+        with open(load_filename, "a") as write_f:
+            write_f.write("garbage\n")
+        self.assertFalse(tripcache.has_cache(month_cachedir, load_filename))
+    
+    def test_resolutions(self):
+        resolutions = [(4, 6, 2), (2, 3, 2), (2, 1, 1)]
+        savedirs = {}
+        for resolution in resolutions:
+            width, height, n = resolution
+            savedirs[resolution] = os.path.join(self.tempdir, "%dx%dn%d" % resolution)
+            os.makedirs(savedirs[resolution])
+            main.process(startyear=2010, startmonth=11, endyear=2011, endmonth=1, width=width, height=height,
+                         n=n, datadir=self.datadir, savedir=savedirs[resolution])
+        for name, kwargs in [("line", {}), ("batch", dict(engine="batch")),
+                             ("sparse_jobs", dict(engine="batch", sparse=True, jobs=2, splits=2))]:
+            savedir = self.run_process(name, resolutions=resolutions, **kwargs)
+            for resolution in resolutions:
+                self.assertSameOutput(savedirs[resolution], main.get_resolution_savedirs(resolutions, savedir)[resolution])
+        self.assertEqual(main.parse_resolution("5x10n2"), (5, 10, 2))
+    
+    def test_chunked_format(self):
+        savedir_line = self.run_process("line")
+        self.assertSameOutput(savedir_line, self.run_process("chunked", engine="batch", save_format="chunked"),
+                              save_format="chunked")
+        self.assertSameOutput(savedir_line, self.run_process("chunked_sparse", engine="batch", sparse=True, jobs=2,
+                                                             save_format="chunked"), save_format="chunked")
+    
+    def test_overflowing_pcount(self):
+        # Counted as unparsable (but in trips, and the spill), as update_data does, with sparse fdata too
+        self.add_overflowing_pcounts()
+        savedir_line = self.run_process("line")
+        errors = main.load_arrays(main.get_save_filename(year=2010, month=12, savedir=savedir_line))['errors']
+        self.assertEqual(errors[1], 2)
+        self.assertSameOutput(savedir_line, self.run_process("batch", engine="batch", batchsize=64))
+        self.assertSameOutput(savedir_line, self.run_process("sparse", engine="batch", batchsize=64, sparse=True))
+        self.assertSameOutput(savedir_line, self.run_process("sparse_jobs", engine="batch", sparse=True, jobs=2))
+    
+    def test_stream(self):
+        self.add_overflowing_pcounts()
+        savedir_line = self.run_process("line")
+        self.assertSameOutput(savedir_line, self.run_process("stream", engine="batch", batchsize=16, stream=True))
+        self.assertSameOutput(savedir_line, self.run_process("stream_chunked", engine="batch", stream=True,
+                                                             save_format="chunked"), save_format="chunked")
+        # (Only the saved months, and their errors, are left)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir, "stream"))),
+                         ["2010-11-data.npz", "2010-11-errors.json", "2010-12-data.npz", "2010-12-errors.json",
+                          "2011-01-data.npz", "2011-01-errors.json"])
+        with self.assertRaises(ValueError):
+            self.run_process("stream_jobs", engine="batch", jobs=2, stream=True)
+
+    def test_pipeline(self):
+        savedir_line = self.run_process("line")
+        for name, kwargs in [("pipeline", dict(pipeline_workers=0)), ("pipeline_workers", dict(pipeline_workers=2)),
+                             ("pipeline_stream", dict(pipeline_workers=1, stream=True)),
+                             ("pipeline_resume", dict(pipeline_workers=1, resume=True, splits=2))]:
+            savedir = self.run_process(name, engine="batch", batchsize=16, **kwargs)
+            self.assertSameOutput(savedir_line, savedir)
+        # The checkpoints saved in the background are the same too
+        savedir_resume = self.run_process("resume", engine="batch", batchsize=16, resume=True)
+        for (year, month) in self.dates:
+            checkpoint = main.load_arrays(main.get_checkpoint_filename(year=year, month=month, savedir=savedir_resume))
+            pipeline_checkpoint = main.load_arrays(main.get_checkpoint_filename(
+                year=year, month=month, savedir=os.path.join(self.tempdir, "pipeline_resume")))
+            for key in checkpoint:
+                self.assertTrue(np.array_equal(checkpoint[key], pipeline_checkpoint[key]))
+        with self.assertRaises(ValueError):
+            self.run_process("pipeline_line", pipeline_workers=1)
+
+        # Every batch is parsed, in order, and the blocked times are counted
+        lines = ["line %d" % ii for ii in range(100)]
+        with pipeline.Pipeline(workers=0, queuesize=1) as pipe:
+            batches = list(pipe.parse(lines, batchsize=7))
+        self.assertEqual([line for batch, _ in batches for line in batch], lines)
+        self.assertTrue(all(len(entries['ok']) == len(batch) and not entries['ok'].any() for batch, entries in batches))
+        self.assertEqual(list(pipe.blocked), list(pipeline.STAGES))
+        self.assertTrue(pipe.report().startswith("Blocked: read "))
+
+    def test_errors(self):
+        reports = {}
+        for name, kwargs in [("errors_line", dict()), ("errors_batch", dict(engine="batch", batchsize=64)),
+                             ("errors_parts", dict(engine="batch", resume=True, splits=3)),
+                             ("errors_jobs", dict(engine="batch", jobs=2, splits=2))]:
+            savedir = self.run_process(name, error_samples=4, **kwargs)
+            for (year, month) in self.dates:
+                with open(os.path.join(savedir, "%d-%02d-errors.json" % (year, month)), "r") as read_f:
+                    report = json.load(read_f)
+                errors = main.load_arrays(main.get_save_filename(year=year, month=month, savedir=savedir))['errors']
+                self.assertEqual([report['invalid'], report['unparsable']], list(errors))
+                self.assertEqual(report['invalid'], sum(report['counts'][reason] for reason in utils.INVALID_REASONS))
+                self.assertTrue(all(len(samples) <= 4 for samples in report['samples'].values()))
+                reports.setdefault((year, month), []).append(report['counts'])
+        for counts in reports.values():
+            self.assertTrue(all(other == counts[0] for other in counts))
+        
+        # Made up lines, with every kind of error
+        lines = list(benchmark.generate_lines(2012, 3, 5000, seed=1, malformed=0.02))[1:]
+        sinks = []
+        for engine in ("line", "batch"):
+            sink = errorsink.ErrorSink(samplesize=3)
+            spill = sparseutils.gen_empty_spill(w=2, h=3, n=2)
+            arrays = dict(vdata=utils.gen_empty_vdata(year=2012, month=3, w=2, h=3, n=2),
+                          fdata=utils.gen_empty_fdata(year=2012, month=3, w=2, h=3, n=2),
+                          vdata_next_mo=spill['vdata'], fdata_next_mo=spill['fdata'], trips=np.zeros((2, 2, 2)))
+            invalid_count, unparsable_count, _ = main.process_lines(lines, 2012, 3, width=2, height=3, n=2,
+                                                                    engine=engine, batchsize=500, sink=sink, **arrays)
+            self.assertEqual((sink.invalid, sink.unparsable), (invalid_count, unparsable_count))
+            for reason, samples in sink.samples.items():
+                self.assertEqual(len(samples), min(sink.counts[reason], 3))
+                for line_number, text in samples:
+                    self.assertEqual(text, lines[line_number - 1].rstrip("\n"))
+                    if reason in utils.UNPARSABLE_REASONS:
+                        self.assertEqual(utils.unparsable_reason(text), reason)
+            sinks.append(sink)
+        self.assertEqual(sinks[0].counts, sinks[1].counts)
+        self.assertTrue(all(sinks[0].counts[reason] > 0 for reason in ("missing_columns", "bad_timestamp", "bad_float",
+                                                                       "too_close", "too_short", "too_fast")))
+        merged = errorsink.ErrorSink(samplesize=3)
+        merged.merge(sinks[0])
+        merged.merge(sinks[1], offset=len(lines))
+        self.assertEqual(merged.unparsable, 2 * unparsable_count)
+        self.assertTrue(all(len(samples) <= 3 for samples in merged.samples.values()))
+        self.assertEqual(errorsink.ErrorSink.from_report(json.loads(json.dumps(merged.report()))).report(),
+                         merged.report())
+
+    def test_report(self):
+        savedir_line = self.run_process("line")
+        for name, kwargs in [("report_line", dict()), ("report_batch", dict(engine="batch", batchsize=64)),
+                             ("report_pipeline", dict(engine="batch", pipeline_workers=0))]:
+            savedir = self.run_process(name, report=True, profile_month=(2010, 12), **kwargs)
+            self.assertSameOutput(savedir_line, savedir)
+            with open(os.path.join(savedir, "process-report.jsonl"), "r") as read_f:
+                reports = [json.loads(line) for line in read_f]
+            self.assertEqual([(report['year'], report['month']) for report in reports], self.dates)
+            for report in reports:
+                lines = 500 + report['month']
+                self.assertEqual(report['lines'], lines)
+                self.assertEqual(report['stages']['read']['count'], lines)
+                self.assertEqual(report['bytes'], report['total_bytes'])
+                if name != "report_pipeline":
+                    self.assertEqual(report['stages']['parse']['count'], lines)
+                    self.assertTrue(0 < report['stages']['accumulate']['count'] <= lines)
+                filename = main.get_save_filename(year=report['year'], month=report['month'], savedir=savedir)
+                self.assertEqual(report['saved'], {filename : os.path.getsize(filename)})
+                self.assertEqual(report['stages']['save']['count'], os.path.getsize(filename))
+                self.assertTrue(report['peak_rss'] > 0 and report['lines_per_sec'] > 0)
+            # (Only the profiled month is profiled)
+            self.assertEqual([name for name in os.listdir(savedir) if "profile" in name], ["2010-12-profile.prof"])
+
+        # (With several resolutions, the entries are counted once)
+        savedir = self.run_process("report_resolutions", report=True, engine="batch", batchsize=64,
+                                   resolutions=[(2, 3, 2), (4, 6, 2), (2, 1, 1), (3, 3, 1)])
+        counts = []
+        for name in ("report_batch", "report_resolutions"):
+            with open(os.path.join(self.tempdir, name, "process-report.jsonl"), "r") as read_f:
+                counts.append([[report['stages'][stage]['count'] for stage in ("validate", "accumulate")]
+                               for report in (json.loads(line) for line in read_f)])
+        self.assertEqual(counts[0], counts[1])
+        
+        stats = instrument.MonthStats(2010, 12, total_bytes=1000)
+        list(stats.read(["a" * 99 + "\n"] * 5))
+        self.assertTrue(stats.progress().startswith("    Line 5, "))
+        self.assertTrue(", 50%, ETA " in stats.progress())
+        with self.assertRaises(ValueError):
+            self.run_process("report_jobs", jobs=2, report=True)
+
+    def test_resume(self):
+        savedir_line = self.run_process("line")
+        for name, kwargs in [("resume", dict(engine="batch")), ("resume_parts", dict(engine="batch", splits=3)),
+                             ("resume_jobs", dict(engine="batch", jobs=2, splits=2))]:
+            savedir = self.run_process(name, resume=True, **kwargs)
+            self.assertSameOutput(savedir_line, savedir)
+            self.assertTrue(main.has_checkpoint(year=2011, month=1, savedirs={None : savedir}))
+            self.assertEqual(len(os.listdir(savedir)), 9) # (No temporary files are left)
+            
+            # Stop after December (or, merging in parallel, before it but after January): November isn't read again
+            for (year, month) in [(2011, 1), (2010, 12)]:
+                os.remove(main.get_save_filename(year=year, month=month, savedir=savedir))
+                os.remove(main.get_checkpoint_filename(year=year, month=month, savedir=savedir))
+                load_filename = main.get_load_filename(year=2010, month=11, datadir=self.datadir)
+                os.rename(load_filename, load_filename + ".moved")
+                try:
+                    main.process(startyear=2010, startmonth=11, endyear=2011, endmonth=1, width=2, height=3, n=2,
+                                 datadir=self.datadir, savedir=savedir, resume=True, **kwargs)
+                finally:
+                    os.rename(load_filename + ".moved", load_filename)
+                self.assertSameOutput(savedir_line, savedir)
+        
+        # Within a month, only the parts that aren't saved are processed
+        kwargs = dict(year=2010, month=12, resolutions=[(2, 3, 2)], engine="batch", datadir=self.datadir)
+        partsdir = os.path.join(self.tempdir, "parts")
+        data, spill, line_number = main.process_month_parts(partsdir=partsdir, splits=3, **kwargs)
+        os.remove(os.path.join(partsdir, "2010-12-2.json"))
+        modified = os.path.getmtime(os.path.join(partsdir, "2010-12-0-2x3n2-data.npz"))
+        data_2, spill_2, line_number_2 = main.process_month_parts(partsdir=partsdir, splits=3, **kwargs)
+        self.assertEqual(modified, os.path.getmtime(os.path.join(partsdir, "2010-12-0-2x3n2-data.npz")))
+        data_1, spill_1, line_number_1 = main.process_month_resolutions(**kwargs)
+        self.assertEqual(line_number, line_number_1)
+        self.assertEqual(line_number_2, line_number_1)
+        for key in data_1[(2, 3, 2)]:
+            self.assertTrue(np.array_equal(data_1[(2, 3, 2)][key], data[(2, 3, 2)][key]))
+            self.assertTrue(np.array_equal(data_1[(2, 3, 2)][key], data_2[(2, 3, 2)][key]))
+        for key in spill_1[(2, 3, 2)]:
+            self.assertTrue(np.array_equal(spill_1[(2, 3, 2)][key].index, spill_2[(2, 3, 2)][key].index))
+            self.assertTrue(np.array_equal(spill_1[(2, 3, 2)][key].values, spill_2[(2, 3, 2)][key].values))
+    
+    def test_slot_reader(self):
+        # (Reading what main.py saved doesn't import processing)
+        code = "import sys, slotreader, regrid, script_data_to_stdn; sys.exit('main' in sys.modules)"
+        self.assertEqual(subprocess.call([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__))), 0)
+        savedirs = [self.run_process("line"),
+                    self.run_process("chunked", engine="batch", save_format="chunked"),
+                    self.run_process("chunked_sparse", engine="batch", sparse=True, jobs=2, save_format="chunked"),
+                    self.run_process("sparse", engine="batch", sparse=True)]
+        # One day of slots per chunk
+        filename = main.get_save_filename(year=2010, month=11, savedir=savedirs[1], save_format="chunked")
+        with zipfile.ZipFile(filename) as archive:
+            self.assertEqual(json.loads(archive.read("meta.json"))['arrays']['fdata']['bounds'][:3], [0, 48, 96])
+        
+        months = [main.load_arrays(main.get_save_filename(year=year, month=month, savedir=savedirs[0]))
+                  for (year, month) in self.dates]
+        full = {'vdata' : np.concatenate([data['vdata'] for data in months], axis=0),
+                'fdata' : np.concatenate([data['fdata'] for data in months], axis=1)}
+        ranges = [(0, 0), (0, 1), (10, 100), (47, 49), (1439, 1441), (1430, 2930), (0, full['vdata'].shape[0]),
+                  (full['vdata'].shape[0], full['vdata'].shape[0])]
+        for savedir in savedirs:
+            reader = slotreader.SlotReader(savedir=savedir, startyear=2010, startmonth=11, endyear=2011, endmonth=1, n=2)
+            self.assertEqual(reader.slots, full['vdata'].shape[0])
+            self.assertEqual(reader.slot(2010, 12, 3), 30*48 + 3)
+            for (start, end) in ranges:
+                vdata = reader.read("vdata", start, end)
+                fdata = reader.read("fdata", start, end)
+                self.assertEqual(vdata.dtype, full['vdata'].dtype)
+                self.assertEqual(fdata.dtype, full['fdata'].dtype)
+                self.assertTrue(np.array_equal(vdata, full['vdata'][start:end]))
+                self.assertTrue(np.array_equal(fdata, full['fdata'][:, start:end]))
+            with self.assertRaises(ValueError):
+                reader.read("vdata", 10, reader.slots + 1)
+    
+    def test_stdn(self):
+        savedirs = [self.run_process("line"),
+                    self.run_process("sparse", engine="batch", sparse=True),
+                    self.run_process("chunked", engine="batch", save_format="chunked"),
+                    self.run_process("chunked_sparse", engine="batch", sparse=True, save_format="chunked")]
+        stdn_savedirs = [self.run_process("stdn", stdn=True),
+                         self.run_process("stdn_jobs", engine="batch", sparse=True, jobs=2, stdn=True, save_format="chunked")]
+        # (Small slabs, so each month is read in many)
+        script_data_to_stdn.data_to_stdn(2010, 11, 2011, 1, datadir=savedirs[0], memory=1000)
+        script_data_to_stdn.data_to_stdn(2010, 11, 2011, 1, datadir=savedirs[1], memory=1000, jobs=2)
+        script_data_to_stdn.data_to_stdn(2010, 11, 2011, 1, datadir=savedirs[2], memory=100000, save_format="chunked")
+        script_data_to_stdn.data_to_stdn(2010, 11, 2011, 1, datadir=savedirs[3], memory=1000)
+        for (year, month) in self.dates:
+            data = main.load_arrays(main.get_save_filename(year=year, month=month, savedir=savedirs[0]))
+            for savedir in savedirs + stdn_savedirs:
+                self.assertFalse(any(name.endswith(".tmp.npy") for name in os.listdir(savedir)))
+                save_format = "chunked" if savedir in (savedirs[2], stdn_savedirs[1]) else "npz"
+                for name, array in (("volume", data['vdata'][..., 1]), ("flow", data['fdata'][..., 1])):
+                    filename = main.get_stdn_filename(year=year, month=month, name=name, savedir=savedir,
+                                                      save_format=save_format)
+                    if save_format == "chunked":
+                        stdn_array = chunkedio.load_chunked(filename)['arr_0']
+                    else:
+                        with np.load(filename) as stdn_data:
+                            stdn_array = stdn_data['arr_0']
+                    self.assertEqual(stdn_array.dtype, array.dtype)
+                    self.assertTrue(np.array_equal(stdn_array, array))
+            # Only the STDN files are saved
+            self.assertFalse(os.path.exists(main.get_save_filename(year=year, month=month, savedir=stdn_savedirs[0])))
+    
+    def test_regrid(self):
+        # At 4x6, n=4
+        savedirs = [self.run_process("fine", engine="batch", resolutions=[(4, 6, 4)]),
+                    self.run_process("fine_sparse", engine="batch", resolutions=[(4, 6, 4)], sparse=True,
+                                     save_format="chunked")]
+        for resolution in [(2, 3, 2), (4, 3, 1)]:
+            # (Small slabs, so each month is read in many)
+            regrid.regrid(2010, 11, 2011, 1, resolution=resolution, datadir=savedirs[0], memory=100000, jobs=2)
+            regrid.regrid(2010, 11, 2011, 1, resolution=resolution, datadir=savedirs[1], memory=100000,
+                          savedir=os.path.join(self.tempdir, "coarse"), save_format="chunked")
+            factors = utils.resolution_factors((4, 6, 4), resolution)
+            for (year, month) in self.dates:
+                data = main.load_arrays(main.get_save_filename(year=year, month=month, savedir=savedirs[0]))
+                for filename in [main.get_save_filename(year=year, month=month,
+                                                        savedir=os.path.join(savedirs[0], "%dx%dn%d" % resolution)),
+                                 main.get_save_filename(year=year, month=month, savedir=os.path.join(self.tempdir, "coarse"),
+                                                        save_format="chunked")]:
+                    coarse = main.load_arrays(filename)
+                    self.assertEqual(sorted(coarse.keys()), sorted(data.keys()))
+                    for key in data:
+                        expected = utils.coarsen(data[key], utils.array_factors(key, factors)) \
+                                   if key in ("vdata", "fdata") else data[key]
+                        self.assertEqual(coarse[key].dtype, expected.dtype)
+                        self.assertTrue(np.array_equal(coarse[key], expected))
+            self.assertFalse(any(name.endswith(".tmp.npy") for name in os.listdir(os.path.join(self.tempdir, "coarse"))))
+        
+        # The processed arrays at 2x3, n=2 are the same, except for the first axis of fdata
+        savedir_coarse = self.run_process("coarse_processed", engine="batch")
+        for (year, month) in self.dates:
+            data = main.load_arrays(main.get_save_filename(year=year, month=month, savedir=savedir_coarse))
+            coarse = main.load_arrays(main.get_save_filename(year=year, month=month,
+                                                             savedir=os.path.join(savedirs[0], "2x3n2")))
+            self.assertTrue(np.array_equal(data['vdata'], coarse['vdata']))
+            self.assertTrue(np.array_equal(data['fdata'].sum(axis=0), coarse['fdata'].sum(axis=0)))
+        
+        with self.assertRaises(ValueError):
+            regrid.regrid_month(2010, 11, resolution=(3, 3, 2), datadir=savedirs[0],
+                                savedir=os.path.join(self.tempdir, "coarse"))
+        with self.assertRaises(ValueError):
+            regrid.regrid_month(2010, 11, resolution=(2, 3, 3), datadir=savedirs[0],
+                                savedir=os.path.join(self.tempdir, "coarse"))
+    
+    def test_monthly_dataset(self):
+        savedirs = [self.run_process("line"),
+                    self.run_process("chunked_sparse", engine="batch", sparse=True, save_format="chunked")]
+        months = [main.load_arrays(main.get_save_filename(year=year, month=month, savedir=savedirs[0]))
+                  for (year, month) in self.dates]
+        full = {'vdata' : np.concatenate([data['vdata'] for data in months], axis=0),
+                'fdata' : np.concatenate([data['fdata'] for data in months], axis=1)}
+        # STDN files, as made by script_data_to_stdn.py
+        for data, (year, month) in zip(months, self.dates):
+            np.savez_compressed(os.path.join(savedirs[0], "STDN-volume-%d-%02d.npz" % (year, month)), data['vdata'][..., 1])
+            np.savez_compressed(os.path.join(savedirs[0], "STDN-flow-%d-%02d.npz" % (year, month)), data['fdata'][..., 1])
+        
+        slots = full['vdata'].shape[0]
+        keys = [slice(None), slice(10, 100), slice(1400, 1500, 7), slice(5, 2000, 48), slice(100, 50),
+                3, 1450, -1, (slice(1430, 1450), 1), (slice(0, slots, 500), Ellipsis, 0), (Ellipsis, 1)]
+        fkeys = [(slice(None), slice(1430, 1450)), (1, slice(1400, 1500, 3), 0, 1), (0, 1441), (0, slice(10, 20), Ellipsis, 1),
+                 (Ellipsis, 0), (slice(None), -3, 1)]
+        for savedir, stdn in ((savedirs[0], False), (savedirs[1], False), (savedirs[0], True)):
+            # (A cache of about two months of fdata)
+            dataset = slotreader.MonthlyDataset(savedir=savedir, startyear=2010, startmonth=11, endyear=2011, endmonth=1,
+                                                n=2, stdn=stdn, cachebytes=1000000)
+            vdata = full['vdata'][..., 1] if stdn else full['vdata']
+            fdata = full['fdata'][..., 1] if stdn else full['fdata']
+            self.assertEqual(dataset.vdata.shape, vdata.shape)
+            self.assertEqual(dataset.fdata.shape, fdata.shape)
+            self.assertEqual(dataset.fdata.dtype, fdata.dtype)
+            for key in keys:
+                self.assertTrue(np.array_equal(dataset.vdata[key], vdata[key]), key)
+            for key in fkeys:
+                self.assertTrue(np.array_equal(dataset.fdata[key], fdata[key]), key)
+            self.assertTrue(dataset.cached_bytes <= 1000000)
+            self.assertTrue(stdn or savedir == savedirs[1] or len(dataset.cache) < 2*len(self.dates))
+            self.assertTrue(np.array_equal(np.asarray(dataset.vdata), vdata))
+            # Writing into what was read doesn't change the months in the cache
+            for array, key in ((dataset.vdata, 5), (dataset.fdata, (0, 1441))):
+                written = array[key]
+                written[...] = 1000
+                self.assertTrue(np.array_equal(array[key], (vdata if array is dataset.vdata else fdata)[key]))
+            with self.assertRaises(IndexError):
+                dataset.vdata[slots]
+            with self.assertRaises(IndexError):
+                dataset.vdata[::-1]
+
+class ReadersTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_byte_ranges(self):
+        filename = os.path.join(self.tempdir, "test.csv")
+        contents = ["header\n", "a,b\n", "c,d\r\n", "\n", "e\rf\n"] + ["%d,%d\n" % (ii, ii*ii) for ii in range(100)] + ["last"]
+        with open(filename, "w", newline="") as write_f:
+            write_f.write("".join(contents))
+        with open(filename, "r") as read_f:
+            read_f.readline() # Skip header
+            expected_lines = list(read_f)
+        
+        for parts in (1, 2, 3, 10, 1000):
+            byte_ranges = readers.split_byte_ranges(filename, parts)
+            self.assertTrue(len(byte_ranges) <= parts)
+            self.assertEqual(byte_ranges[0][0], len(contents[0]))
+            self.assertEqual(byte_ranges[-1][1], os.path.getsize(filename))
+            lines = []
+            for (start, end) in byte_ranges:
+                lines += list(readers.read_byte_range(filename, start, end, blocksize=7))
+            self.assertEqual(lines, expected_lines)
+    
+    def test_compressed(self):
+        os.makedirs(os.path.join(self.tempdir, "FOIL2010"))
+        filename = os.path.join(self.tempdir, "FOIL2010", "test.csv")
+        contents = "".join(["header\n", "a,b\n", "c,d\r\n", "\n", "e\rf\n"] +
+                           ["%d,%d\n" % (ii, ii*ii) for ii in range(1000)] + ["last"])
+        with open(filename, "w", newline="") as write_f:
+            write_f.write(contents)
+        with open(filename, "r") as read_f:
+            expected_lines = list(read_f)
+        self.assertEqual(list(readers.read_lines(filename)), expected_lines)
+        os.remove(filename)
+        self.assertEqual(readers.find_source(filename), (filename, None))
+        
+        sources = [(filename + ".gz", None), (filename + ".zip", "test.csv"),
+                   (os.path.join(self.tempdir, "FOIL2010.zip"), "FOIL2010/test.csv")]
+        for path, member in sources:
+            if member is None:
+                with gzip.open(path, "wb") as write_f:
+                    write_f.write(contents.encode())
+            else:
+                with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                    archive.writestr("other.csv", "header\n")
+                    archive.writestr(member, contents)
+            self.assertEqual(readers.find_source(filename), (path, member))
+            self.assertTrue(readers.is_compressed(filename))
+            self.assertEqual(list(readers.read_lines(filename, blocksize=7, queuesize=1)), expected_lines)
+            self.assertEqual(list(readers.read_lines(filename)), expected_lines)
+            # Stopping early stops the background thread
+            lines = readers.read_lines(filename, blocksize=7, queuesize=1)
+            self.assertEqual(next(lines), expected_lines[0])
+            lines.close()
+            os.remove(path)
+
+class ChunkedIOTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_round_trip(self):
+        fdata = np.zeros((2, 96, 3, 2, 3, 2, 2), dtype=np.int16)
+        fdata.reshape(-1)[np.random.randint(0, fdata.size, 1000)] = np.random.randint(-2**15, 2**15, 1000)
+        arrays = {'vdata'       : np.random.randint(0, 100, (96, 3, 2, 2, 2)).astype(np.int16),
+                  'fdata'       : fdata,
+                  'trips'       : np.random.rand(2, 2, 2),
+                  'errors'      : np.array([10, 2]),
+                  'fdata_dtype' : np.array("<i2"),
+                  'empty'       : np.zeros((0, 4), dtype=np.float32)}
+        filename = os.path.join(self.tempdir, "data" + chunkedio.extension)
+        # Small chunks, so each array is split into several
+        chunkedio.save_chunked(filename, arrays, chunkbytes=1000, workers=3)
+        self.assertTrue(chunkedio.is_chunked(filename))
+        self.assertEqual(chunkedio.read_chunked_header(filename, "fdata"), (fdata.shape, np.dtype(np.int16)))
+        loaded = chunkedio.load_chunked(filename, workers=2)
+        self.assertEqual(sorted(loaded.keys()), sorted(arrays.keys()))
+        for key in arrays:
+            self.assertEqual(loaded[key].dtype, arrays[key].dtype)
+            self.assertEqual(loaded[key].shape, arrays[key].shape)
+            self.assertTrue(np.array_equal(loaded[key], arrays[key]))
+        self.assertEqual(list(chunkedio.load_chunked(filename, keys=["trips"]).keys()), ["trips"])
+        
+        # Split along another axis, from a memory map
+        mmap_filename = os.path.join(self.tempdir, "vdata.npy")
+        np.save(mmap_filename, arrays['vdata'])
+        chunkedio.save_chunked(filename, {'vdata' : np.load(mmap_filename, mmap_mode="r")}, chunkbytes=10, axes={'vdata' : 2})
+        self.assertTrue(np.array_equal(chunkedio.load_chunked(filename)['vdata'], arrays['vdata']))
+        
+        with self.assertRaises(ValueError):
+            chunkedio.save_chunked(filename, {'objects' : np.array([None, 1])})
+    
+    def test_load_range(self):
+        arrays = {'vdata' : np.random.randint(0, 100, (96, 3, 2, 2, 2)).astype(np.int16),
+                  'fdata' : np.random.randint(0, 100, (2, 96, 3, 2, 3, 2, 2)).astype(np.int16)}
+        filename = os.path.join(self.tempdir, "data" + chunkedio.extension)
+        chunkedio.save_chunked(filename, arrays, chunkslots=24)
+        self.assertEqual(sorted(chunkedio.read_chunked_names(filename)), ["fdata", "vdata"])
+        for (start, end) in [(0, 96), (0, 0), (96, 96), (5, 6), (23, 25), (24, 48), (10, 90)]:
+            self.assertTrue(np.array_equal(chunkedio.load_range(filename, "vdata", start, end),
+                                           arrays['vdata'][start:end]))
+            self.assertTrue(np.array_equal(chunkedio.load_range(filename, "fdata", start, end, workers=2),
+                                           arrays['fdata'][:, start:end]))
+        with self.assertRaises(ValueError):
+            chunkedio.load_range(filename, "vdata", 90, 97)
+
+class STDNSamplerTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dates = [(2010, 1), (2010, 2)]
+        slots = sum(utils.no_samples_in_mo(year=year, month=month, n=2) for (year, month) in self.dates)
+        self.volume = np.random.randint(0, 100, (slots, 3, 4, 2)).astype(np.int16)
+        self.flow = np.random.randint(0, 100, (2, slots, 3, 4, 3, 4)).astype(np.int16)
+        np.save(os.path.join(self.tempdir, "STDN-volume.npy"), self.volume)
+        np.save(os.path.join(self.tempdir, "STDN-flow.npy"), self.flow)
+        start = 0
+        for (year, month) in self.dates:
+            end = start + utils.no_samples_in_mo(year=year, month=month, n=2)
+            np.savez_compressed(os.path.join(self.tempdir, "STDN-volume-%d-%02d.npz" % (year, month)), self.volume[start:end])
+            np.savez_compressed(os.path.join(self.tempdir, "STDN-flow-%d-%02d.npz" % (year, month)), self.flow[:, start:end])
+            start = end
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def naive_sample(self, t, x, y, radius, lookback, periods, period_slots, period):
+        # One sample, built one value at a time
+        def window(s):
+            volume = np.zeros((2*radius + 1, 2*radius + 1, 2), dtype=np.int16)
+            flow = np.zeros((2*radius + 1, 2*radius + 1, 4), dtype=np.int16)
+            for ii, nx in enumerate(range(x - radius, x + radius + 1)):
+                for jj, ny in enumerate(range(y - radius, y + radius + 1)):
+                    if 0 <= nx < 3 and 0 <= ny < 4:
+                        volume[ii, jj] = self.volume[s, nx, ny]
+                        flow[ii, jj] = [self.flow[0, s, nx, ny, x, y], self.flow[1, s, nx, ny, x, y],
+                                        self.flow[0, s, x, y, nx, ny], self.flow[1, s, x, y, nx, ny]]
+            return volume, flow
+        short = [window(s) for s in range(t - lookback, t)]
+        periodic = [[window(t - p*period + q) for q in range(-period_slots, period_slots + 1)]
+                    for p in range(periods, 0, -1)]
+        return {'volume'          : np.array([v for (v, _) in short]),
+                'flow'            : np.array([f for (_, f) in short]),
+                'periodic_volume' : np.array([[v for (v, _) in day] for day in periodic]),
+                'periodic_flow'   : np.array([[f for (_, f) in day] for day in periodic]),
+                'target'          : self.volume[t, x, y]}
+    
+    def test_batch(self):
+        dataset = slotreader.MonthlyDataset(savedir=self.tempdir, startyear=2010, startmonth=1, endyear=2010, endmonth=2,
+                                            n=2, stdn=True)
+        params = dict(radius=1, lookback=3, periods=2, period_slots=1, n=2)
+        samplers = [stdnsamples.STDNSampler(self.volume, self.flow, **params),
+                    stdnsamples.STDNSampler(os.path.join(self.tempdir, "STDN-volume.npy"),
+                                            os.path.join(self.tempdir, "STDN-flow.npy"), **params),
+                    stdnsamples.STDNSampler(dataset.vdata, dataset.fdata, **params)]
+        self.assertEqual(samplers[0].start_slot, 2*48 + 1)
+        self.assertEqual(len(samplers[0]), (self.volume.shape[0] - 2*48 - 1) * 12)
+        samples = np.random.randint(0, len(samplers[0]), 50)
+        samples[:2] = [0, len(samplers[0]) - 1]
+        for sampler in samplers:
+            batch = sampler.batch(samples)
+            for ii, sample in enumerate(samples):
+                t, x, y = batch['t'][ii], batch['x'][ii], batch['y'][ii]
+                self.assertEqual(sample, (t - sampler.start_slot)*12 + x*4 + y)
+                expected = self.naive_sample(t, x, y, radius=1, lookback=3, periods=2, period_slots=1, period=48)
+                for key in expected:
+                    self.assertEqual(batch[key].dtype, np.int16)
+                    self.assertTrue(np.array_equal(batch[key][ii], expected[key]), key)
+        
+        with self.assertRaises(ValueError):
+            stdnsamples.STDNSampler(self.volume, self.flow[:, 1:])
+    
+    def test_batches(self):
+        params = dict(radius=2, lookback=2, periods=1, period_slots=2, n=2, period=96, start_slot=200, end_slot=300)
+        dataset = slotreader.MonthlyDataset(savedir=self.tempdir, startyear=2010, startmonth=1, endyear=2010, endmonth=2,
+                                            n=2, stdn=True)
+        sampler = stdnsamples.STDNSampler(os.path.join(self.tempdir, "STDN-volume.npy"),
+                                          os.path.join(self.tempdir, "STDN-flow.npy"), **params)
+        self.assertEqual(len(sampler), 100*12)
+        batches = list(sampler.batches(batchsize=100, seed=1))
+        self.assertEqual(sorted(np.concatenate([batch['t'] * 12 + batch['x'] * 4 + batch['y'] for batch in batches])),
+                         list(range(200*12, 300*12)))
+        for other in [sampler, stdnsamples.STDNSampler(dataset.vdata, dataset.fdata, **params)]:
+            other_batches = list(other.batches(batchsize=100, seed=1, workers=2))
+            self.assertEqual(len(other_batches), len(batches))
+            for batch, other_batch in zip(batches, other_batches):
+                for key in batch:
+                    self.assertTrue(np.array_equal(batch[key], other_batch[key]))
+        self.assertTrue(stdnsamples.measure_throughput(sampler, batchsize=100, batches=2) > 0)
+
+class ScriptCompileSTDNTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dates = [(2012, 11), (2012, 12), (2013, 1), (2013, 2)]
+        self.vdata = []
+        self.fdata = []
+        for (year, month) in self.dates:
+            samples = utils.no_samples_in_mo(year=year, month=month, n=1)
+            self.vdata.append(np.random.randint(0, 100, (samples, 2, 3, 2)).astype(np.int16))
+            self.fdata.append(np.random.randint(0, 100, (2, samples, 2, 3, 2, 3)).astype(np.int16))
+            np.savez_compressed(os.path.join(self.tempdir, "STDN-volume-%d-%02d.npz" % (year, month)), self.vdata[-1])
+            np.savez_compressed(os.path.join(self.tempdir, "STDN-flow-%d-%02d.npz" % (year, month)), self.fdata[-1])
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_compile(self):
+        filename = os.path.join(self.tempdir, "STDN-flow-2012-12.npz")
+        self.assertEqual(script_compile_STDN.read_npz_header(filename), (self.fdata[1].shape, np.dtype(np.int16)))
+        
+        script_compile_STDN.compile_stdn(2012, 12, 2013, 2, datadir=self.tempdir)
+        with np.load(os.path.join(self.tempdir, "STDN-volume.npz")) as data:
+            self.assertTrue(np.array_equal(data['arr_0'], np.concatenate(self.vdata[1:], axis=0)))
+        with np.load(os.path.join(self.tempdir, "STDN-flow.npz")) as data:
+            self.assertTrue(np.array_equal(data['arr_0'], np.concatenate(self.fdata[1:], axis=1)))
+        
+        script_compile_STDN.compile_stdn(2012, 11, 2013, 2, datadir=self.tempdir, save_format="npy")
+        self.assertTrue(np.array_equal(np.load(os.path.join(self.tempdir, "STDN-flow.npy"), mmap_mode="r"),
+                                       np.concatenate(self.fdata, axis=1)))
+        self.assertFalse(any(name.endswith(".tmp.npy") for name in os.listdir(self.tempdir)))
+        
+        # Chunked monthly files are used when they exist, and chunked output
+        chunkedio.save_chunked(os.path.join(self.tempdir, "STDN-flow-2013-01" + chunkedio.extension),
+                               {'arr_0' : self.fdata[2]}, axes={'arr_0' : 1})
+        os.remove(os.path.join(self.tempdir, "STDN-flow-2013-01.npz"))
+        script_compile_STDN.compile_stdn(2012, 11, 2013, 2, datadir=self.tempdir, save_format="chunked")
+        self.assertTrue(np.array_equal(chunkedio.load_chunked(os.path.join(self.tempdir, "STDN-flow.npzc"))['arr_0'],
+                                       np.concatenate(self.fdata, axis=1)))
+        
+        # Months of different resolutions can't be compiled together
+        np.savez_compressed(os.path.join(self.tempdir, "STDN-volume-2013-02.npz"), self.vdata[-1][:, :1])
+        with self.assertRaises(ValueError):
+            script_compile_STDN.compile_stdn(2013, 1, 2013, 2, datadir=self.tempdir)
+
+class BenchmarkTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_generate_lines(self):
+        lines = list(benchmark.generate_lines(2010, 12, 5000, seed=3, malformed=0.02, invalid=0.1, crossing=0.02))
+        self.assertTrue(lines == list(benchmark.generate_lines(2010, 12, 5000, seed=3, malformed=0.02, invalid=0.1,
+                                                               crossing=0.02)))
+        self.assertFalse(lines == list(benchmark.generate_lines(2010, 12, 5000, seed=4)))
+        counts = {'unparsable' : 0, 'invalid' : 0, 'crossing' : 0}
+        last_start = None
+        for line in lines:
+            try:
+                entry = utils.process_entry(line)
+            except:
+                counts['unparsable'] += 1
+                continue
+            start = (entry['sday'], entry['shour'], entry['smin'], entry['ssec'])
+            self.assertTrue(last_start is None or last_start <= start) # In order of pickup time
+            last_start = start
+            if not utils.check_valid(entry, year=2010, month=12):
+                counts['invalid'] += 1
+            elif (entry['eyear'], entry['emonth']) == (2011, 1):
+                counts['crossing'] += 1
+        self.assertTrue(50 <= counts['unparsable'] <= 150)
+        self.assertTrue(350 <= counts['invalid'] <= 650)
+        self.assertTrue(50 <= counts['crossing'] <= 150)
+        # The same columns as example.csv
+        with open("example.csv", "r") as read_f:
+            self.assertEqual(read_f.readline(), benchmark.header)
+            self.assertEqual(len(read_f.readline().split(",")), len(lines[0].split(",")))
+    
+    def test_benchmark(self):
+        results = benchmark.benchmark(lines=500, month=12, resolutions=[(2, 3, 2)], batchsize=64, workdir=self.tempdir,
+                                      stages=["process_entry", "update_data_entries", "process_month_batch", "save"],
+                                      crossing=0.01, V=False)
+        self.assertEqual(os.listdir(self.tempdir), [])
+        self.assertEqual([result['stage'] for result in results['results']],
+                         ["process_entry", "update_data_entries", "process_month_batch", "save"])
+        for result in results['results']:
+            self.assertEqual(result['resolution'], "2x3n2")
+            self.assertTrue(result['peak_rss'] >= result['setup_peak_rss'] > 0)
+        self.assertEqual(results['results'][0]['lines'], 500)
+        self.assertTrue(results['results'][-1]['bytes'] > 0)
+        json.dumps(results)
+        
+        # Stages more than 10% slower are flagged
+        slow = json.loads(json.dumps(results))
+        slow['results'][0]['lines_per_sec'] = results['results'][0]['lines_per_sec'] / 2
+        rows, slower = benchmark.compare(results, slow)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(slower, [("2x3n2", "process_entry")])
+        self.assertEqual(benchmark.compare(slow, results)[1], [])
+
+class GoldenTest(ut.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    
+    def test_candidates(self):
+        # Every candidate saves the same as the per-line path, over a month boundary
+        report = golden.check([(2010, 12), (2011, 1)], resolutions=[(4, 6, 2), (2, 3, 2)], batchsize=64,
+                              workdir=self.tempdir, synthetic=1000)
+        self.assertEqual(os.listdir(self.tempdir), [])
+        self.assertEqual(list(report['candidates']), list(golden.CANDIDATES))
+        for name, result in report['candidates'].items():
+            self.assertEqual(len(result['months']), 4)
+            self.assertTrue(result['equal'], "\n".join(golden.format_report(report)))
+        self.assertTrue(report['equal'])
+        json.dumps(report)
+        report = golden.check([(2010, 1)], resolutions=[(2, 3, 2)], candidates=["batch"], workdir=self.tempdir,
+                              example=True)
+        self.assertTrue(report['equal'])
+    
+    def test_diff_arrays(self):
+        expected = np.zeros((3, 4, 5), dtype=np.int16)
+        self.assertTrue(golden.diff_arrays(expected, expected.copy())['equal'])
+        self.assertFalse(golden.diff_arrays(expected, expected.astype(np.int32))['equal'])
+        self.assertFalse(golden.diff_arrays(expected, expected[:2])['equal'])
+        actual = expected.copy()
+        actual[1, 2, 3] = 7
+        actual[2, 0, 3] = -1
+        actual[2, 2, 4] = 1
+        diff = golden.diff_arrays(expected, actual, limit=1)
+        self.assertFalse(diff['equal'])
+        self.assertEqual((diff['differing'], diff['first'], diff['expected'], diff['actual']), (3, [1, 2, 3], 0, 7))
+        self.assertEqual([axis['count'] for axis in diff['axes']], [2, 2, 2])
+        self.assertEqual([axis['indices'] for axis in diff['axes']], [[[1, 1]], [[0, 1]], [[3, 2]]])
+        self.assertEqual(golden.format_diff("vdata", diff)[0], "vdata: 3 elements differ, first at (1, 2, 3): expected 0, actual 7")
+        json.dumps(diff)
+        # (Compared a few rows at a time)
+        expected = np.zeros((2**12, 2**13), dtype=np.int16)
+        actual = expected.copy()
+        actual[-1, -1] = 1
+        self.assertEqual(golden.diff_arrays(expected, actual)['first'], [2**12 - 1, 2**13 - 1])
+        nan = np.array([np.nan, 1.0])
+        self.assertTrue(golden.diff_arrays(nan, nan.copy())['equal'])
+
 all_tests = [GPSUtilsTest,
              UtilsMiscTest,
              UtilsProcessEntryTest,
-             UtilsUpdateDataTest]
+             UtilsUpdateDataTest,
+             UtilsBatchTest,
+             SparseUtilsTest,
+             ReadersTest,
+             MainProcessTest,
+             ChunkedIOTest,
+             STDNSamplerTest,
+             ScriptCompileSTDNTest,
+             BenchmarkTest,
+             GoldenTest]
 
 for test in all_tests:
     ut.TextTestRunner(verbosity=2).run(ut.TestLoader().loadTestsFromTestCase(test))
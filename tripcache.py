@@ -0,0 +1,357 @@
+''' A columnar binary cache of the trip data.
+
+Parsing the .csv files is the slowest part of processing them, but
+timestamps, coordinates and passenger counts don't change when the grid
+or time slots do. Ingesting a month parses its .csv once into one
+memory-mappable .npy file per column:
+
+    line:       Line number in the .csv (header excluded), int64
+    sepoch:     Start time, in seconds since 1970-01-01, int64
+    eepoch:     End time, in seconds since 1970-01-01, int64
+    sx, sy:     Start coordinates in the unit grid (see GPSUtils), float64
+    ex, ey:     End coordinates in the unit grid, float64
+    l2distance: Straight-line (l2) distance in m, float64
+    distance:   Trip distance from the .csv, float64
+    pcount:     Passenger count, int64
+
+Lines that the batch functions in utils can't handle are kept as text
+(fallback_text.npy, with their line numbers in fallback_line.npy) and go
+through the per-line functions, so processing from the cache gives the
+same results as processing the .csv.
+
+Usage, to ingest 2010-2013 from ../decompressed into ../cache:
+
+    python3.6 tripcache.py -v --datadir ../decompressed --cachedir ../cache
+
+Then run main.py with --cachedir ../cache. With --thresholds, it instead
+counts how many trips of each cached month each set of thresholds of
+utils.check_valid would keep (see validate_cached), without processing
+them.
+'''
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import contextlib
+import collections
+import concurrent.futures
+import numpy as np
+import utils
+import readers
+import sparseutils
+import savefiles
+
+columns = (('line',       np.int64),
+           ('sepoch',     np.int64),
+           ('eepoch',     np.int64),
+           ('sx',         np.float64),
+           ('sy',         np.float64),
+           ('ex',         np.float64),
+           ('ey',         np.float64),
+           ('l2distance', np.float64),
+           ('distance',   np.float64),
+           ('pcount',     np.int64))
+
+def get_month_cachedir(year, month, cachedir):
+    ''' Get the directory holding the cache of the given (year, month)'''
+    return os.path.join(cachedir, str(year)+"-"+str(month).zfill(2))
+
+def _source_info(load_filename):
+    # Size and modification time of the .csv (or the file it's read from), to tell if a cache is stale
+    stat = os.stat(readers.find_source(load_filename)[0])
+    return {'source_size' : stat.st_size, 'source_mtime_ns' : stat.st_mtime_ns}
+
+def has_cache(month_cachedir, load_filename=None):
+    ''' Return True if month_cachedir holds a complete cache that is
+        up to date with load_filename (if given and it exists).'''
+    meta_filename = os.path.join(month_cachedir, "meta.json")
+    if not os.path.exists(meta_filename):
+        return False
+    if load_filename is None or not os.path.exists(readers.find_source(load_filename)[0]):
+        return True
+    with open(meta_filename, "r") as read_f:
+        meta = json.load(read_f)
+    return all(meta.get(key) == value for key, value in _source_info(load_filename).items())
+
+def _finish_npy(raw_filename, filename, dtype, count):
+    # Turn a file of raw values into an .npy file
+    with open(filename, "wb") as write_f:
+        np.lib.format.write_array_header_1_0(write_f, {'descr'         : np.dtype(dtype).str,
+                                                      'fortran_order' : False,
+                                                      'shape'         : (count,)})
+        with open(raw_filename, "rb") as read_f:
+            shutil.copyfileobj(read_f, write_f, 1<<24)
+    os.remove(raw_filename)
+
+def ingest_month(load_filename, month_cachedir, batchsize=100000, V=False):
+    ''' Parse the .csv at load_filename (which can be compressed; see
+        readers.find_source) into a cache in month_cachedir.
+        Returns the number of lines read (excluding the header).
+        The cache is only marked complete (see has_cache) once it is
+        fully written.'''
+    os.makedirs(month_cachedir, exist_ok=True)
+    meta_filename = os.path.join(month_cachedir, "meta.json")
+    if os.path.exists(meta_filename):
+        os.remove(meta_filename)
+    meta = _source_info(load_filename)
+
+    raw_files = {name : open(os.path.join(month_cachedir, name + ".raw"), "wb") for (name, _) in columns}
+    count = 0
+    fallback_text = []
+    fallback_line = []
+    line_number = 0
+    try:
+        with contextlib.closing(readers.read_lines(load_filename)) as read_f:
+            next(read_f, None) # Skip header
+            for batch in utils.read_batches(read_f, batchsize=batchsize):
+                entries = utils.process_entries(batch)
+                ok = entries['ok']
+                line_numbers = np.arange(line_number + 1, line_number + 1 + len(batch))
+                values = {'line'       : line_numbers,
+                          'sepoch'     : utils.epoch_seconds(entries['syear'], entries['smonth'], entries['sday'],
+                                                             entries['shour'], entries['smin'], entries['ssec']),
+                          'eepoch'     : utils.epoch_seconds(entries['eyear'], entries['emonth'], entries['eday'],
+                                                             entries['ehour'], entries['emin'], entries['esec'])}
+                for (name, dtype) in columns:
+                    array = values[name] if name in values else entries[name]
+                    raw_files[name].write(np.ascontiguousarray(array[ok], dtype=dtype).tobytes())
+                count += int(np.count_nonzero(ok))
+                for ii in np.flatnonzero(~ok):
+                    fallback_text.append(batch[ii])
+                    fallback_line.append(line_numbers[ii])
+                line_number += len(batch)
+                if V:
+                    print("    Ingested line", line_number)
+    finally:
+        for raw_file in raw_files.values():
+            raw_file.close()
+
+    for (name, dtype) in columns:
+        _finish_npy(os.path.join(month_cachedir, name + ".raw"),
+                    os.path.join(month_cachedir, name + ".npy"), dtype, count)
+    np.save(os.path.join(month_cachedir, "fallback_text.npy"), np.array(fallback_text, dtype=str))
+    np.save(os.path.join(month_cachedir, "fallback_line.npy"), np.array(fallback_line, dtype=np.int64))
+
+    meta['lines'] = line_number
+    with open(meta_filename, "w") as write_f:
+        json.dump(meta, write_f)
+    return line_number
+
+def load_columns(month_cachedir):
+    ''' Return a dict of the (memory-mapped) column arrays in the cache,
+        plus 'fallback_text', 'fallback_line' and 'lines' (the number of
+        lines in the .csv).'''
+    data = {name : np.load(os.path.join(month_cachedir, name + ".npy"), mmap_mode='r')
+            for (name, _) in columns}
+    data['fallback_text'] = np.load(os.path.join(month_cachedir, "fallback_text.npy"))
+    data['fallback_line'] = np.load(os.path.join(month_cachedir, "fallback_line.npy"))
+    with open(os.path.join(month_cachedir, "meta.json"), "r") as read_f:
+        data['lines'] = json.load(read_f)['lines']
+    return data
+
+def entries_from_columns(data, start, end, n=4):
+    ''' Return an entries dict (see utils.process_entries) for rows start
+        to end of the cached columns in data (see load_columns).'''
+    rows = {name : np.asarray(data[name][start:end]) for (name, _) in columns}
+    return utils.make_entries(sx         = rows['sx'],
+                              sy         = rows['sy'],
+                              ex         = rows['ex'],
+                              ey         = rows['ey'],
+                              l2distance = rows['l2distance'],
+                              distance   = rows['distance'],
+                              start_time = utils.times_from_epoch(rows['sepoch'], n=n),
+                              end_time   = utils.times_from_epoch(rows['eepoch'], n=n),
+                              pcount     = rows['pcount'],
+                              ok         = np.ones(len(rows['line']), dtype=bool))
+
+def _read_text(load_filename, line_numbers):
+    # The text of the lines numbered line_numbers (header excluded) of the .csv, read up to the last of them
+    wanted = set(line_numbers)
+    text = {}
+    with contextlib.closing(readers.read_lines(load_filename)) as read_f:
+        next(read_f, None) # Skip header
+        for line_number, line in enumerate(read_f, 1):
+            if line_number in wanted:
+                text[line_number] = line.rstrip("\r\n")
+                if len(text) == len(wanted):
+                    break
+    return text
+
+def process_cached(month_cachedir, year, month, targets, plan, batchsize=100000, sink=None, load_filename=None):
+    ''' Process the cached month into the arrays of each resolution,
+        exactly as utils.process_batch_resolutions would process the .csv.
+        (See utils.accumulate_resolutions for targets and plan.) With a
+        sink (see errorsink.py), the invalid and unparsable lines are added
+        to it. The cache only has the text of the lines in the fallback, so
+        the lines it samples from the columns have none (None), unless
+        load_filename is given: then their text is read back from the .csv
+        there, if it exists, which reads the .csv up to the last of them.
+        Returns (results, line_number): results maps each resolution to
+        (invalid_count, unparsable_lines), the number of invalid entries
+        and a sorted list of the line numbers of unparsable entries, and
+        line_number is the number of lines in the .csv.'''
+    data = load_columns(month_cachedir)
+    results = utils.accumulate_resolutions(entries_from_columns(data, 0, 0), data['line'][0:0],
+                                           data['fallback_text'], data['fallback_line'],
+                                           year=year, month=month, targets=targets, plan=plan, sink=sink)
+    for start in range(0, len(data['line']), batchsize):
+        batch_results = utils.accumulate_resolutions(
+            entries_from_columns(data, start, start + batchsize), np.asarray(data['line'][start:start + batchsize]),
+            [], np.zeros(0, dtype=np.int64), year=year, month=month, targets=targets, plan=plan, sink=sink)
+        for resolution, (invalid_count, unparsable_lines) in batch_results.items():
+            results[resolution] = (results[resolution][0] + invalid_count,
+                                   results[resolution][1] + unparsable_lines)
+    results = {resolution : (invalid_count, sorted(unparsable_lines))
+               for resolution, (invalid_count, unparsable_lines) in results.items()}
+    if sink is not None:
+        # (The cached lines parse, so if they're unparsable, it's because their trips can't be added)
+        text = dict(zip(data['fallback_line'].tolist(), data['fallback_text'].tolist()))
+        for line_number in sorted(set().union(*(unparsable_lines for _, unparsable_lines in results.values()))):
+            if line_number in text:
+                sink.add(utils.unparsable_reason(text[line_number]), line_number, text[line_number])
+            else:
+                sink.add("out_of_range", line_number)
+        # (Nor is the text of the lines sampled from the columns, invalid or not)
+        missing = [sample for samples in sink.samples.values() for sample in samples if sample[1] is None]
+        if missing and load_filename is not None and os.path.exists(readers.find_source(load_filename)[0]):
+            text = _read_text(load_filename, [line_number for line_number, _ in missing])
+            for sample in missing:
+                sample[1] = text.get(sample[0])
+    return results, data['lines']
+
+def validate_cached(month_cachedir, year, month, thresholds=(utils.DEFAULT_THRESHOLDS,), batchsize=100000,
+                    w=10, h=20, n=4):
+    ''' Count how many of the cached month's trips would be valid under each
+        set of thresholds (see utils.validate_entries), in one pass over the
+        cache, without processing the month.
+        Returns (kept, rejections): the number of valid trips under each
+        set of thresholds, and an OrderedDict for each of the number of
+        trips each rule rejected. (Unparsable lines are in neither. Nor
+        are valid trips that can't be added at the resolution (w, h, n),
+        which processing counts as unparsable)'''
+    data = load_columns(month_cachedir)
+    kept = np.zeros(len(thresholds), dtype=np.int64)
+    rejections = [dict.fromkeys(utils.INVALID_REASONS, 0) for _ in thresholds]
+    # (Scratch arrays to add the trips into, to find the ones that can't be)
+    spill = sparseutils.gen_empty_spill(w=w, h=h, n=n)
+    arrays = dict(vdata=utils.gen_empty_vdata(year=year, month=month, w=w, h=h, n=n),
+                  fdata=sparseutils.gen_empty_sparse_fdata(year=year, month=month, w=w, h=h, n=n),
+                  vdata_next_mo=spill['vdata'], fdata_next_mo=spill['fdata'], trips=np.zeros((2, 2, 2)))
+    def add(entries):
+        valid, batch_rejections = utils.validate_entries(entries, year=year, month=month, thresholds=thresholds)
+        # (The ones in the month, valid under some thresholds, whose pcount fits into int16)
+        added = valid.any(axis=0) & (np.iinfo(np.int16).min <= entries['pcount']) \
+                & (entries['pcount'] <= np.iinfo(np.int16).max)
+        added[added] = ~utils.update_data_entries(utils.select_entries(entries, added), w=w, h=h, n=n, **arrays)
+        kept[:] += (valid & added).sum(axis=1)
+        for counts, batch_counts in zip(rejections, batch_rejections):
+            for reason, count in batch_counts.items():
+                counts[reason] += count
+    for start in range(0, len(data['line']), batchsize):
+        add(entries_from_columns(data, start, start + batchsize, n=n))
+    for line in data['fallback_text']:
+        try:
+            add(utils.entries_from_entry(utils.process_entry(line=str(line), n=n)))
+        except:
+            pass
+    return [int(count) for count in kept], [collections.OrderedDict((reason, counts[reason])
+                                                                    for reason in utils.INVALID_REASONS)
+                                            for counts in rejections]
+
+def parse_thresholds(string):
+    ''' Parse a MIN_TIME,MAX_SPEED,MIN_DISTANCE string (e.g. "59,36,100")
+        into a dict of thresholds, for utils.validate_entries.'''
+    try:
+        min_time, max_speed, min_distance = (float(value) for value in string.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Thresholds should be MIN_TIME,MAX_SPEED,MIN_DISTANCE, e.g. 59,36,100")
+    return dict(min_time=min_time, max_speed=max_speed, min_distance=min_distance)
+
+def _ingest(year, month, datadir, cachedir, batchsize, V):
+    # Ingest a single month. (For the process pool.)
+    load_filename = savefiles.get_load_filename(year=year, month=month, datadir=datadir)
+    month_cachedir = get_month_cachedir(year=year, month=month, cachedir=cachedir)
+    if V:
+        print("Ingesting", load_filename, "into", month_cachedir)
+    line_number = ingest_month(load_filename, month_cachedir, batchsize=batchsize)
+    if V:
+        print("Finished", year, month, "with", line_number, "lines")
+    return line_number
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="NYC Dataset processing: ingest .csv files into a columnar cache")
+    parser.add_argument("--startyear", "-sy",
+                        help="Year to start ingesting from. Default 2010",
+                        type=int, nargs=1)
+    parser.add_argument("--startmonth", "-sm",
+                        help="Month to start ingesting from. Default 1.",
+                        type=int, nargs=1)
+    parser.add_argument("--endyear", "-ey",
+                        help="Year to finish ingesting (inclusive). Default 2013.",
+                        type=int, nargs=1)
+    parser.add_argument("--endmonth", "-em",
+                        help="Month to finish ingesting (inclusive). Default 12.",
+                        type=int, nargs=1)
+    parser.add_argument("--datadir", "-d",
+                        help="Directory holding the FOIL201* directories of .csv files (or .csv.gz or .csv.zip files), or FOIL201*.zip archives of them. (Default ../decompressed)",
+                        type=str, nargs=1)
+    parser.add_argument("--cachedir", "-c",
+                        help="Directory to write the cache to. (Default ../cache)",
+                        type=str, nargs=1)
+    parser.add_argument("--batchsize", "-b",
+                        help="Number of lines to parse at a time. (Default 100000)",
+                        type=int, nargs=1)
+    parser.add_argument("--jobs", "-j",
+                        help="Number of months to ingest in parallel. (Default 1)",
+                        type=int, nargs=1)
+    parser.add_argument("--thresholds", "-t",
+                        help="Instead of ingesting, count how many of the cached trips of each month each set of thresholds, given as MIN_TIME,MAX_SPEED,MIN_DISTANCE (e.g. -t 59,36,100 30,36,50), would keep, and how many each rule of utils.check_valid would reject.",
+                        type=parse_thresholds, nargs="+")
+    parser.add_argument("--width", "-x",
+                        help="With --thresholds, width of the grid the trips are added to (default 10)",
+                        type=int, nargs=1)
+    parser.add_argument("--height", "-y",
+                        help="With --thresholds, height of the grid (default 20)",
+                        type=int, nargs=1)
+    parser.add_argument("--nslotsperhour", "-n",
+                        help="With --thresholds, number of time slots per hour (default 4)",
+                        type=int, nargs=1)
+    parser.add_argument("--verbose", "-v",
+                        help="",
+                        action="store_true")
+    args = parser.parse_args()
+
+    startyear   = 2010  if args.startyear   is None else args.startyear[0]
+    startmonth  = 1     if args.startmonth  is None else args.startmonth[0]
+    endyear     = 2013  if args.endyear     is None else args.endyear[0]
+    endmonth    = 12    if args.endmonth    is None else args.endmonth[0]
+    datadir     = "../decompressed" if args.datadir is None else args.datadir[0]
+    cachedir    = "../cache" if args.cachedir is None else args.cachedir[0]
+    batchsize   = 100000 if args.batchsize  is None else args.batchsize[0]
+    jobs        = 1     if args.jobs        is None else args.jobs[0]
+    width       = 10    if args.width       is None else args.width[0]
+    height      = 20    if args.height      is None else args.height[0]
+    n           = 4     if args.nslotsperhour is None else args.nslotsperhour[0]
+    V = args.verbose
+
+    dates = utils.generate_dates(startyear, startmonth, endyear, endmonth)
+    if args.thresholds is not None:
+        for (year, month) in dates:
+            month_cachedir = get_month_cachedir(year=year, month=month, cachedir=cachedir)
+            if not has_cache(month_cachedir):
+                print("No cache of", year, month)
+                continue
+            kept, rejections = validate_cached(month_cachedir, year, month, thresholds=args.thresholds,
+                                               batchsize=batchsize, w=width, h=height, n=n)
+            for threshold, count, counts in zip(args.thresholds, kept, rejections):
+                print("%d-%02d min_time %g, max_speed %g, min_distance %g: kept %d, rejected %s" % (
+                    year, month, threshold['min_time'], threshold['max_speed'], threshold['min_distance'], count,
+                    ", ".join("%s %d" % item for item in counts.items())))
+        sys.exit()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_ingest, year, month, datadir, cachedir, batchsize, V)
+                   for (year, month) in dates]
+        for future in futures:
+            future.result()
@@ -2,9 +2,17 @@
 
 import regex as re
 from datetime import datetime
-from GPSUtils import pgps_to_xy, gps_distance
+from GPSUtils import pgps_to_xy, gps_distance, pgps_to_xy_batch, gps_distance_batch
 from math import floor
+from itertools import islice
+import collections
 import numpy as np
+import sparseutils
+import instrument
+
+# Formats of the pickup/dropoff timestamps in the .csv
+regex_format = r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}'
+time_format = "%Y-%m-%d %H:%M:%S"
 
 def get_t(day, hour, minute, n=4):
     ''' Returns the sample numbr given the day, hour, and minute.
@@ -15,14 +23,12 @@ def process_entry(line, n=4):
     ''' Given string line from the .csv,
         return a dict representing that entry. '''
     entry_strings = line.strip().split(",")
-    regex_format = r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}'
     
     # Extract the string out from scruff that might be around it
     start_time_string = re.search(regex_format, entry_strings[5]).group()
     end_time_string = re.search(regex_format, entry_strings[6]).group()
     
     # Parse the times using datetime
-    time_format = "%Y-%m-%d %H:%M:%S"
     start_time = datetime.strptime(start_time_string, time_format)
     end_time = datetime.strptime(end_time_string, time_format)
     
@@ -101,6 +107,49 @@ def check_valid(entry, year, month, min_time=59, max_speed=36, min_distance=100)
     return True
     
 
+# Why a line couldn't be processed (see unparsable_reason), or why a trip
+# isn't valid: the first check_valid rule it breaks (see invalid_reason)
+UNPARSABLE_REASONS = ("missing_columns", "bad_timestamp", "bad_float", "bad_pcount", "out_of_range", "other")
+INVALID_REASONS = ("wrong_month", "too_close", "too_short", "too_fast")
+
+def unparsable_reason(line):
+    ''' Return why process_entry (or update_data) fails on line, one of
+        UNPARSABLE_REASONS: fewer than 14 columns, a pickup or dropoff time
+        that can't be parsed, a distance or coordinate that isn't a float,
+        a passenger count that isn't an int, or "out_of_range" for a line
+        that parses, but whose trip can't be added (e.g. it ends more than
+        a year later, or is too far away to map to the grid). "other" if
+        line is None (not known).'''
+    if line is None:
+        return "other"
+    entry_strings = line.strip().split(",")
+    if len(entry_strings) < 14:
+        return "missing_columns"
+    try:
+        for time_string in entry_strings[5:7]:
+            datetime.strptime(re.search(regex_format, time_string).group(), time_format)
+    except (AttributeError, ValueError):
+        return "bad_timestamp"
+    try:
+        for float_string in entry_strings[9:14]:
+            float(float_string.strip())
+    except ValueError:
+        return "bad_float"
+    try:
+        int(entry_strings[7].strip())
+    except ValueError:
+        return "bad_pcount"
+    return "out_of_range"
+
+def invalid_reason(entry, year, month, min_time=59, max_speed=36, min_distance=100):
+    ''' Return the first rule of check_valid the entry breaks, one of
+        INVALID_REASONS, or None if it is valid.'''
+    if not (entry['syear'] == year and entry['smonth'] == month): return "wrong_month"
+    if not entry['l2distance'] >= min_distance: return "too_close"
+    if not entry['deltat'] >= min_time: return "too_short"
+    if not (entry['l2distance'] / entry['deltat']) <= max_speed: return "too_fast"
+    return None
+
 def generate_dates(start_year = 2010, start_month = 1, end_year = 2013, end_month = 12):
     ''' Returns a list of (year, month) tuples from
         (start_year, start_month) to (end_year, end_month), inclusive.'''
@@ -149,6 +198,23 @@ def gen_empty_fdata(year, month, w=10, h=20, n=4):
     samples = no_samples_in_mo(year=year, month=month, n=n)
     return np.zeros((2, samples, w, h, w, h, 2), dtype=np.int16)
 
+def spill_offset(syear, smonth, eyear, emonth, n=4):
+    ''' Return the number of time slots from the start of the month after
+        (syear, smonth) to the start of (eyear, emonth). A trip that starts
+        in (syear, smonth) and ends in a later month ends at time slot
+        et + spill_offset of its spill. (See sparseutils.gen_empty_spill)
+        Works on ints or int arrays.'''
+    next_year, next_month = syear + smonth // 12, smonth % 12 + 1
+    seconds = epoch_seconds(eyear, emonth, 1, 0, 0, 0) - epoch_seconds(next_year, next_month, 1, 0, 0, 0)
+    return seconds // (24*60*60) * 24 * n
+
+def _add_one(data, index, value):
+    # data[index] += value, where data can also be a sparseutils.SparseArray
+    if isinstance(data, np.ndarray):
+        data[index] += value
+    else:
+        data.add_at(tuple(np.array([ii]) for ii in index), value)
+
 def update_data(entry, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, w=10, h=20, n=4):
     ''' Updates the given numpy arrays with data from the provided entry.
         Returns nothing.
@@ -157,9 +223,11 @@ def update_data(entry, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, w=10,
         entry: Dictionary providing pertinent values for a given trip.
         vdata, fdata: Numpy arrays representing the volume and flow
             data for a given month.
-        vdata_next_mo, fdata_next_mo: Numpy array representing the
-            volume and flow data for the next month. (Useful for those
-            trips that start in this month and end in the next.)
+        vdata_next_mo, fdata_next_mo: Numpy arrays (or, usually,
+            sparseutils.SparseArrays; see sparseutils.gen_empty_spill)
+            representing the volume and flow data after this month, from
+            the start of the next. (Useful for those trips that start in
+            this month and end in a later one.)
         trips: Numpy array that stores statistical information about
             the total number of trips and passengers in the month.
         w, h: Ints; width and height of the grud
@@ -170,7 +238,10 @@ def update_data(entry, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, w=10,
     starts_inside = (0 <= entry['sx'] <= 1) and (0 <= entry['sy'] <= 1)
     ends_inside   = (0 <= entry['ex'] <= 1) and (0 <= entry['ey'] <= 1)
     
-    starts_and_ends_in_same_month = (entry['smonth'] == entry['emonth'])
+    starts_and_ends_in_same_month = (entry['syear'], entry['smonth']) == (entry['eyear'], entry['emonth'])
+    if not starts_and_ends_in_same_month:
+        # Time slot of the end, counted from the start of the next month
+        et_next_mo = entry['et'] + int(spill_offset(entry['syear'], entry['smonth'], entry['eyear'], entry['emonth'], n=n))
     
     # Variable names:
     #   s/e stands for start/end, g stands for grid, x/y are coordinates
@@ -194,18 +265,16 @@ def update_data(entry, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, w=10,
         
         if ends_inside:
             # Update volume data only if the trip starts and ends within Manhattan.
-            if entry['st'] == entry['et']:
-                # st == et, so we don't need to check if et is in the
-                #    next month.
+            if entry['st'] == entry['et'] and starts_and_ends_in_same_month:
                 fdata[0, entry['et'], sgx, sgy, egx, egy, 0] += pcount
                 fdata[0, entry['et'], sgx, sgy, egx, egy, 1] += 1
             else:
                 if starts_and_ends_in_same_month:
                     fdata[1, entry['et'], sgx, sgy, egx, egy, 0] += pcount
                     fdata[1, entry['et'], sgx, sgy, egx, egy, 1] += 1
-                else: # End time crosses over to the next month
-                    fdata_next_mo[1, entry['et'], sgx, sgy, egx, egy, 0] += pcount
-                    fdata_next_mo[1, entry['et'], sgx, sgy, egx, egy, 1] += 1
+                else: # End time crosses over to a later month
+                    _add_one(fdata_next_mo, (1, et_next_mo, sgx, sgy, egx, egy, 0), pcount)
+                    _add_one(fdata_next_mo, (1, et_next_mo, sgx, sgy, egx, egy, 1), 1)
 
     if ends_inside:
         # Update volume data for the end of the trip.
@@ -213,8 +282,694 @@ def update_data(entry, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, w=10,
             vdata[entry['et'], egx, egy, 1, 0] += pcount
             vdata[entry['et'], egx, egy, 1, 1] += 1
         
-        else: # Ends during the next month, so use the array representing the next month
-            vdata_next_mo[entry['et'], egx, egy, 1, 0] += pcount
-            vdata_next_mo[entry['et'], egx, egy, 1, 1] += 1
+        else: # Ends during a later month, so use the array representing the months after this one
+            _add_one(vdata_next_mo, (et_next_mo, egx, egy, 1, 0), pcount)
+            _add_one(vdata_next_mo, (et_next_mo, egx, egy, 1, 1), 1)
             
     # Returns nothing - numpy arrays are updated by reference.
+
+
+# Batch ("vectorized") versions of process_entry, check_valid and update_data.
+# These work on a whole batch of .csv lines at once, storing each entry field
+# as a numpy array under the same keys as the dict from process_entry.
+# Lines that the fast path can't handle are left to the per-line functions
+# above (see process_batch), so the results are identical either way.
+
+def read_batches(lines, batchsize=100000):
+    ''' Given an iterable of lines, yield lists of up to batchsize lines.'''
+    lines = iter(lines)
+    batch = list(islice(lines, batchsize))
+    while batch:
+        yield batch
+        batch = list(islice(lines, batchsize))
+
+def parse_column(strings, cast=float, dtype=np.float64, ok=None):
+    ''' Apply cast (e.g. float, int) to every string in the column.
+        Returns a numpy array of the given dtype.
+        ok: Optional boolean array. Where cast fails, ok is set to False
+            (and the value is left as 0) instead of raising an error.
+    '''
+    try:
+        return np.fromiter(map(cast, strings), dtype=dtype, count=len(strings))
+    except (ValueError, TypeError, OverflowError):
+        if ok is None:
+            raise
+    # Slow path: at least one bad value in this column
+    values = np.zeros(len(strings), dtype=dtype)
+    for ii, string in enumerate(strings):
+        try:
+            values[ii] = cast(string)
+        except (ValueError, TypeError, OverflowError):
+            ok[ii] = False
+    return values
+
+def epoch_seconds(year, month, day, hour, minute, second):
+    ''' Given int arrays of date and time fields, return int64 seconds
+        since 1970-01-01 00:00:00. '''
+    days = (np.asarray(year, dtype=np.int64) - 1970).astype('datetime64[Y]')
+    days = (days.astype('datetime64[M]') + (np.asarray(month) - 1)).astype('datetime64[D]')
+    days = (days + (np.asarray(day) - 1)).astype(np.int64)
+    return ((days*24 + hour)*60 + minute)*60 + second
+
+def get_t_batch(day, hour, minute, n=4):
+    ''' Batch version of get_t, for int arrays day, hour and minute.'''
+    return (((day - 1)*24 + hour)*60 + minute) // floor(60/n)
+
+def days_in_mo_batch(year, month):
+    ''' Batch version of no_days_in_mo, for int arrays year and month (1-12).'''
+    days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[month - 1]
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    return days + (leap & (month == 2))
+
+# Layout of a timestamp, "YYYY-MM-DD HH:MM:SS": positions of the digits of
+# each field, and of the separators between them.
+timestamp_digits = ((0, 1, 2, 3), (5, 6), (8, 9), (11, 12), (14, 15), (17, 18))
+timestamp_separators = ((4, '-'), (7, '-'), (10, ' '), (13, ':'), (16, ':'))
+
+def _parse_times_fixed(strings):
+    ''' Parse timestamps laid out exactly as "YYYY-MM-DD HH:MM:SS" (or the
+        same in double quotes) by reading the characters at fixed offsets.
+        Returns (fields, ok): a (6, len(strings)) int64 array of year, month,
+        day, hour, minute, second, and a boolean array that is False for
+        any string that doesn't strictly fit the layout or isn't a real time.
+    '''
+    count = len(strings)
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=count)
+    # Longer strings are truncated, but those don't fit the layout anyway.
+    chars = np.array(strings, dtype='U21').view(np.uint32).reshape(count, 21).astype(np.int64)
+    quoted = (chars[:, 0] == ord('"')) & (chars[:, 20] == ord('"')) & (lengths == 21)
+    ok = quoted | (lengths == 19)
+    chars = np.where(quoted[:, None], chars[:, 1:20], chars[:, 0:19])
+    
+    for position, separator in timestamp_separators:
+        ok &= chars[:, position] == ord(separator)
+    digits = chars - ord('0')
+    fields = np.zeros((6, count), dtype=np.int64)
+    for field, positions in zip(fields, timestamp_digits):
+        for position in positions:
+            ok &= (0 <= digits[:, position]) & (digits[:, position] <= 9)
+            field *= 10
+            field += digits[:, position]
+    
+    # Same range checks as datetime.strptime
+    year, month, day, hour, minute, second = fields
+    ok &= (year >= 1) & (1 <= month) & (month <= 12) & (1 <= day)
+    ok &= (hour <= 23) & (minute <= 59) & (second <= 59)
+    ok[ok] &= day[ok] <= days_in_mo_batch(year[ok], month[ok])
+    return fields, ok
+
+def _parse_times_regex(strings):
+    ''' Parse timestamps one at a time with the regex, as process_entry does.
+        Returns (fields, ok), as with _parse_times_fixed.'''
+    fields = np.zeros((6, len(strings)), dtype=np.int64)
+    ok = np.ones(len(strings), dtype=bool)
+    for ii, string in enumerate(strings):
+        try:
+            time = datetime.strptime(re.search(regex_format, string).group(), time_format)
+        except (AttributeError, ValueError):
+            ok[ii] = False
+            continue
+        fields[:, ii] = (time.year, time.month, time.day, time.hour, time.minute, time.second)
+    return fields, ok
+
+def parse_times(strings, n=4):
+    ''' Batch version of the timestamp parsing in process_entry.
+        Timestamps are read by fixed character offsets; only the strings
+        that don't strictly fit "YYYY-MM-DD HH:MM:SS" go through the
+        regex and datetime.strptime, as in process_entry.
+    
+        Returns (times, ok): times is a dict of int64 arrays 'year', 'month',
+        'day', 'hour', 'minute', 'second', 'epoch' (seconds since 1970) and
+        'slot' (the time slot, as with get_t), and ok is a boolean array
+        that is False where parsing failed.
+    '''
+    fields, ok = _parse_times_fixed(strings)
+    malformed = np.flatnonzero(~ok)
+    if len(malformed):
+        fields[:, malformed], ok[malformed] = _parse_times_regex([strings[ii] for ii in malformed])
+    # Placeholder date for unparsable strings, so epoch_seconds is well-defined
+    fields[:3, ~ok] = np.array([[1970], [1], [1]])
+    
+    return time_fields(*fields, n=n), ok
+
+def time_fields(year, month, day, hour, minute, second, n=4, epoch=None):
+    ''' Return the dict of int64 arrays from parse_times, given the date
+        and time fields (and epoch, if already known).'''
+    times = {
+        'year'   : year,
+        'month'  : month,
+        'day'    : day,
+        'hour'   : hour,
+        'minute' : minute,
+        'second' : second,
+        'epoch'  : epoch_seconds(year, month, day, hour, minute, second) if epoch is None else epoch,
+        'slot'   : get_t_batch(day, hour, minute, n=n)
+    }
+    return times
+
+def times_from_epoch(epoch, n=4):
+    ''' Return the dict of int64 arrays from parse_times, given an array
+        of epoch seconds (seconds since 1970-01-01 00:00:00).'''
+    epoch = np.asarray(epoch, dtype=np.int64)
+    seconds = epoch.astype('datetime64[s]')
+    days = seconds.astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+    time_of_day = (seconds - days).astype(np.int64)
+    return time_fields(year   = years.astype(np.int64) + 1970,
+                       month  = (months - years).astype(np.int64) + 1,
+                       day    = (days - months).astype(np.int64) + 1,
+                       hour   = time_of_day // 3600,
+                       minute = time_of_day // 60 % 60,
+                       second = time_of_day % 60,
+                       n      = n,
+                       epoch  = epoch)
+
+def process_entries(lines, n=4, stats=None):
+    ''' Batch version of process_entry.
+        Given a list of string lines from the .csv, return a dict with the
+        same keys as process_entry, each holding a numpy array with one
+        value per line, plus the key 'ok': a boolean array that is False
+        for lines the batch functions can't handle (including pcounts
+        that don't fit into int16). (Values for those lines are
+        meaningless; use process_entry on them instead.)
+        stats: Optional instrument.MonthStats, to count the time spent
+            parsing and projecting in.
+    '''
+    with instrument.timing(stats, "parse", len(lines)):
+        rows = [line.strip().split(",") for line in lines]
+        ok = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows)) >= 14
+        if not ok.all():
+            rows = [row if len(row) >= 14 else [""]*14 for row in rows]
+        columns = list(zip(*rows)) if rows else [()]*14
+        
+        start_time, start_ok = parse_times(columns[5], n=n)
+        end_time, end_ok = parse_times(columns[6], n=n)
+        ok &= start_ok & end_ok
+        
+        slon = parse_column(columns[10], ok=ok)
+        slat = parse_column(columns[11], ok=ok)
+        elon = parse_column(columns[12], ok=ok)
+        elat = parse_column(columns[13], ok=ok)
+        pcount = parse_column(columns[7], cast=int, dtype=np.int64, ok=ok)
+        # pcounts that don't fit into the int16 vdata/fdata are left to update_data
+        ok &= (np.iinfo(np.int16).min <= pcount) & (pcount <= np.iinfo(np.int16).max)
+        distance = parse_column(columns[9], ok=ok)
+    
+    with instrument.timing(stats, "project", len(lines)):
+        sx, sy = pgps_to_xy_batch(slon, slat)
+        ex, ey = pgps_to_xy_batch(elon, elat)
+        errors = np.zeros(len(rows), dtype=bool)
+        l2distance = gps_distance_batch(slat, slon, elat, elon, errors=errors)
+        ok &= ~errors
+    
+    return make_entries(sx=sx, sy=sy, ex=ex, ey=ey, l2distance=l2distance,
+                        distance=distance, start_time=start_time,
+                        end_time=end_time, pcount=pcount, ok=ok)
+
+def make_entries(sx, sy, ex, ey, l2distance, distance, start_time, end_time, pcount, ok):
+    ''' Return an entries dict (see process_entries) from arrays of
+        coordinates, distances and passenger counts, and the dicts of
+        start and end times from parse_times.'''
+    # Get the change in time (deltat) in seconds, as with timedelta.seconds
+    difference = end_time['epoch'] - start_time['epoch']
+    deltat = np.where(difference > 0, difference % 86400, -((-difference) % 86400))
+    
+    entries = {
+        'sx' : sx,
+        'sy' : sy,
+        'ex' : ex,
+        'ey' : ey,
+        'l2distance' : l2distance,
+        'distance'   : distance,
+        'st' : start_time['slot'],
+        'et' : end_time['slot'],
+        'syear'  : start_time['year'],
+        'smonth' : start_time['month'],
+        'sday'   : start_time['day'],
+        'shour'  : start_time['hour'],
+        'smin'   : start_time['minute'],
+        'ssec'   : start_time['second'],
+        'eyear'  : end_time['year'],
+        'emonth' : end_time['month'],
+        'eday'   : end_time['day'],
+        'ehour'  : end_time['hour'],
+        'emin'   : end_time['minute'],
+        'esec'   : end_time['second'],
+        'pcount' : pcount,
+        'deltat' : deltat,
+        'ok'     : ok
+    }
+    
+    return entries
+
+def entries_from_entry(entry):
+    ''' Return an entries dict (as with process_entries) holding the single
+        entry from process_entry.'''
+    return {key : np.array([value]) for key, value in entry.items()}
+
+def select_entries(entries, mask):
+    ''' Return a new entries dict holding only the rows where mask is True.'''
+    return {key : value[mask] for key, value in entries.items()}
+
+def check_valid_entries(entries, year, month, min_time=59, max_speed=36, min_distance=100):
+    ''' Batch version of check_valid.
+        Returns a boolean array, True for each valid entry.'''
+    valid = (entries['syear'] == year) & (entries['smonth'] == month)
+    valid &= entries['l2distance'] >= min_distance
+    valid &= entries['deltat'] >= min_time
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid &= (entries['l2distance'] / entries['deltat']) <= max_speed
+    return valid
+
+DEFAULT_THRESHOLDS = dict(min_time=59, max_speed=36, min_distance=100) # (See check_valid)
+
+def _broken_rules(entries, year, month, thresholds):
+    # Yield, for each dict of min_time, max_speed and min_distance in
+    #   thresholds, the index in INVALID_REASONS of the first rule of
+    #   check_valid each entry breaks, or -1 if it's valid. (What doesn't
+    #   depend on the thresholds is only worked out once)
+    wrong_month = ~((entries['syear'] == year) & (entries['smonth'] == month))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = entries['l2distance'] / entries['deltat']
+    for threshold in thresholds:
+        threshold = dict(DEFAULT_THRESHOLDS, **threshold)
+        codes = np.full(len(wrong_month), -1, dtype=np.int8)
+        # (Later rules first, so the first rule broken is the one kept)
+        codes[~(speed <= threshold['max_speed'])] = 3
+        codes[~(entries['deltat'] >= threshold['min_time'])] = 2
+        codes[~(entries['l2distance'] >= threshold['min_distance'])] = 1
+        codes[wrong_month] = 0
+        yield codes
+
+def validate_entries(entries, year, month, thresholds=(DEFAULT_THRESHOLDS,)):
+    ''' Batch version of check_valid, under several sets of thresholds at
+        once, e.g. to see how many trips each would keep.
+    
+    # Arguments:
+        entries: Dict of column arrays, as from process_entries. (Only
+            'syear', 'smonth', 'l2distance' and 'deltat' are used)
+        year, month: The year and month being processed.
+        thresholds: List of dicts of 'min_time', 'max_speed' and
+            'min_distance' (see check_valid). Missing ones are the defaults,
+            DEFAULT_THRESHOLDS.
+    # Returns:
+        (valid, rejections): valid is a boolean array of shape
+        (len(thresholds), number of entries), True for each entry that is
+        valid under each set of thresholds. rejections is a list of an
+        OrderedDict for each set, of the number of entries each rule
+        (see INVALID_REASONS) rejected, counting only the first rule an
+        entry breaks, as check_valid does.
+    '''
+    valid = []
+    rejections = []
+    for codes in _broken_rules(entries, year, month, thresholds):
+        valid.append(codes < 0)
+        counts = np.bincount(codes[codes >= 0], minlength=len(INVALID_REASONS))
+        rejections.append(collections.OrderedDict(zip(INVALID_REASONS, (int(count) for count in counts))))
+    return np.array(valid, dtype=bool).reshape(len(thresholds), len(entries['syear'])), rejections
+
+def invalid_reasons_entries(entries, year, month, min_time=59, max_speed=36, min_distance=100):
+    ''' Batch version of invalid_reason. Returns an int array, the index in
+        INVALID_REASONS of the first rule each entry breaks, or -1 if valid.'''
+    threshold = dict(min_time=min_time, max_speed=max_speed, min_distance=min_distance)
+    return next(_broken_rules(entries, year, month, [threshold]))
+
+def _add_invalid(sink, reasons, line_numbers):
+    # Add the invalid entries to sink (see errorsink.ErrorSink), by the rule
+    #   they break (see invalid_reasons_entries)
+    for code, reason in enumerate(INVALID_REASONS):
+        sink.add_many(reason, line_numbers[reasons == code])
+
+def _add_at(data, index, values):
+    ''' Unbuffered in-place add of values into the C-contiguous array data,
+        at the given tuple of index arrays (via linearized indices).
+        data can also be a sparseutils.SparseArray.'''
+    if not isinstance(data, np.ndarray):
+        data.add_at(index, values)
+        return
+    flat = data.reshape(-1)
+    np.add.at(flat, np.ravel_multi_index(index, data.shape), values.astype(data.dtype))
+
+def update_data_entries(entries, vdata, fdata, vdata_next_mo, fdata_next_mo, trips, w=10, h=20, n=4):
+    ''' Batch version of update_data. entries should only hold valid entries
+        (see check_valid_entries) with pcounts that fit in vdata/fdata.
+        Any of the arrays but trips can also be sparseutils.SparseArrays.
+    
+        Returns a boolean array, True for each entry where update_data
+        would have raised an error (e.g. a trip that ends past the end of
+        vdata_next_mo). Those entries are partially applied, exactly as
+        update_data would have left them.
+    '''
+    sx, sy, ex, ey = entries['sx'], entries['sy'], entries['ex'], entries['ey']
+    st, et, pcount = entries['st'], entries['et'], entries['pcount']
+    
+    starts_inside = (0 <= sx) & (sx <= 1) & (0 <= sy) & (sy <= 1)
+    ends_inside   = (0 <= ex) & (ex <= 1) & (0 <= ey) & (ey <= 1)
+    starts_and_ends_in_same_month = (entries['syear'] == entries['eyear']) & (entries['smonth'] == entries['emonth'])
+    et_next_mo = et + spill_offset(entries['syear'], entries['smonth'], entries['eyear'], entries['emonth'], n=n)
+    
+    # update_data raises before touching anything if a grid coordinate can't be floored.
+    gridded = np.isfinite(sx*w) & np.isfinite(sy*h) & np.isfinite(ex*w) & np.isfinite(ey*h)
+    sgx = np.floor(np.where(starts_inside, sx*w, 0)).astype(np.int64)
+    sgy = np.floor(np.where(starts_inside, sy*h, 0)).astype(np.int64)
+    egx = np.floor(np.where(ends_inside, ex*w, 0)).astype(np.int64)
+    egy = np.floor(np.where(ends_inside, ey*h, 0)).astype(np.int64)
+    
+    # Which index each update would use, and whether it is in bounds.
+    # (E.g. sx == 1 maps to sgx == w, which is out of bounds.)
+    samples, samples_next_mo = vdata.shape[0], vdata_next_mo.shape[0]
+    same_slot = (st == et) & starts_and_ends_in_same_month
+    start_ok = (sgx < w) & (sgy < h) & (st < samples)
+    end_ok = (egx < w) & (egy < h)
+    end_in_bounds = np.where(starts_and_ends_in_same_month, et < samples, et_next_mo < samples_next_mo)
+    flow_ok = end_ok & end_in_bounds
+    vend_ok = end_ok & end_in_bounds
+    
+    # Each update happens only if every update before it succeeded.
+    do_trips = gridded
+    do_vstart = do_trips & starts_inside
+    do_flow = do_vstart & start_ok & ends_inside
+    do_vend = do_trips & ends_inside & (~starts_inside | (start_ok & flow_ok))
+    failed = ~gridded | (do_vstart & ~start_ok) | (do_flow & ~flow_ok) | (do_vend & ~vend_ok)
+    do_vstart &= start_ok
+    do_flow &= flow_ok
+    do_vend &= vend_ok
+    
+    # Trips is a (2,2,2) array: [starts in/outside, ends in/side, passenger/trip count]
+    cell = (2*(~starts_inside) + (~ends_inside))[do_trips]
+    trips[:, :, 0] += np.bincount(cell, weights=pcount[do_trips], minlength=4).reshape(2, 2).astype(trips.dtype)
+    trips[:, :, 1] += np.bincount(cell, minlength=4).reshape(2, 2).astype(trips.dtype)
+    
+    def add(data, index, mask):
+        # Add pcount and a trip count for each masked entry at data[index]
+        index = tuple(ii[mask] if isinstance(ii, np.ndarray) else np.full(np.count_nonzero(mask), ii)
+                      for ii in index)
+        _add_at(data, index + (np.zeros_like(index[0]),), pcount[mask])
+        _add_at(data, index + (np.ones_like(index[0]),), np.ones(len(index[0]), dtype=np.int64))
+    
+    # Volume data for the start of the trip
+    add(vdata, (st, sgx, sgy, 0), do_vstart)
+    
+    # Flow data, for trips that start and end within Manhattan
+    kind = np.where(same_slot, 0, 1)
+    add(fdata, (kind, et, sgx, sgy, egx, egy), do_flow & starts_and_ends_in_same_month)
+    add(fdata_next_mo, (kind, et_next_mo, sgx, sgy, egx, egy), do_flow & ~starts_and_ends_in_same_month)
+    
+    # Volume data for the end of the trip
+    add(vdata, (et, egx, egy, 1), do_vend & starts_and_ends_in_same_month)
+    add(vdata_next_mo, (et_next_mo, egx, egy, 1), do_vend & ~starts_and_ends_in_same_month)
+    
+    return failed
+
+def accumulate_entries(entries, line_numbers, year, month, vdata, fdata, vdata_next_mo,
+                       fdata_next_mo, trips, w=10, h=20, n=4, stats=None, sink=None):
+    ''' Check and add entries (as from process_entries, but only the ones
+        that are 'ok') into the given arrays, exactly as check_valid and
+        update_data would one entry at a time.
+        Returns (invalid_count, unparsable_lines): The number of invalid
+        entries and a list of the line numbers (from the int array
+        line_numbers, one per entry) of entries that raised an error.
+        stats: Optional instrument.MonthStats, to count the time spent
+            validating and accumulating in.
+        sink: Optional errorsink.ErrorSink, to add the invalid entries to.'''
+    with instrument.timing(stats, "validate", len(line_numbers)):
+        if sink is None:
+            valid = check_valid_entries(entries, year=year, month=month)
+        else:
+            # (Why each entry is invalid comes with no extra pass)
+            reasons = invalid_reasons_entries(entries, year=year, month=month)
+            valid = reasons < 0
+    if sink is not None and not valid.all():
+        _add_invalid(sink, reasons, line_numbers)
+    with instrument.timing(stats, "accumulate", int(np.count_nonzero(valid))):
+        failed = update_data_entries(select_entries(entries, valid),
+                                     vdata=vdata, fdata=fdata,
+                                     vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                                     trips=trips, w=w, h=h, n=n)
+    return int(np.count_nonzero(~valid)), [int(ii) for ii in line_numbers[valid][failed]]
+
+class _Int16Overflow:
+    # Stands in for vdata and fdata in update_data, for an entry whose pcount
+    #   doesn't fit into int16: the first write into them raises, as writing
+    #   that pcount into the int16 arrays does. (After anything update_data
+    #   adds to trips or the spill first, as it does with the dense arrays)
+    def __getitem__(self, index):
+        return 0
+    
+    def __setitem__(self, index, value):
+        raise OverflowError("Passenger count %d doesn't fit into int16" % value)
+
+def accumulate_lines(lines, line_numbers, year, month, vdata, fdata, vdata_next_mo,
+                     fdata_next_mo, trips, w=10, h=20, n=4, sink=None):
+    ''' Process lines from the .csv one at a time with process_entry,
+        check_valid and update_data, as main.py does.
+        Returns (invalid_count, unparsable_lines), as accumulate_entries.'''
+    invalid_count = 0
+    unparsable_lines = []
+    for line, line_number in zip(lines, line_numbers):
+        try:
+            entry = process_entry(line=line, n=n)
+            if not check_valid(entry=entry, year=year, month=month):
+                invalid_count += 1
+                if sink is not None:
+                    sink.add(invalid_reason(entry, year=year, month=month), int(line_number), line)
+            elif isinstance(fdata, np.ndarray) and isinstance(vdata, np.ndarray):
+                update_data(entry=entry, vdata=vdata, fdata=fdata,
+                            vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                            trips=trips, w=w, h=h, n=n)
+            elif not (np.iinfo(np.int16).min <= entry['pcount'] <= np.iinfo(np.int16).max):
+                # (update_data_entries would wrap it around into a SparseArray or a SlabArray)
+                update_data(entry=entry, vdata=_Int16Overflow(), fdata=_Int16Overflow(),
+                            vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                            trips=trips, w=w, h=h, n=n)
+            elif update_data_entries(entries_from_entry(entry), vdata=vdata, fdata=fdata,
+                                     vdata_next_mo=vdata_next_mo, fdata_next_mo=fdata_next_mo,
+                                     trips=trips, w=w, h=h, n=n)[0]:
+                # (update_data can't write into a SparseArray or a SlabArray)
+                unparsable_lines.append(int(line_number))
+        except:
+            unparsable_lines.append(int(line_number))
+    return invalid_count, unparsable_lines
+
+# Processing several resolutions (w, h, n) in one pass. A resolution whose
+# w, h and n divide those of another one (its "parent") isn't accumulated
+# itself: its arrays are the parent's arrays, coarsened by summing blocks of
+# cells and time slots (see coarsen), plus corrections for the entries that
+# coarsening gets wrong (see derivable_entries). The results are the same as
+# processing each resolution separately.
+
+def resolution_factors(fine, coarse):
+    ''' Return (kx, ky, kt), the factors the coarse resolution (w, h, n)
+        divides the fine one by, or None if it can't be derived from it.'''
+    (fine_w, fine_h, fine_n), (w, h, n) = fine, coarse
+    if fine_w % w or fine_h % h or fine_n % n or 60 % fine_n:
+        return None
+    return (fine_w // w, fine_h // h, fine_n // n)
+
+def plan_resolutions(resolutions):
+    ''' Return a dict mapping each (w, h, n) in resolutions to the
+        resolution it is derived from (see resolution_factors), or None if
+        it has to be accumulated. Resolutions that are accumulated come first.'''
+    resolutions = list(dict.fromkeys(tuple(resolution) for resolution in resolutions))
+    def parents(resolution):
+        return [parent for parent in resolutions
+                if parent != resolution and resolution_factors(parent, resolution) is not None]
+    roots = [resolution for resolution in resolutions if not parents(resolution)]
+    plan = {resolution : None for resolution in roots}
+    for resolution in resolutions:
+        if resolution not in plan:
+            # The smallest accumulated resolution it can be derived from
+            plan[resolution] = min((parent for parent in parents(resolution) if parent in roots),
+                                   key=lambda parent: parent[0]*parent[1]*parent[2])
+    return plan
+
+def array_factors(name, factors):
+    ''' Return the factor to divide each axis of the array name ('vdata',
+        'fdata', 'vdata_next_mo', 'fdata_next_mo' or 'trips') by, given
+        (kx, ky, kt) from resolution_factors.'''
+    kx, ky, kt = factors
+    if name.startswith("vdata"):
+        return (kt, kx, ky, 1, 1)
+    if name.startswith("fdata"):
+        return (1, kt, kx, ky, kx, ky, 1)
+    return (1, 1, 1)
+
+def coarsen(data, factors):
+    ''' Return data with each block of factors[i] positions along each
+        axis i summed together. (E.g. fdata at w=10, h=20, n=4 coarsened by
+        array_factors("fdata", (2, 2, 2)) is fdata at w=5, h=10, n=2.)
+        data can also be a sparseutils.SparseArray.'''
+    if not isinstance(data, np.ndarray):
+        return data.coarsen(factors)
+    shape = []
+    for size, factor in zip(data.shape, factors):
+        shape += [size // factor, factor]
+    # Summed as int64; converting back wraps around as accumulating would have
+    return data.reshape(shape).sum(axis=tuple(range(1, 2*data.ndim, 2)), dtype=np.int64).astype(data.dtype)
+
+def add_array(data, other, sign=1):
+    ''' Add other (times sign, 1 or -1) into data, in place. Either can be a
+        numpy array or a sparseutils.SparseArray of the same shape.'''
+    if isinstance(other, np.ndarray):
+        index = np.flatnonzero(other)
+        values = other.reshape(-1)[index]
+    else:
+        index, values = other.index, other.values
+    if isinstance(data, np.ndarray):
+        data.reshape(-1)[index] += (sign*values).astype(data.dtype)
+    else:
+        data.add_at_linear(index, sign*values.astype(np.int64))
+
+def with_slots(entries, n):
+    ''' Return a copy of the entries dict (see process_entries) with the
+        time slots 'st' and 'et' for n slots per hour.'''
+    entries = dict(entries)
+    entries['st'] = get_t_batch(entries['sday'], entries['shour'], entries['smin'], n=n)
+    entries['et'] = get_t_batch(entries['eday'], entries['ehour'], entries['emin'], n=n)
+    return entries
+
+def derivable_entries(entries, fine, coarse):
+    ''' Return a boolean array, True for each entry that adds the same
+        to the coarse resolution's arrays as to the fine one's, coarsened:
+        its grid cells at the coarse resolution are exactly its fine cells
+        coarsened (almost always), and its start and end time slots are
+        the same at both resolutions or different at both (which decides
+        the first axis of fdata).'''
+    (fine_w, fine_h, fine_n), (w, h, n) = fine, coarse
+    fine_entries, entries = with_slots(entries, fine_n), with_slots(entries, n)
+    same_month = (entries['syear'] == entries['eyear']) & (entries['smonth'] == entries['emonth'])
+    derivable = ((fine_entries['st'] == fine_entries['et']) & same_month) == ((entries['st'] == entries['et']) & same_month)
+    for key, fine_size, size in (('sx', fine_w, w), ('sy', fine_h, h), ('ex', fine_w, w), ('ey', fine_h, h)):
+        with np.errstate(over='ignore', invalid='ignore'):
+            fine_cell, cell = entries[key]*fine_size, entries[key]*size
+        derivable &= np.isfinite(fine_cell) == np.isfinite(cell)
+        inside = (0 <= entries[key]) & (entries[key] <= 1)
+        derivable[inside] &= np.floor(fine_cell[inside]) // (fine_size // size) == np.floor(cell[inside])
+    return derivable
+
+def accumulate_resolutions(entries, line_numbers, fallback_lines, fallback_line_numbers,
+                           year, month, targets, plan, stats=None, sink=None):
+    ''' Add entries (as with accumulate_entries) and fallback lines (as with
+        accumulate_lines) into the arrays of each resolution.
+    
+    # Arguments:
+        entries, line_numbers: 'ok' entries from process_entries (for any n),
+            and their line numbers.
+        fallback_lines, fallback_line_numbers: Lines from the .csv to
+            process one at a time, and their line numbers.
+        year, month: The year and month being processed.
+        targets: Dict mapping each resolution (w, h, n) to a dict of its
+            'vdata', 'fdata', 'vdata_next_mo', 'fdata_next_mo' and 'trips'.
+        plan: Dict from plan_resolutions. The arrays of derived resolutions
+            only get corrections; see finish_resolutions.
+        stats: Optional instrument.MonthStats. (See accumulate_entries. The
+            entries are counted once, as the time of every resolution is)
+        sink: Optional errorsink.ErrorSink, to add the invalid entries and
+            lines to. (Once: they're the same at every resolution)
+    # Returns:
+        Dict mapping each resolution to (invalid_count, unparsable_lines),
+        as with accumulate_entries (with unparsable_lines sorted).
+    '''
+    results = {}
+    for resolution, parent in plan.items():
+        w, h, n = resolution
+        arrays = dict(year=year, month=month, w=w, h=h, n=n, **targets[resolution])
+        if parent is None:
+            # (The first resolution is accumulated)
+            resolution_sink = sink if not results else None
+            resolution_stats = stats if not results else instrument.uncounted(stats)
+            invalid_count, unparsable_lines = accumulate_entries(with_slots(entries, n), line_numbers,
+                                                                 stats=resolution_stats, sink=resolution_sink,
+                                                                 **arrays)
+            fallback_invalid_count, fallback_unparsable_lines = accumulate_lines(
+                fallback_lines, fallback_line_numbers, sink=resolution_sink, **arrays)
+            results[resolution] = (invalid_count + fallback_invalid_count,
+                                   sorted(unparsable_lines + fallback_unparsable_lines))
+            continue
+        
+        # Entries that can't be derived from the parent, and the fallback lines,
+        #   are taken back out of the coarsened parent and added in directly.
+        correct = ~derivable_entries(entries, parent, resolution)
+        corrected = select_entries(entries, correct)
+        parent_w, parent_h, parent_n = parent
+        parent_targets = {key : sparseutils.SparseArray(array.shape, dtype=array.dtype)
+                          for key, array in targets[parent].items() if key != 'trips'}
+        parent_targets['trips'] = np.zeros_like(targets[parent]['trips'])
+        parent_arrays = dict(year=year, month=month, w=parent_w, h=parent_h, n=parent_n, **parent_targets)
+        _, parent_unparsable_lines = accumulate_entries(with_slots(corrected, parent_n), line_numbers[correct],
+                                                        stats=instrument.uncounted(stats), **parent_arrays)
+        _, parent_fallback_unparsable_lines = accumulate_lines(fallback_lines, fallback_line_numbers,
+                                                               **parent_arrays)
+        factors = resolution_factors(parent, resolution)
+        for key, array in parent_targets.items():
+            add_array(targets[resolution][key], coarsen(array, array_factors(key, factors)), sign=-1)
+        
+        _, unparsable_lines = accumulate_entries(with_slots(corrected, n), line_numbers[correct],
+                                                 stats=instrument.uncounted(stats), **arrays)
+        _, fallback_unparsable_lines = accumulate_lines(fallback_lines, fallback_line_numbers, **arrays)
+        
+        invalid_count, unparsable = results[parent]
+        unparsable = set(unparsable) - set(parent_unparsable_lines + parent_fallback_unparsable_lines)
+        results[resolution] = (invalid_count, sorted(unparsable | set(unparsable_lines + fallback_unparsable_lines)))
+    
+    # Arrays that write finished time slots out as they go (see slabarray.py)
+    #   are told where the trips just read start
+    this_month = (entries['syear'] == year) & (entries['smonth'] == month)
+    for (w, h, n), arrays in targets.items():
+        for array in arrays.values():
+            if hasattr(array, "advance_watermark"):
+                array.advance_watermark(with_slots(select_entries(entries, this_month), n)['st'])
+    return results
+
+def finish_resolutions(targets, plan):
+    ''' Add the coarsened arrays of each derived resolution's parent into
+        its arrays, in place, once everything has been accumulated.
+        (See accumulate_resolutions.) Returns nothing.'''
+    for resolution, parent in plan.items():
+        if parent is None:
+            continue
+        factors = resolution_factors(parent, resolution)
+        for key, array in targets[parent].items():
+            add_array(targets[resolution][key], coarsen(array, array_factors(key, factors)))
+
+def process_batch_resolutions(lines, year, month, targets, plan, first_line_number=1, entries=None, stats=None,
+                              sink=None):
+    ''' Process a batch of lines from the .csv into the arrays of each
+        resolution. (See accumulate_resolutions and process_batch.)
+        entries: Optional process_entries(lines), if already parsed.
+        stats: Optional instrument.MonthStats, to count the time of each stage in.
+        sink: Optional errorsink.ErrorSink, to add the invalid entries to.
+        Returns a dict mapping each resolution to (invalid_count, unparsable_lines).'''
+    entries = process_entries(lines, stats=stats) if entries is None else entries
+    ok = entries['ok']
+    line_numbers = np.arange(first_line_number, first_line_number + len(lines))
+    # Anything the batch parser couldn't handle goes through the per-line path
+    fallback = np.flatnonzero(~ok)
+    if sink is not None:
+        sink.set_batch(first_line_number, lines)
+    return accumulate_resolutions(select_entries(entries, ok), line_numbers[ok],
+                                  [lines[ii] for ii in fallback], line_numbers[fallback],
+                                  year=year, month=month, targets=targets, plan=plan, stats=stats, sink=sink)
+
+def process_batch(lines, year, month, vdata, fdata, vdata_next_mo, fdata_next_mo, trips,
+                  w=10, h=20, n=4, first_line_number=1):
+    ''' Process a batch of lines from the .csv, exactly as process_entry,
+        check_valid and update_data would one line at a time.
+    
+    # Arguments:
+        lines: List of string lines from the .csv.
+        year, month: The year and month being processed.
+        vdata, ..., trips: Numpy arrays to update. (See update_data.)
+            Any of them but trips can also be sparseutils.SparseArrays.
+        w, h, n: Width and height of the grid, number of timeslots per hour.
+        first_line_number: Line number of lines[0], for reporting errors.
+    # Returns:
+        (invalid_count, unparsable_lines): The number of invalid entries
+            and a sorted list of the line numbers of unparsable entries.
+    '''
+    resolution = (w, h, n)
+    targets = {resolution : dict(vdata=vdata, fdata=fdata, vdata_next_mo=vdata_next_mo,
+                                 fdata_next_mo=fdata_next_mo, trips=trips)}
+    return process_batch_resolutions(lines, year=year, month=month, targets=targets, plan={resolution : None},
+                                     first_line_number=first_line_number)[resolution]